@@ -0,0 +1,96 @@
+import asyncio
+import hmac
+import threading
+import tracemalloc
+from typing import Literal
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from ..config import get_settings
+from ..drain import drain
+from ..services.memory import rss_bytes, series_counts, snapshots
+from ..services.profiler import ProfilerBusy, sample_stacks
+
+settings = get_settings()
+
+
+def require_admin(x_admin_token: str = Header(None)):
+    """Admin endpoints exist only when ADMIN_TOKEN is set, and need it in X-Admin-Token."""
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/api/v1/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def profile(
+    seconds: float = Query(5.0, gt=0),
+    interval: float = Query(0.005, ge=0.001, le=1.0),
+    all_threads: bool = False
+):
+    """
+    Sample stacks for `seconds` and return them collapsed, ready for
+    flamegraph.pl or speedscope. Samples the event loop thread unless
+    all_threads is set (threadpool work, the loop watchdog).
+    """
+    if seconds > settings.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be at most {settings.PROFILE_MAX_SECONDS}")
+    
+    thread_ids = None if all_threads else {threading.get_ident()}
+    try:
+        return await asyncio.to_thread(sample_stacks, seconds, interval, thread_ids)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+
+@router.get("/memory")
+async def memory():
+    """RSS, tracemalloc totals and the series count of each metric family."""
+    counts = series_counts()
+    traced, peak = tracemalloc.get_traced_memory()
+    return {
+        "rss_bytes": rss_bytes(),
+        "tracing": tracemalloc.is_tracing(),
+        "traced_bytes": traced,
+        "traced_peak_bytes": peak,
+        "series": dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)),
+    }
+
+
+@router.post("/memory/snapshot")
+async def take_snapshot(reset: bool = False):
+    """Start tracemalloc and keep a baseline; reset replaces an existing baseline."""
+    return await asyncio.to_thread(snapshots.snapshot, reset)
+
+
+@router.get("/memory/top")
+async def memory_top(
+    group_by: Literal["lineno", "filename", "traceback"] = "lineno",
+    limit: int = Query(20, ge=1, le=500),
+    diff: bool = True
+):
+    """Top allocation sites, by growth since the baseline unless diff is off."""
+    try:
+        return await asyncio.to_thread(snapshots.top, group_by, limit, diff)
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail="Take a snapshot first")
+
+
+@router.delete("/memory/snapshot")
+async def stop_tracing():
+    """Stop tracemalloc and drop the baseline."""
+    snapshots.stop()
+    return {"tracing": False}
+
+
+@router.post("/drain")
+async def start_drain():
+    """
+    Put every worker of this server into drain mode ahead of a shutdown,
+    e.g. from a preStop hook: /health turns 503 and new generations are
+    refused. in_flight counts this worker's generations only.
+    """
+    drain.start()
+    return {"draining": True, "in_flight": drain.in_flight}
@@ -1,23 +1,108 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import csv
+import io
+import json
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
+from ..config import get_settings
 from ..database import get_db
-from ..schemas import CopyGenerateRequest, CopyGenerateResponse, CopyVariation
-from ..services.copy_service import generate_copy, format_variation_content
-from ..services.token_service import check_can_generate, consume_generation
-from ..metrics import copy_generated, tokens_consumed, free_trial_used, TOOL_NAME
+from ..schemas import (
+    CopyType, CopyGenerateRequest, CopyGenerateResponse, CopyVariation,
+    CopyKitRequest, CopyKitResponse, CopyKitSection, CopyRefineRequest, CopyRefineResponse,
+    HistoryItem, HistoryPage
+)
+from ..services.copy_service import (
+    generate_copy, generate_kit, localize_all, refine_variation, format_variation_content
+)
+from ..services.degradation import Priority
+from ..services.history_service import decode_cursor, get_history_page, iter_history, record_generation
+from ..services.warmer import warmer
+from ..services.token_service import check_can_generate, consume_generation, refund_generation
+from ..metrics import copy_generated, tokens_consumed, free_trial_used, generation_cancelled, TOOL_NAME
+
+settings = get_settings()
 
 router = APIRouter(prefix="/api/v1/copy", tags=["copy"])
 
+# Non-standard status (as used by nginx) logged for requests the client abandoned
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the response was ready."""
+
+
+async def run_until_disconnect(raw_request: Request, coro):
+    """Await coro, cancelling it if the client disconnects first."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=settings.LLM_DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await raw_request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+def format_variations(copy_type: CopyType, raw_variations: List[Dict[str, Any]], count: int) -> List[CopyVariation]:
+    """Turn parsed model output into numbered response variations."""
+    variations = []
+    for i, var in enumerate(raw_variations[:count]):
+        content = format_variation_content(copy_type, var)
+        variations.append(CopyVariation(
+            id=i + 1,
+            content=content,
+            word_count=len(content.split())
+        ))
+    return variations
+
+
+def compact_variations(variations: List[CopyVariation]) -> List[str]:
+    """Variation texts only; ids are list positions and word counts are cheap to recompute."""
+    return [v.content for v in variations]
+
+
+def charge_generations(db: Session, device_id: str, count: int) -> Tuple[Optional[List[bool]], Optional[int]]:
+    """
+    Consume count generations, all or none.
+    Returns: (was_free_trial of each charge or None if the balance ran out, remaining_after)
+    """
+    charges, remaining = [], None
+    for _ in range(count):
+        success, remaining, was_free = consume_generation(db, device_id)
+        if not success:
+            refund_generations(db, device_id, charges)
+            return None, 0
+        charges.append(was_free)
+    return charges, remaining
+
+
+def refund_generations(db: Session, device_id: str, charges: List[bool]):
+    for was_free in charges:
+        refund_generation(db, device_id, was_free)
+
 
 @router.post("/generate", response_model=CopyGenerateResponse)
 async def generate_copy_endpoint(
     request: CopyGenerateRequest,
-    db: Session = Depends(get_db)
+    raw_request: Request,
+    db: Session = Depends(get_db),
+    compact: bool = False
 ):
-    """Generate copy variations."""
+    """
+    Generate copy variations. With ?compact=true the response carries only
+    the variation texts, balance and translations.
+    """
     
     # Check if device can generate
-    can_generate, remaining, is_free = check_can_generate(db, request.device_id)
+    can_generate, remaining, is_free = await run_in_threadpool(check_can_generate, db, request.device_id)
     
     if not can_generate:
         raise HTTPException(
@@ -25,8 +110,18 @@ async def generate_copy_endpoint(
             detail="No generations remaining. Please purchase a pack to continue."
         )
     
+    # Each target language is an extra upstream call on the same generation
+    target_languages = list(dict.fromkeys(
+        language for language in request.target_languages if language != request.language
+    ))
+    if is_free and len(target_languages) > settings.FREE_TRIAL_MAX_TARGET_LANGUAGES:
+        raise HTTPException(
+            status_code=402,
+            detail=f"Free trial generations include up to {settings.FREE_TRIAL_MAX_TARGET_LANGUAGES} translations. Please purchase a pack to continue."
+        )
+    
     # Consume one generation
-    success, new_remaining, was_free = consume_generation(db, request.device_id)
+    success, new_remaining, was_free = await run_in_threadpool(consume_generation, db, request.device_id)
     
     if not success:
         raise HTTPException(
@@ -42,43 +137,349 @@ async def generate_copy_endpoint(
     
     copy_generated.labels(tool=TOOL_NAME, copy_type=request.copy_type.value).inc()
     
+    # Don't hold a pooled connection while waiting on upstream, or requests
+    # in flight beyond the pool size queue for one. A refund checks out a
+    # fresh one.
+    await run_in_threadpool(db.close)
+    
+    warmer.observe(request.copy_type.value, request.topic, request.tone, request.language)
+    
+    try:
+        # Popular requests may already have a pre-generated result
+        raw_variations = warmer.take(request.copy_type.value, request.topic, request.tone, request.language)
+        if raw_variations is None:
+            raw_variations = await run_until_disconnect(raw_request, generate_copy(
+                copy_type=request.copy_type,
+                topic=request.topic,
+                tone=request.tone,
+                language=request.language,
+                variations=request.variations,
+                priority=Priority.FREE if was_free else Priority.PAID
+            ))
+        
+        raw_variations = raw_variations[:request.variations]
+        
+        translations = None
+        if was_free:
+            target_languages = target_languages[:settings.FREE_TRIAL_MAX_TARGET_LANGUAGES]
+        if target_languages:
+            # Translating finished copy costs a fraction of generating it again
+            localized = await run_until_disconnect(raw_request, localize_all(
+                request.copy_type,
+                raw_variations,
+                request.language,
+                target_languages,
+                Priority.FREE if was_free else Priority.PAID
+            ))
+            translations = {
+                language: format_variations(request.copy_type, translated, request.variations)
+                for language, translated in localized.items()
+            }
+        
+        variations = format_variations(request.copy_type, raw_variations, request.variations)
+        record_generation(
+            request.device_id, request.copy_type.value, request.topic, request.language,
+            [v.content for v in variations]
+        )
+        
+        if compact:
+            content = {
+                "variations": compact_variations(variations),
+                "remaining_generations": new_remaining,
+                "is_free_trial": was_free
+            }
+            if translations:
+                content["translations"] = {
+                    language: compact_variations(translated) for language, translated in translations.items()
+                }
+            return JSONResponse(content)
+        
+        return CopyGenerateResponse(
+            success=True,
+            variations=variations,
+            copy_type=request.copy_type,
+            remaining_generations=new_remaining,
+            is_free_trial=was_free,
+            translations=translations
+        )
+        
+    except ClientDisconnected:
+        # Nobody will read the result; don't charge for it
+        await run_in_threadpool(refund_generation, db, request.device_id, was_free)
+        generation_cancelled.labels(tool=TOOL_NAME, copy_type=request.copy_type.value, reason="disconnect").inc()
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    
+    except asyncio.CancelledError:
+        # Cut off by a shutdown past DRAIN_TIMEOUT_SECONDS; don't charge for it
+        await run_in_threadpool(refund_generation, db, request.device_id, was_free)
+        generation_cancelled.labels(tool=TOOL_NAME, copy_type=request.copy_type.value, reason="shutdown").inc()
+        raise
+    
+    except Exception as e:
+        # Refund the generation on error
+        await run_in_threadpool(refund_generation, db, request.device_id, was_free)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Generation failed: {str(e)}"
+        )
+
+
+@router.post("/refine", response_model=CopyRefineResponse)
+async def refine_copy_endpoint(
+    request: CopyRefineRequest,
+    raw_request: Request,
+    db: Session = Depends(get_db)
+):
+    """Revise one variation ("shorter", "more playful") without regenerating the set."""
+    
+    can_generate, remaining, is_free = await run_in_threadpool(check_can_generate, db, request.device_id)
+    
+    if not can_generate:
+        raise HTTPException(
+            status_code=402,
+            detail="No generations remaining. Please purchase a pack to continue."
+        )
+    
+    success, new_remaining, was_free = await run_in_threadpool(consume_generation, db, request.device_id)
+    
+    if not success:
+        raise HTTPException(
+            status_code=402,
+            detail="Failed to consume generation. Please try again."
+        )
+    
+    if was_free:
+        free_trial_used.labels(tool=TOOL_NAME).inc()
+    else:
+        tokens_consumed.labels(tool=TOOL_NAME).inc()
+    
+    copy_generated.labels(tool=TOOL_NAME, copy_type=request.copy_type.value).inc()
+    
+    # See generate_copy_endpoint
+    await run_in_threadpool(db.close)
+    
     try:
-        # Generate copy
-        raw_variations = await generate_copy(
+        revised = await run_until_disconnect(raw_request, refine_variation(
             copy_type=request.copy_type,
             topic=request.topic,
             tone=request.tone,
             language=request.language,
-            variations=request.variations
-        )
+            variation=request.variation,
+            instruction=request.instruction,
+            priority=Priority.FREE if was_free else Priority.PAID
+        ))
         
-        # Format variations
-        variations = []
-        for i, var in enumerate(raw_variations[:request.variations]):
-            content = format_variation_content(request.copy_type, var)
-            variations.append(CopyVariation(
-                id=i + 1,
-                content=content,
-                word_count=len(content.split())
-            ))
+        variation = format_variations(request.copy_type, [revised], 1)[0]
+        record_generation(
+            request.device_id, request.copy_type.value, request.topic, request.language,
+            [variation.content]
+        )
         
-        return CopyGenerateResponse(
+        return CopyRefineResponse(
             success=True,
-            variations=variations,
+            variation=variation,
             copy_type=request.copy_type,
             remaining_generations=new_remaining,
             is_free_trial=was_free
         )
+    
+    except ClientDisconnected:
+        await run_in_threadpool(refund_generation, db, request.device_id, was_free)
+        generation_cancelled.labels(tool=TOOL_NAME, copy_type=request.copy_type.value, reason="disconnect").inc()
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    
+    except asyncio.CancelledError:
+        await run_in_threadpool(refund_generation, db, request.device_id, was_free)
+        generation_cancelled.labels(tool=TOOL_NAME, copy_type=request.copy_type.value, reason="shutdown").inc()
+        raise
+    
+    except Exception as e:
+        await run_in_threadpool(refund_generation, db, request.device_id, was_free)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Refinement failed: {str(e)}"
+        )
+
+
+@router.post("/kit", response_model=CopyKitResponse)
+async def generate_kit_endpoint(
+    request: CopyKitRequest,
+    raw_request: Request,
+    db: Session = Depends(get_db),
+    compact: bool = False
+):
+    """
+    Generate several copy types for one topic in one upstream call, billed per
+    type. With ?compact=true sections map each copy type to its texts.
+    """
+    
+    can_generate, remaining, is_free = await run_in_threadpool(check_can_generate, db, request.device_id)
+    
+    if not can_generate:
+        raise HTTPException(
+            status_code=402,
+            detail="No generations remaining. Please purchase a pack to continue."
+        )
+    
+    # One generation per copy type; was_free of each, for refunds
+    charges, new_remaining = await run_in_threadpool(charge_generations, db, request.device_id, len(request.copy_types))
+    if charges is None:
+        raise HTTPException(
+            status_code=402,
+            detail=f"This kit needs {len(request.copy_types)} generations. Please purchase a pack to continue."
+        )
+    
+    # Once paid credits run out mid-kit the rest comes from the free trial;
+    # a kit with any free-trial section is scheduled and reported as one
+    is_free_trial = any(charges)
+    
+    for copy_type, charged_free in zip(request.copy_types, charges):
+        if charged_free:
+            free_trial_used.labels(tool=TOOL_NAME).inc()
+        else:
+            tokens_consumed.labels(tool=TOOL_NAME).inc()
+        copy_generated.labels(tool=TOOL_NAME, copy_type=copy_type.value).inc()
+    
+    # See generate_copy_endpoint
+    await run_in_threadpool(db.close)
+    
+    try:
+        kit = await run_until_disconnect(raw_request, generate_kit(
+            copy_types=request.copy_types,
+            topic=request.topic,
+            tone=request.tone,
+            language=request.language,
+            variations=request.variations,
+            priority=Priority.FREE if is_free_trial else Priority.PAID
+        ))
+        
+        charged_free = dict(zip(request.copy_types, charges))
+        sections = [
+            CopyKitSection(
+                copy_type=copy_type,
+                variations=format_variations(copy_type, raw_variations, request.variations),
+                is_free_trial=charged_free[copy_type]
+            )
+            for copy_type, raw_variations in kit.items()
+        ]
+        for section in sections:
+            record_generation(
+                request.device_id, section.copy_type.value, request.topic, request.language,
+                [v.content for v in section.variations]
+            )
+        
+        if compact:
+            return JSONResponse({
+                "sections": {section.copy_type.value: compact_variations(section.variations) for section in sections},
+                "remaining_generations": new_remaining,
+                "is_free_trial": is_free_trial
+            })
         
+        return CopyKitResponse(
+            success=True,
+            sections=sections,
+            remaining_generations=new_remaining,
+            is_free_trial=is_free_trial
+        )
+    
+    except ClientDisconnected:
+        await run_in_threadpool(refund_generations, db, request.device_id, charges)
+        for copy_type in request.copy_types:
+            generation_cancelled.labels(tool=TOOL_NAME, copy_type=copy_type.value, reason="disconnect").inc()
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    
+    except asyncio.CancelledError:
+        await run_in_threadpool(refund_generations, db, request.device_id, charges)
+        for copy_type in request.copy_types:
+            generation_cancelled.labels(tool=TOOL_NAME, copy_type=copy_type.value, reason="shutdown").inc()
+        raise
+    
     except Exception as e:
-        # Refund the generation on error
-        # (In production, you'd want more sophisticated error handling)
+        await run_in_threadpool(refund_generations, db, request.device_id, charges)
         raise HTTPException(
             status_code=500,
             detail=f"Generation failed: {str(e)}"
         )
 
 
+@router.get("/history/{device_id}", response_model=HistoryPage)
+async def get_history(
+    device_id: str,
+    limit: int = Query(default=20, ge=1, le=settings.HISTORY_PAGE_MAX),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    compact: bool = False
+):
+    """
+    Get a device's past generations, newest first. With ?compact=true items
+    are rows of values in the order given by "fields".
+    """
+    
+    try:
+        position = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    rows, next_cursor = await run_in_threadpool(get_history_page, db, device_id, limit, position)
+    if compact:
+        items = [HistoryItem.model_validate(row).model_dump(mode="json") for row in rows]
+        return JSONResponse({
+            "fields": HISTORY_EXPORT_FIELDS,
+            "items": [[item[field] for field in HISTORY_EXPORT_FIELDS] for item in items],
+            "next_cursor": next_cursor
+        })
+    return HistoryPage(
+        items=[HistoryItem.model_validate(row) for row in rows],
+        next_cursor=next_cursor
+    )
+
+
+HISTORY_EXPORT_FIELDS = ["id", "created_at", "copy_type", "topic", "language", "variation_id", "content"]
+
+
+@router.get("/history/{device_id}/export")
+async def export_history(
+    device_id: str,
+    format: str = Query(default="ndjson", pattern="^(ndjson|csv)$"),
+    db: Session = Depends(get_db)
+):
+    """Stream a device's whole history as NDJSON or CSV, one page in memory at a time."""
+    
+    def ndjson_lines():
+        for row in iter_history(db, device_id):
+            yield json.dumps(HistoryItem.model_validate(row).model_dump(mode="json"), ensure_ascii=False) + "\n"
+    
+    def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(HISTORY_EXPORT_FIELDS)
+        for row in iter_history(db, device_id):
+            item = HistoryItem.model_validate(row).model_dump(mode="json")
+            writer.writerow([item[field] for field in HISTORY_EXPORT_FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    
+    def stream(lines):
+        # The request's session has been released by now; it reconnects
+        # for the export and is closed again at the end.
+        try:
+            yield from lines()
+        finally:
+            db.close()
+    
+    if format == "csv":
+        body, media_type = stream(csv_lines), "text/csv"
+    else:
+        body, media_type = stream(ndjson_lines), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="history.{format}"'}
+    )
+
+
 @router.get("/types")
 async def get_copy_types():
     """Get available copy types."""
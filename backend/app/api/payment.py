@@ -1,14 +1,17 @@
 import json
 import hmac
 import hashlib
-import httpx
 from fastapi import APIRouter, Depends, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from ..database import get_db
 from ..config import get_settings
-from ..models import GenerationToken, PaymentTransaction
+from ..models import PaymentTransaction
 from ..schemas import CheckoutRequest, CheckoutResponse
+from ..services.payment_service import CheckoutInProgress, CreemError, get_creem_client
+from ..services.token_service import add_paid_token
+from ..services.exhausted_filter import exhausted_devices
 from ..metrics import (
     payment_checkout_created, payment_success, payment_revenue_cents,
     tokens_created, TOOL_NAME
@@ -27,11 +30,7 @@ PRODUCTS = {
 
 def get_creem_product_id(sku: str) -> str:
     """Get Creem product ID for a SKU."""
-    try:
-        product_ids = json.loads(settings.CREEM_PRODUCT_IDS)
-        return product_ids.get(sku, "")
-    except json.JSONDecodeError:
-        return ""
+    return get_creem_client().product_ids.get(sku, "")
 
 
 @router.post("/create-checkout", response_model=CheckoutResponse)
@@ -51,35 +50,26 @@ async def create_checkout(request: CheckoutRequest):
     # Track metrics
     payment_checkout_created.labels(tool=TOOL_NAME, product_sku=request.product_sku).inc()
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            f"{settings.CREEM_API_BASE}/v1/checkouts",
-            headers={
-                "Authorization": f"Bearer {settings.CREEM_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "product_id": product_id,
-                "success_url": request.success_url,
-                "cancel_url": request.cancel_url,
-                "metadata": {
-                    "device_id": request.device_id,
-                    "product_sku": request.product_sku
-                }
-            }
+    try:
+        checkout = await get_creem_client().create_checkout(
+            device_id=request.device_id,
+            product_sku=request.product_sku,
+            success_url=request.success_url,
+            cancel_url=request.cancel_url
         )
-        
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Checkout creation failed: {response.text}"
-            )
-        
-        data = response.json()
-        return CheckoutResponse(
-            checkout_url=data["checkout_url"],
-            checkout_id=data["id"]
+    except CheckoutInProgress:
+        raise HTTPException(
+            status_code=409,
+            detail="Checkout is already being created. Please retry.",
+            headers={"Retry-After": "1"}
+        )
+    except CreemError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Checkout creation failed: {str(e)}"
         )
+    
+    return CheckoutResponse(**checkout)
 
 
 @router.post("/webhook")
@@ -111,12 +101,12 @@ async def handle_webhook(
     event_type = payload.get("type")
     
     if event_type == "checkout.completed":
-        await handle_checkout_completed(payload, db)
+        await run_in_threadpool(handle_checkout_completed, payload, db)
     
     return {"status": "ok"}
 
 
-async def handle_checkout_completed(payload: dict, db: Session):
+def handle_checkout_completed(payload: dict, db: Session):
     """Handle successful checkout."""
     
     data = payload.get("data", {})
@@ -143,16 +133,14 @@ async def handle_checkout_completed(payload: dict, db: Session):
     if existing:
         return
     
-    # Create token
-    token = GenerationToken(
-        device_id=device_id,
-        product_sku=product_sku,
-        total_generations=product["generations"],
-        remaining_generations=product["generations"],
-        expires_at=datetime.utcnow() + timedelta(days=365)
+    # Create token and credit the device balance
+    token = add_paid_token(
+        db,
+        device_id,
+        product_sku,
+        product["generations"],
+        datetime.utcnow() + timedelta(days=365)
     )
-    db.add(token)
-    db.flush()
     
     # Create transaction record
     transaction = PaymentTransaction(
@@ -167,6 +155,7 @@ async def handle_checkout_completed(payload: dict, db: Session):
     )
     db.add(transaction)
     db.commit()
+    exhausted_devices.discard(device_id)
     
     # Track metrics
     payment_success.labels(tool=TOOL_NAME, product_sku=product_sku, currency="USD").inc()
@@ -4,7 +4,7 @@ from datetime import datetime
 from ..database import get_db
 from ..models import GenerationToken
 from ..schemas import TokensByDeviceResponse, TokenInfo
-from ..services.token_service import check_can_generate
+from ..services.token_service import check_can_generate, get_device_balance
 from ..config import get_settings
 
 settings = get_settings()
@@ -12,7 +12,7 @@ router = APIRouter(prefix="/api/v1/tokens", tags=["tokens"])
 
 
 @router.get("/by-device/{device_id}", response_model=TokensByDeviceResponse)
-async def get_tokens_by_device(device_id: str, db: Session = Depends(get_db)):
+def get_tokens_by_device(device_id: str, db: Session = Depends(get_db)):
     """Get all tokens for a device."""
     
     now = datetime.utcnow()
@@ -32,13 +32,13 @@ async def get_tokens_by_device(device_id: str, db: Session = Depends(get_db)):
         for t in tokens
     ]
     
-    total_remaining = sum(t.remaining_generations for t in tokens)
+    total_remaining = get_device_balance(db, device_id).paid_remaining
     
     return TokensByDeviceResponse(tokens=token_list, total_remaining=total_remaining)
 
 
 @router.get("/status/{device_id}")
-async def get_device_status(device_id: str, db: Session = Depends(get_db)):
+def get_device_status(device_id: str, db: Session = Depends(get_db)):
     """Get generation status for a device."""
     
     can_generate, remaining, is_free = check_can_generate(db, device_id)
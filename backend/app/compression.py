@@ -0,0 +1,128 @@
+import zlib
+from typing import Optional
+from starlette.datastructures import Headers, MutableHeaders
+from .config import get_settings
+from .metrics import compressed_responses, TOOL_NAME
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+settings = get_settings()
+
+# Types worth compressing; images and archives are compressed already
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "application/javascript")
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Best encoding the client accepts: br over gzip, honouring q=0."""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip()] = q
+    wildcard = accepted.get("*", 0.0)
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+class _Gzip:
+    def __init__(self):
+        # wbits 31: gzip container
+        self._compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    
+    def chunk(self, data: bytes) -> bytes:
+        # Sync flush so each chunk of a stream reaches the client right away
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+    
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+    
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with brotli (when installed) or gzip, as negotiated
+    through Accept-Encoding. Single-part bodies under COMPRESSION_MIN_SIZE are
+    sent as they are. Streamed bodies are compressed chunk by chunk, never
+    buffered, so exports and other streams still arrive progressively.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.COMPRESSION_ENABLED or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start = None
+        compressor = None
+        
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held until the first body chunk shows whether it is worth compressing
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=list(start["headers"]))
+                if (
+                    "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < settings.COMPRESSION_MIN_SIZE)
+                ):
+                    if "content-encoding" not in headers:
+                        headers.add_vary_header("Accept-Encoding")
+                    await send({**start, "headers": headers.raw})
+                    start = None
+                    await send(message)
+                    return
+                
+                compressor = _Brotli() if encoding == "br" else _Gzip()
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                del headers["content-length"]
+                compressed_responses.labels(tool=TOOL_NAME, encoding=encoding).inc()
+                if not more_body:
+                    body = compressor.finish(body)
+                    headers["content-length"] = str(len(body))
+                    await send({**start, "headers": headers.raw})
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send({**start, "headers": headers.raw})
+            
+            data = compressor.finish(body) if not more_body else compressor.chunk(body)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+        
+        await self.app(scope, receive, send_compressed)
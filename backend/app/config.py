@@ -12,18 +12,155 @@ class Settings(BaseSettings):
     # LLM Proxy
     LLM_PROXY_URL: str = "https://llm-proxy.densematrix.ai"
     LLM_PROXY_KEY: str = ""
+    LLM_MODEL: str = "gpt-4o-mini"
+    LLM_TIMEOUT_SECONDS: float = 60.0
+    LLM_MAX_CONNECTIONS: int = 50
+    # Follow-up calls for variations missing from a short or malformed reply
+    LLM_TOPUP_ATTEMPTS: int = 1
+    # Don't start a follow-up with less than this much of the deadline left
+    LLM_TOPUP_MIN_SECONDS: float = 10.0
+    # Cassettes of upstream traffic (see app/services/cassette.py): record every
+    # exchange to LLM_RECORD_PATH, or answer from LLM_REPLAY_PATH instead of upstream
+    LLM_RECORD_PATH: str = ""
+    LLM_REPLAY_PATH: str = ""
+    # Replayed latency relative to the recording; 0 = instant
+    LLM_REPLAY_LATENCY_SCALE: float = 1.0
+    # Upstream connections opened in the background at startup, so the first
+    # generations don't pay for TCP and TLS setup
+    LLM_PREWARM_CONNECTIONS: int = 4
+    # Variations at least this similar (Jaccard of 4-gram shingles) to an
+    # earlier one are dropped and topped up
+    DEDUP_ENABLED: bool = True
+    DEDUP_SIMILARITY_THRESHOLD: float = 0.8
+    # Load-aware degradation of free-trial and batch requests
+    DEGRADE_ENABLED: bool = True
+    # Faster model for degraded requests; set empty to keep LLM_MODEL
+    DEGRADE_MODEL: str = "gpt-4.1-nano"
+    DEGRADE_MAX_TOKENS: int = 1000
+    DEGRADE_MAX_VARIATIONS: int = 2
+    # Full pressure at this average upstream latency / queue depth
+    DEGRADE_LATENCY_SECONDS: float = 20.0
+    DEGRADE_QUEUE_DEPTH: int = 50
+    # Minimum time at a level before stepping back down
+    DEGRADE_HOLD_SECONDS: float = 30.0
+    # Upstream call scheduling: slot share per class when requests queue,
+    # and concurrency caps that keep room for paid requests
+    SCHEDULER_PAID_WEIGHT: int = 8
+    SCHEDULER_FREE_WEIGHT: int = 2
+    SCHEDULER_BATCH_WEIGHT: int = 1
+    SCHEDULER_FREE_MAX_CONCURRENCY: int = 30
+    SCHEDULER_BATCH_MAX_CONCURRENCY: int = 10
+    # How often a pending generation checks whether its client went away
+    LLM_DISCONNECT_POLL_SECONDS: float = 0.5
     
     # Database
     DATABASE_URL: str = "sqlite:///./app.db"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    # Sharded SQLite: >1 splits device data across this many files by device_id
+    DATABASE_SHARDS: int = 0
+    DATABASE_SHARD_URL_TEMPLATE: str = "sqlite:///./data/app_shard{shard}.db"
+    # PostgreSQL connection pool
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 10
+    DB_POOL_RECYCLE: int = 1800
+    DB_STATEMENT_TIMEOUT_MS: int = 5000
+    
+    # Multi-worker
+    # SQLite file for state shared between worker processes; empty = in-process only
+    SHARED_STORE_PATH: str = ""
     
     # Creem Payment
     CREEM_API_KEY: str = ""
     CREEM_WEBHOOK_SECRET: str = ""
     CREEM_API_BASE: str = "https://api.creem.io"
     CREEM_PRODUCT_IDS: str = '{"pack_10": "", "pack_50": "", "pack_200": ""}'
+    CREEM_TIMEOUT_SECONDS: float = 30.0
+    CREEM_MAX_RETRIES: int = 2
+    CREEM_MAX_CONNECTIONS: int = 20
+    CREEM_CHECKOUT_CACHE_SECONDS: int = 30
     
     # Free trial
     FREE_GENERATIONS_PER_DEVICE: int = 3
+    # Translations a free-trial generation may include (paid: up to 10)
+    FREE_TRIAL_MAX_TARGET_LANGUAGES: int = 2
+    
+    # Exhausted-device filter (refuses known-exhausted devices without DB work)
+    EXHAUSTED_FILTER_ENABLED: bool = True
+    EXHAUSTED_FILTER_CAPACITY: int = 100_000
+    EXHAUSTED_FILTER_FP_RATE: float = 1e-6
+    # Share of filter hits double-checked against the database
+    EXHAUSTED_FILTER_VERIFY_RATE: float = 0.01
+    EXHAUSTED_FILTER_RESET_SECONDS: int = 86400
+    # How often a worker picks up purchases made through other workers
+    EXHAUSTED_FILTER_SYNC_SECONDS: float = 1.0
+    
+    # Maintenance (archiving spent tokens, pruning free-trial rows)
+    MAINTENANCE_ENABLED: bool = True
+    MAINTENANCE_INTERVAL_SECONDS: int = 3600
+    MAINTENANCE_BATCH_SIZE: int = 500
+    MAINTENANCE_MAX_BATCHES: int = 20
+    # Free-trial rows never used are dropped after this many days
+    FREE_TRIAL_IDLE_DAYS: int = 7
+    # Exhausted tokens stay this long before archiving, well past any
+    # generation's deadline, so a failed generation can still be refunded
+    ARCHIVE_EXHAUSTED_AFTER_HOURS: int = 24
+    
+    # Generation history (buffered, written in batches off the request path)
+    HISTORY_ENABLED: bool = True
+    HISTORY_BATCH_SIZE: int = 200
+    HISTORY_FLUSH_SECONDS: float = 2.0
+    # Rows buffered beyond this are dropped (oldest first)
+    HISTORY_BUFFER_MAX: int = 10_000
+    HISTORY_PAGE_MAX: int = 100
+    
+    # Cache warming: pre-generate the most requested topics while upstream is quiet
+    WARMER_ENABLED: bool = False
+    WARMER_INTERVAL_SECONDS: float = 60
+    # Distinct requests the popularity sketch tracks
+    WARMER_SKETCH_SIZE: int = 1000
+    WARMER_TOP_K: int = 20
+    # Requests seen before a combination is worth warming
+    WARMER_MIN_COUNT: int = 3
+    WARMER_RESULTS_PER_KEY: int = 2
+    WARMER_RESULT_TTL_SECONDS: float = 3600
+    # Upstream tokens warming may spend per hour across all workers on the
+    # node (kept in the shared store), counted at max_tokens per call
+    WARMER_TOKEN_BUDGET_PER_HOUR: int = 200_000
+    # Warming pauses above this degradation pressure (0-1)
+    WARMER_MAX_PRESSURE: float = 0.3
+    
+    # Response compression (brotli when installed, else gzip)
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_MIN_SIZE: int = 1024
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_BROTLI_QUALITY: int = 4
+    
+    # Shutdown: in-flight generations get this long before they are cancelled
+    # and refunded; keep it below gunicorn's GRACEFUL_TIMEOUT
+    DRAIN_TIMEOUT_SECONDS: float = 20
+    
+    # Admin endpoints (/api/v1/admin); disabled while empty
+    ADMIN_TOKEN: str = ""
+    PROFILE_MAX_SECONDS: float = 60
+    # Stack depth tracemalloc records per allocation once a snapshot is taken
+    TRACEMALLOC_FRAMES: int = 1
+    
+    # Event loop lag monitor; the loop is reported blocked after this long
+    LOOP_MONITOR_ENABLED: bool = True
+    LOOP_MONITOR_INTERVAL_SECONDS: float = 0.25
+    LOOP_BLOCKED_THRESHOLD_SECONDS: float = 1.0
+    
+    # Rate limiting (token buckets on generation endpoints)
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_DEVICE_PER_MINUTE: float = 10
+    RATE_LIMIT_DEVICE_BURST: int = 5
+    RATE_LIMIT_IP_PER_MINUTE: float = 60
+    RATE_LIMIT_IP_BURST: int = 20
+    RATE_LIMIT_MAX_KEYS: int = 100_000
+    # Comma-separated proxy addresses or CIDR ranges whose X-Real-IP header is
+    # used as the client address. Empty: always use the peer address
+    RATE_LIMIT_TRUSTED_PROXIES: str = ""
     
     class Config:
         env_file = ".env"
@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, make_url
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker, Session
 from contextlib import contextmanager
 from .config import get_settings
@@ -6,16 +7,80 @@ from .models import Base
 
 settings = get_settings()
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {}
-)
+
+def engine_options(url: str) -> dict:
+    """create_engine() keyword arguments tuned for the database behind url."""
+    backend = make_url(url).get_backend_name()
+    
+    if backend == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+    
+    if backend == "postgresql":
+        return {
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+            "pool_pre_ping": True,
+            "connect_args": {
+                "options": f"-c statement_timeout={int(settings.DB_STATEMENT_TIMEOUT_MS)}"
+            },
+        }
+    
+    return {"pool_pre_ping": True}
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers in other workers proceed while one writes; the busy
+    # timeout makes writers wait for the lock instead of failing fast.
+    cursor = dbapi_connection.cursor()
+    # Only takes effect on a fresh file; lets maintenance return freed pages.
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.close()
+
+
+def create_db_engine(url: str, **kwargs) -> Engine:
+    """Create an engine for url with the options for its dialect."""
+    db_engine = create_engine(url, **{**engine_options(url), **kwargs})
+    if db_engine.dialect.name == "sqlite" and db_engine.url.database not in (None, "", ":memory:"):
+        event.listen(db_engine, "connect", _sqlite_pragmas)
+    return db_engine
+
+
+engine = create_db_engine(settings.DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Optional: device-keyed tables split across several SQLite files
+shard_router = None
+if settings.DATABASE_SHARDS > 1:
+    from .sharding import ShardRouter
+    shard_router = ShardRouter.from_template(settings.DATABASE_SHARD_URL_TEMPLATE, settings.DATABASE_SHARDS)
+    SessionLocal = shard_router.session_factory()
+
+
+def create_tables(bind: Engine):
+    """Create missing tables; a schema that is already in place costs one query."""
+    if set(Base.metadata.tables) <= set(inspect(bind).get_table_names()):
+        return
+    Base.metadata.create_all(bind=bind)
+
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    if shard_router is not None:
+        shard_router.create_all()
+    else:
+        create_tables(engine)
+
+
+def dispose_db():
+    """Close pooled connections, e.g. before forking workers."""
+    if shard_router is not None:
+        shard_router.dispose()
+    engine.dispose()
 
 
 def get_db():
@@ -0,0 +1,110 @@
+import json
+import os
+import time
+import uuid
+from .config import get_settings
+from .metrics import generations_in_flight, drain_rejected, TOOL_NAME
+from .shared_store import get_shared_store
+
+settings = get_settings()
+
+DRAIN_STORE_KEY = "drain:node"
+
+
+def boot_id() -> str:
+    """
+    Identifies this start of the server. Gunicorn's master sets APP_BOOT_ID
+    for all its workers (gunicorn.conf.py); a single process makes up its own.
+    """
+    return os.environ.setdefault("APP_BOOT_ID", uuid.uuid4().hex)
+
+
+class DrainState:
+    """
+    Whether this node is draining, and how many generation requests this
+    worker is still serving. Once draining, /health reports 503 so the load
+    balancer stops routing here, and new generations are refused with a 503.
+
+    Draining is recorded in the shared store under the boot id, so it holds
+    for every worker of this server and not for the next one started on the
+    same store. Workers re-read the flag at most every check_seconds.
+    """
+    
+    def __init__(self, store=None, check_seconds: float = 0.5):
+        self.in_flight = 0
+        self.check_seconds = check_seconds
+        self._store = store
+        self._draining = False
+        self._checked_at = float("-inf")
+    
+    @property
+    def store(self):
+        return self._store if self._store is not None else get_shared_store()
+    
+    @property
+    def draining(self) -> bool:
+        if not self._draining and time.monotonic() - self._checked_at >= self.check_seconds:
+            self._checked_at = time.monotonic()
+            self._draining = self.store.get(DRAIN_STORE_KEY) == boot_id()
+        return self._draining
+    
+    def start(self):
+        """Drain every worker of this server."""
+        self._draining = True
+        self.store.set(DRAIN_STORE_KEY, boot_id(), ttl=86400)
+    
+    def clear(self):
+        self._draining = False
+        self._checked_at = float("-inf")
+        self.store.delete(DRAIN_STORE_KEY)
+
+
+drain = DrainState()
+
+
+class DrainMiddleware:
+    """
+    Counts in-flight generation requests and refuses new ones while draining.
+    Requests already running are left to finish.
+    """
+    
+    def __init__(self, app, path_prefix: str = "/api/v1/copy/"):
+        self.app = app
+        self.path_prefix = path_prefix
+    
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
+        
+        if drain.draining:
+            await self._reject(send)
+            return
+        
+        drain.in_flight += 1
+        generations_in_flight.labels(tool=TOOL_NAME).inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            drain.in_flight -= 1
+            generations_in_flight.labels(tool=TOOL_NAME).dec()
+    
+    @staticmethod
+    async def _reject(send):
+        drain_rejected.labels(tool=TOOL_NAME).inc()
+        body = json.dumps({"detail": "Server is restarting. Please retry."}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", b"1"),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,23 +1,92 @@
 import re
-from fastapi import FastAPI, Request
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import logging
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from .config import get_settings
 from .database import init_db
-from .api import copy, payment, tokens
-from .metrics import metrics_router, http_requests, crawler_visits, TOOL_NAME
+from .api import admin, copy, payment, tokens
+from .compression import CompressionMiddleware
+from .drain import DrainMiddleware, drain
+from .ratelimit import RateLimitMiddleware
+from .services.copy_service import start_llm_client, close_llm_client, prewarm_llm_client
+from .services.payment_service import start_creem_client, close_creem_client
+from .services.maintenance_service import maintenance_loop
+from .services.history_service import history_writer_loop, stop_history_writer
+from .services.warmer import warmer, warmer_loop
+from .services.profiler import loop_monitor
+from .metrics import metrics_router, http_requests, crawler_visits, startup_phase_seconds, TOOL_NAME
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 
 BOT_PATTERNS = ["Googlebot", "bingbot", "Baiduspider", "YandexBot", "DuckDuckBot", "Slurp", "msnbot"]
 
 
+@contextmanager
+def _phase(timings: dict, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started
+
+
+def _report_startup(timings: dict):
+    for name, seconds in timings.items():
+        startup_phase_seconds.labels(tool=TOOL_NAME, phase=name).set(seconds)
+    logger.info(
+        "startup took %.3fs: %s",
+        sum(timings.values()),
+        ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items())
+    )
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    init_db()
+    timings = {"imports": _IMPORT_SECONDS}
+    with _phase(timings, "init_db"):
+        init_db()
+    with _phase(timings, "clients"):
+        start_creem_client()
+        start_llm_client()
+    # Connections open while the first requests are already being served
+    prewarm = None
+    if settings.LLM_PREWARM_CONNECTIONS and not (settings.LLM_RECORD_PATH or settings.LLM_REPLAY_PATH):
+        prewarm = asyncio.create_task(prewarm_llm_client(settings.LLM_PREWARM_CONNECTIONS))
+    if settings.LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    maintenance = asyncio.create_task(maintenance_loop()) if settings.MAINTENANCE_ENABLED else None
+    history_writer = asyncio.create_task(history_writer_loop()) if settings.HISTORY_ENABLED else None
+    cache_warmer = asyncio.create_task(warmer_loop()) if settings.WARMER_ENABLED else None
+    _report_startup(timings)
     yield
-    # Shutdown
+    # Shutdown. By now uvicorn has let running generations finish, or
+    # cancelled and refunded them after DRAIN_TIMEOUT_SECONDS (app/worker.py)
+    if prewarm:
+        prewarm.cancel()
+    if maintenance:
+        maintenance.cancel()
+    if cache_warmer:
+        cache_warmer.cancel()
+        try:
+            warmer.save_sketch()
+        except Exception:
+            logger.exception("saving warmer sketch failed")
+    await stop_history_writer(history_writer)
+    await close_creem_client()
+    await close_llm_client()
+    loop_monitor.stop()
 
 
 app = FastAPI(
@@ -27,6 +96,11 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Added before CORS so 429s and 503s still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
+# Outside rate limiting: requests refused while draining don't spend tokens
+app.add_middleware(DrainMiddleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -37,40 +111,74 @@ app.add_middleware(
 )
 
 
-@app.middleware("http")
-async def track_metrics(request: Request, call_next):
-    # Track crawler visits
-    ua = request.headers.get("user-agent", "")
-    for bot in BOT_PATTERNS:
-        if bot.lower() in ua.lower():
-            crawler_visits.labels(tool=TOOL_NAME, bot=bot).inc()
-            break
-    
-    response = await call_next(request)
+class TrackMetricsMiddleware:
+    """
+    Counts requests and crawler visits. Pure ASGI rather than
+    @app.middleware("http"), which hides client disconnects from endpoints.
+    """
     
-    # Track HTTP requests
-    endpoint = request.url.path
-    method = request.method
-    status = response.status_code
-    http_requests.labels(
-        tool=TOOL_NAME,
-        endpoint=endpoint,
-        method=method,
-        status=status
-    ).inc()
+    def __init__(self, app):
+        self.app = app
     
-    return response
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        # Track crawler visits
+        ua = Headers(scope=scope).get("user-agent", "")
+        for bot in BOT_PATTERNS:
+            if bot.lower() in ua.lower():
+                crawler_visits.labels(tool=TOOL_NAME, bot=bot).inc()
+                break
+        
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Label by route template, not path: raw paths carry device ids
+            # and would add a series per device
+            route = scope.get("route")
+            http_requests.labels(
+                tool=TOOL_NAME,
+                endpoint=route.path if route is not None else "unmatched",
+                method=scope["method"],
+                status=status
+            ).inc()
+
+
+# Outside CORS so it compresses the final response
+app.add_middleware(CompressionMiddleware)
+
+# Added last so it is outermost and sees every response
+app.add_middleware(TrackMetricsMiddleware)
 
 
 # Include routers
 app.include_router(copy.router)
 app.include_router(payment.router)
 app.include_router(tokens.router)
+app.include_router(admin.router)
 app.include_router(metrics_router)
 
 
 @app.get("/health")
 async def health():
+    if drain.draining:
+        # Readiness: take this worker out of rotation
+        return JSONResponse(status_code=503, content={
+            "status": "draining",
+            "in_flight": drain.in_flight,
+            "version": settings.APP_VERSION,
+            "service": settings.APP_NAME
+        })
     return {
         "status": "healthy",
         "version": settings.APP_VERSION,
@@ -89,6 +197,9 @@ async def root():
             "docs": "/docs",
             "copy_types": "/api/v1/copy/types",
             "generate": "POST /api/v1/copy/generate",
+            "kit": "POST /api/v1/copy/kit",
+            "refine": "POST /api/v1/copy/refine",
+            "history": "/api/v1/copy/history/{device_id}",
             "products": "/api/v1/payment/products"
         }
     }
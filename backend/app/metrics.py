@@ -1,5 +1,7 @@
 import os
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import (
+    Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+)
 from fastapi import APIRouter
 from fastapi.responses import Response
 
@@ -18,6 +20,12 @@ http_request_duration = Histogram(
     ["tool", "endpoint", "method"]
 )
 
+compressed_responses = Counter(
+    "compressed_responses_total",
+    "Responses sent compressed",
+    ["tool", "encoding"]
+)
+
 # Payment Metrics
 payment_checkout_created = Counter(
     "payment_checkout_created_total",
@@ -63,6 +71,194 @@ copy_generated = Counter(
     ["tool", "copy_type"]
 )
 
+variation_topups = Counter(
+    "variation_topups_total",
+    "Follow-up calls for variations missing from the first reply",
+    ["tool", "copy_type", "result"]
+)
+
+variation_similarity = Histogram(
+    "variation_similarity",
+    "Highest similarity of each variation to the ones before it",
+    ["tool"],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+)
+
+near_duplicates = Counter(
+    "near_duplicate_variations_total",
+    "Variations dropped as near-duplicates",
+    ["tool", "copy_type"]
+)
+
+kit_fallbacks = Counter(
+    "kit_fallbacks_total",
+    "Campaign kit sections regenerated with a single-type call",
+    ["tool", "copy_type"]
+)
+
+warmer_requests = Counter(
+    "warmer_requests_total",
+    "Generation requests answered from warmed results or not",
+    ["tool", "result"]
+)
+
+warmer_generations = Counter(
+    "warmer_generations_total",
+    "Results pre-generated for popular requests",
+    ["tool"]
+)
+
+localizations = Counter(
+    "localizations_total",
+    "Translation calls for target languages",
+    ["tool", "result"]
+)
+
+degradation_level = Gauge(
+    "generation_degradation_level",
+    "Current load degradation level (0 = normal)",
+    ["tool"],
+    multiprocess_mode="max"
+)
+
+degraded_generations = Counter(
+    "degraded_generations_total",
+    "Generations run with a smaller model, budget or variation count",
+    ["tool", "priority"]
+)
+
+generation_queue_seconds = Histogram(
+    "generation_queue_seconds",
+    "Time generations waited for an upstream slot",
+    ["tool", "priority"],
+    buckets=(0.005, 0.05, 0.25, 1, 2.5, 5, 10, 30, 60)
+)
+
+generation_queue_depth = Gauge(
+    "generation_queue_depth",
+    "Generations waiting for an upstream slot",
+    ["tool", "priority"],
+    multiprocess_mode="livesum"
+)
+
+generation_cancelled = Counter(
+    "generation_cancelled_total",
+    "Generations cancelled and refunded: the client disconnected or shutdown cut them off",
+    ["tool", "copy_type", "reason"]
+)
+
+rate_limited = Counter(
+    "rate_limited_total",
+    "Requests rejected by the rate limiter",
+    ["tool", "scope"]
+)
+
+# Exhausted-device filter
+exhausted_filter_checks = Counter(
+    "exhausted_filter_checks_total",
+    "Exhausted-device filter lookups",
+    ["tool", "result"]
+)
+
+exhausted_filter_false_positives = Counter(
+    "exhausted_filter_false_positives_total",
+    "Devices the filter marked exhausted that could still generate",
+    ["tool"]
+)
+
+exhausted_filter_entries = Gauge(
+    "exhausted_filter_entries",
+    "Devices held in the exhausted-device filter",
+    ["tool"],
+    multiprocess_mode="livesum"
+)
+
+exhausted_filter_memory_bytes = Gauge(
+    "exhausted_filter_memory_bytes",
+    "Memory used by the exhausted-device filter",
+    ["tool"],
+    multiprocess_mode="livesum"
+)
+
+exhausted_filter_fp_rate = Gauge(
+    "exhausted_filter_estimated_fp_rate",
+    "Estimated false-positive rate of the exhausted-device filter",
+    ["tool"],
+    multiprocess_mode="max"
+)
+
+# History Metrics
+history_rows = Counter(
+    "history_rows_total",
+    "Generation history rows written or dropped",
+    ["tool", "result"]
+)
+
+# Maintenance Metrics
+maintenance_rows = Counter(
+    "maintenance_rows_total",
+    "Rows archived or pruned by maintenance",
+    ["tool", "action"]
+)
+
+maintenance_duration = Histogram(
+    "maintenance_duration_seconds",
+    "Maintenance run duration",
+    ["tool"],
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300)
+)
+
+# Event loop Metrics
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a timer, i.e. time spent in blocking callbacks",
+    ["tool"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+event_loop_blocked = Counter(
+    "event_loop_blocked_total",
+    "Times the event loop was stuck longer than LOOP_BLOCKED_THRESHOLD_SECONDS",
+    ["tool"]
+)
+
+# Drain Metrics
+generations_in_flight = Gauge(
+    "generations_in_flight",
+    "Generation requests being served",
+    ["tool"],
+    multiprocess_mode="livesum"
+)
+
+drain_rejected = Counter(
+    "drain_rejected_total",
+    "Generation requests refused because the worker was draining",
+    ["tool"]
+)
+
+# Startup Metrics
+startup_phase_seconds = Gauge(
+    "startup_phase_seconds",
+    "Time each startup phase took in the latest worker start",
+    ["tool", "phase"],
+    multiprocess_mode="max"
+)
+
+# Memory Metrics (refreshed on each scrape)
+process_rss = Gauge(
+    "worker_resident_memory_bytes",
+    "Resident set size of each worker",
+    ["tool"],
+    multiprocess_mode="all"
+)
+
+metric_series = Gauge(
+    "metric_series",
+    "Series exposed per metric family; steady growth means an unbounded label",
+    ["tool", "metric"],
+    multiprocess_mode="max"
+)
+
 # Crawler Metrics
 crawler_visits = Counter(
     "crawler_visits_total",
@@ -73,6 +269,18 @@ crawler_visits = Counter(
 metrics_router = APIRouter()
 
 
+def get_registry():
+    """Registry to expose; aggregates all workers when running multi-process."""
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
 @metrics_router.get("/metrics")
 async def metrics():
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    from .services.memory import update_memory_gauges
+    
+    update_memory_gauges()
+    return Response(generate_latest(get_registry()), media_type=CONTENT_TYPE_LATEST)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, String, Integer, DateTime, Boolean, ForeignKey, Index, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 import uuid
@@ -28,11 +28,28 @@ class GenerationToken(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
 
 
+class ArchivedGenerationToken(Base):
+    """Exhausted or expired tokens, moved out of generation_tokens by maintenance."""
+    __tablename__ = "generation_tokens_archive"
+    
+    id = Column(String(36), primary_key=True)
+    token = Column(String(255), unique=True, nullable=False)
+    product_sku = Column(String(50), nullable=False)
+    total_generations = Column(Integer, nullable=False)
+    remaining_generations = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    device_id = Column(String(255), index=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=func.now())
+
+
 class PaymentTransaction(Base):
     __tablename__ = "payment_transactions"
     
     id = Column(String(36), primary_key=True, default=generate_uuid)
-    token_id = Column(String(36), ForeignKey("generation_tokens.id"), nullable=False)
+    # Not a foreign key: the token may since have moved to the archive table
+    token_id = Column(String(36), nullable=False, index=True)
     product_sku = Column(String(50), nullable=False)
     provider = Column(String(20), nullable=False, default="creem")
     provider_transaction_id = Column(String(255), unique=True)
@@ -52,3 +69,37 @@ class FreeTrialUsage(Base):
     generations_used = Column(Integer, default=0)
     last_used_at = Column(DateTime, default=func.now())
     created_at = Column(DateTime, default=func.now())
+
+
+class DeviceBalance(Base):
+    """
+    Materialized per-device credit balance, kept in step with
+    generation_tokens and free_trial_usage by token_service.
+    """
+    __tablename__ = "device_balances"
+    
+    device_id = Column(String(255), primary_key=True)
+    paid_remaining = Column(Integer, nullable=False, default=0)
+    free_used = Column(Integer, nullable=False, default=0)
+    # Earliest expiry among tokens with generations left; the balance is
+    # rebuilt from source rows once this passes.
+    next_expiry = Column(DateTime)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class GenerationHistory(Base):
+    """Append-only record of every variation returned to a device."""
+    __tablename__ = "generation_history"
+    __table_args__ = (
+        # Keyset pagination: newest first within a device
+        Index("ix_generation_history_device_created", "device_id", "created_at", "id"),
+    )
+    
+    id = Column(String(36), primary_key=True, default=generate_uuid)
+    device_id = Column(String(255), nullable=False)
+    copy_type = Column(String(20), nullable=False)
+    topic = Column(String(500), nullable=False)
+    language = Column(String(35), nullable=False)
+    variation_id = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
@@ -0,0 +1,229 @@
+import ipaddress
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple, Union
+from .config import get_settings
+from .metrics import rate_limited, TOOL_NAME
+from .shared_store import SQLiteStore, get_shared_store
+
+settings = get_settings()
+
+# Bodies larger than this are not inspected for a device_id.
+MAX_INSPECTED_BODY = 64 * 1024
+
+BucketState = Tuple[float, float]  # (tokens, updated_at)
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def take_token(
+    state: Optional[BucketState],
+    now: float,
+    rate: float,
+    capacity: float,
+) -> Tuple[bool, BucketState, float]:
+    """
+    Refill a token bucket and try to take one token from it.
+    Returns: (allowed, new_state, retry_after_seconds)
+    """
+    if state is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, state[0] + (now - state[1]) * rate)
+    
+    if tokens >= 1:
+        return True, (tokens - 1, now), 0.0
+    return False, (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    """Token buckets in process memory; least recently used keys are evicted."""
+    
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, BucketState]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def take(self, key: str, rate: float, capacity: float) -> Tuple[bool, float]:
+        with self._lock:
+            allowed, state, retry_after = take_token(
+                self._buckets.get(key), time.monotonic(), rate, capacity
+            )
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed, retry_after
+    
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedBucketStore:
+    """Token buckets in the shared store, so all workers enforce one limit."""
+    
+    def __init__(self, store):
+        self.store = store
+    
+    def take(self, key: str, rate: float, capacity: float) -> Tuple[bool, float]:
+        result = {}
+        
+        def refill(state):
+            allowed, new_state, retry_after = take_token(
+                tuple(state) if state else None, time.time(), rate, capacity
+            )
+            result["allowed"], result["retry_after"] = allowed, retry_after
+            return list(new_state)
+        
+        # A full bucket is the same as no bucket, so the key can expire then.
+        self.store.update(f"ratelimit:{key}", refill, ttl=math.ceil(capacity / rate) + 1)
+        return result["allowed"], result["retry_after"]
+
+
+_bucket_store = None
+
+
+def get_bucket_store():
+    """Shared buckets when a cross-worker store is configured, otherwise memory."""
+    global _bucket_store
+    if _bucket_store is None:
+        shared = get_shared_store()
+        if isinstance(shared, SQLiteStore):
+            _bucket_store = SharedBucketStore(shared)
+        else:
+            _bucket_store = MemoryBucketStore(settings.RATE_LIMIT_MAX_KEYS)
+    return _bucket_store
+
+
+@lru_cache(maxsize=8)
+def trusted_proxies(raw: str) -> Tuple[IPNetwork, ...]:
+    """Parse a comma-separated list of proxy addresses or CIDR ranges."""
+    return tuple(ipaddress.ip_network(part.strip(), strict=False) for part in raw.split(",") if part.strip())
+
+
+# Fail at startup, not on the first request, on a malformed setting
+trusted_proxies(settings.RATE_LIMIT_TRUSTED_PROXIES)
+
+
+def client_ip(scope) -> str:
+    """Client address, taking X-Real-IP only from a RATE_LIMIT_TRUSTED_PROXIES peer."""
+    peer = (scope.get("client") or ("unknown", 0))[0]
+    proxies = trusted_proxies(settings.RATE_LIMIT_TRUSTED_PROXIES)
+    if not proxies:
+        return peer
+    try:
+        address = ipaddress.ip_address(peer)
+    except ValueError:
+        return peer
+    # Not is_private: behind Docker's port publishing every direct client
+    # looks like a private address and could pick its own bucket
+    if any(address in network for network in proxies):
+        for name, value in scope.get("headers", []):
+            if name == b"x-real-ip":
+                return value.decode("latin-1").strip()
+    return peer
+
+
+class RateLimitMiddleware:
+    """
+    Token-bucket limits on generation endpoints, per client IP and per
+    device_id (read from the JSON body). Over-limit requests get a 429 with
+    Retry-After before any DB or upstream work happens.
+    """
+    
+    def __init__(self, app, path_prefix: str = "/api/v1/copy/"):
+        self.app = app
+        self.path_prefix = path_prefix
+    
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not settings.RATE_LIMIT_ENABLED
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
+        
+        store = get_bucket_store()
+        allowed, retry_after = store.take(
+            f"ip:{client_ip(scope)}",
+            settings.RATE_LIMIT_IP_PER_MINUTE / 60,
+            settings.RATE_LIMIT_IP_BURST,
+        )
+        if not allowed:
+            await self._reject(send, "ip", retry_after)
+            return
+        
+        body, receive = await self._buffer_body(receive)
+        device_id = self._device_id(body)
+        if device_id:
+            allowed, retry_after = store.take(
+                f"device:{device_id}",
+                settings.RATE_LIMIT_DEVICE_PER_MINUTE / 60,
+                settings.RATE_LIMIT_DEVICE_BURST,
+            )
+            if not allowed:
+                await self._reject(send, "device", retry_after)
+                return
+        
+        await self.app(scope, receive, send)
+    
+    @staticmethod
+    async def _buffer_body(receive):
+        """Read the request body and return a receive() that replays it."""
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body and size <= MAX_INSPECTED_BODY:
+            message = await receive()
+            if message["type"] != "http.request":
+                # Client went away; hand the message straight to the app.
+                return b"", _replay([message], receive)
+            chunks.append(message)
+            size += len(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        
+        body = b"".join(m.get("body", b"") for m in chunks) if not more_body else b""
+        return body, _replay(chunks, receive)
+    
+    @staticmethod
+    def _device_id(body: bytes) -> Optional[str]:
+        if not body:
+            return None
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return None
+        device_id = payload.get("device_id") if isinstance(payload, dict) else None
+        return device_id if isinstance(device_id, str) and device_id else None
+    
+    @staticmethod
+    async def _reject(send, scope_name: str, retry_after: float):
+        rate_limited.labels(tool=TOOL_NAME, scope=scope_name).inc()
+        body = json.dumps({"detail": "Too many requests. Please slow down."}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def _replay(messages, receive):
+    pending = list(messages)
+    
+    async def replay():
+        if pending:
+            return pending.pop(0)
+        return await receive()
+    
+    return replay
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from typing import Annotated, Dict, Optional, List
 from datetime import datetime
 from enum import Enum
 
@@ -20,6 +20,10 @@ class CopyGenerateRequest(BaseModel):
     language: str = "en"
     device_id: str = Field(..., min_length=10, max_length=100)
     variations: int = Field(default=3, ge=1, le=5)
+    # Also return the variations translated into these languages
+    target_languages: List[Annotated[str, Field(min_length=2, max_length=35)]] = Field(
+        default_factory=list, max_length=10
+    )
 
 
 class CopyVariation(BaseModel):
@@ -34,6 +38,77 @@ class CopyGenerateResponse(BaseModel):
     copy_type: CopyType
     remaining_generations: Optional[int] = None
     is_free_trial: bool = False
+    # Keyed by target language; languages whose translation failed are left out
+    translations: Optional[Dict[str, List[CopyVariation]]] = None
+
+
+class CopyRefineRequest(BaseModel):
+    copy_type: CopyType
+    topic: str = Field(..., min_length=1, max_length=500)
+    tone: Optional[str] = "professional"
+    language: str = "en"
+    device_id: str = Field(..., min_length=10, max_length=100)
+    # The variation to revise, as returned by /generate
+    variation: str = Field(..., min_length=1, max_length=2000)
+    instruction: str = Field(..., min_length=1, max_length=300)
+
+
+class CopyRefineResponse(BaseModel):
+    success: bool
+    variation: CopyVariation
+    copy_type: CopyType
+    remaining_generations: Optional[int] = None
+    is_free_trial: bool = False
+
+
+class CopyKitRequest(BaseModel):
+    copy_types: List[CopyType] = Field(..., min_length=2, max_length=len(CopyType))
+    topic: str = Field(..., min_length=1, max_length=500)
+    tone: Optional[str] = "professional"
+    language: str = "en"
+    device_id: str = Field(..., min_length=10, max_length=100)
+    variations: int = Field(default=3, ge=1, le=5)
+    
+    @field_validator("copy_types")
+    @classmethod
+    def unique_copy_types(cls, value: List[CopyType]) -> List[CopyType]:
+        if len(set(value)) != len(value):
+            raise ValueError("copy_types must not repeat")
+        return value
+
+
+class CopyKitSection(BaseModel):
+    copy_type: CopyType
+    variations: List[CopyVariation]
+    # Whether this section was charged to the free trial
+    is_free_trial: bool = False
+
+
+class CopyKitResponse(BaseModel):
+    success: bool
+    sections: List[CopyKitSection]
+    remaining_generations: Optional[int] = None
+    # Whether any section was charged to the free trial
+    is_free_trial: bool = False
+
+
+class HistoryItem(BaseModel):
+    id: str
+    copy_type: str
+    topic: str
+    language: str
+    variation_id: int
+    content: str
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
+class HistoryPage(BaseModel):
+    items: List[HistoryItem]
+    # Pass as ?cursor= for the next (older) page; None on the last page
+    next_cursor: Optional[str] = None
 
 
 class TokenInfo(BaseModel):
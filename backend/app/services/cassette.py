@@ -0,0 +1,165 @@
+"""
+Record and replay upstream LLM traffic.
+
+RecordingTransport wraps a real httpx transport and appends every exchange
+to a cassette; ReplayTransport serves a cassette back, with the recorded
+latency scaled by a factor, so tests and benchmarks get real responses
+without calling upstream.
+
+A cassette is JSON Lines, gzipped when the path ends in ".gz". One line per
+exchange:
+
+    {"method": "POST", "path": "/v1/chat/completions", "key": "<sha256>",
+     "request": {...}, "status": 200, "headers": {...},
+     "chunks": [[0.84, "..."], [0.91, "..."]]}
+
+Each chunk holds its arrival time in seconds since the request was sent, so
+streamed responses keep their time-to-first-byte and pacing. Chunk bytes are
+stored as text when they are UTF-8, otherwise base64 under "b64_chunks".
+"""
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import httpx
+
+# Response headers worth replaying; hop-by-hop and length headers are not
+KEPT_HEADERS = ("content-type", "content-encoding", "x-request-id")
+
+# Request fields that don't change the reply and would defeat matching
+IGNORED_FIELDS = ("stream_options", "user")
+
+
+class CassetteMiss(LookupError):
+    """Replay was asked for a request the cassette doesn't have."""
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def request_key(method: str, path: str, body: bytes) -> str:
+    """Stable key for a request: method, path and its JSON body with sorted keys."""
+    try:
+        payload = json.loads(body) if body else None
+    except ValueError:
+        canonical = body.decode("utf-8", "replace")
+    else:
+        if isinstance(payload, dict):
+            payload = {k: v for k, v in payload.items() if k not in IGNORED_FIELDS}
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{method} {path} {canonical}".encode()).hexdigest()
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Pass requests to `transport` and append each exchange to the cassette at `path`."""
+    
+    def __init__(self, path: str, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.path = path
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self._lock = threading.Lock()
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        started = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        chunks: List[Tuple[float, bytes]] = []
+        try:
+            async for chunk in response.stream:
+                chunks.append((round(time.perf_counter() - started, 4), chunk))
+        finally:
+            await response.aclose()
+        
+        entry: Dict[str, Any] = {
+            "method": request.method,
+            "path": request.url.path,
+            "key": request_key(request.method, request.url.path, body),
+            "request": json.loads(body) if body else None,
+            "status": response.status_code,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() in KEPT_HEADERS},
+        }
+        try:
+            entry["chunks"] = [[at, chunk.decode("utf-8")] for at, chunk in chunks]
+        except UnicodeDecodeError:
+            entry["b64_chunks"] = [[at, base64.b64encode(chunk).decode()] for at, chunk in chunks]
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock, _open(self.path, "a") as f:
+            f.write(line + "\n")
+        
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_ReplayStream(chunks, 0.0),
+            extensions=response.extensions,
+        )
+    
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: List[Tuple[float, bytes]], latency_scale: float):
+        self.chunks = chunks
+        self.latency_scale = latency_scale
+    
+    async def __aiter__(self):
+        started = time.perf_counter()
+        for at, chunk in self.chunks:
+            delay = at * self.latency_scale - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+
+def load_cassette(path: str) -> List[Dict[str, Any]]:
+    with _open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    Serve recorded responses. Requests are matched on method, path and body;
+    repeats of one request get its recordings in order, cycling when they
+    run out. With match_body=False every request takes the next recording
+    for its path, which suits benchmarks whose prompts vary.
+
+    latency_scale 1.0 replays the recorded timing, 0 replies at once.
+    """
+    
+    def __init__(self, path: str, latency_scale: float = 1.0, match_body: bool = True):
+        self.latency_scale = latency_scale
+        self.match_body = match_body
+        self.entries = load_cassette(path)
+        self._queues: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        for entry in self.entries:
+            self._queues[self._key(entry["method"], entry["path"], entry["key"])].append(entry)
+    
+    def _key(self, method: str, path: str, key: str) -> str:
+        return key if self.match_body else f"{method} {path}"
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = request_key(request.method, request.url.path, body)
+        queue = self._queues.get(self._key(request.method, request.url.path, key))
+        if not queue:
+            raise CassetteMiss(f"no recording for {request.method} {request.url.path} ({key[:12]})")
+        entry = queue.popleft()
+        queue.append(entry)
+        
+        if "b64_chunks" in entry:
+            chunks = [(at, base64.b64decode(chunk)) for at, chunk in entry["b64_chunks"]]
+        else:
+            chunks = [(at, chunk.encode("utf-8")) for at, chunk in entry["chunks"]]
+        return httpx.Response(
+            entry["status"],
+            headers=entry["headers"],
+            stream=_ReplayStream(chunks, self.latency_scale),
+            request=request,
+        )
@@ -1,7 +1,17 @@
+import asyncio
+import json
+import time
 import httpx
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from ..config import get_settings
+from ..metrics import (
+    variation_topups, variation_similarity, near_duplicates, kit_fallbacks, localizations, TOOL_NAME
+)
 from ..schemas import CopyType
+from .cassette import RecordingTransport, ReplayTransport
+from .degradation import Priority, degradation
+from .scheduler import scheduler
+from .similarity import NearDuplicateFilter
 
 settings = get_settings()
 
@@ -86,14 +96,242 @@ Output format: JSON array with objects containing "hook" and "intro" fields.""",
 }
 
 
+# The field each copy type's variations can't do without
+CONTENT_FIELDS = {
+    CopyType.MARKETING: "body",
+    CopyType.PRODUCT: "description",
+    CopyType.AD: "primary_text",
+    CopyType.EMAIL: "subject",
+    CopyType.SOCIAL: "post",
+    CopyType.BLOG: "intro",
+}
+
+# Every field each copy type's variations are asked for
+OUTPUT_FIELDS = {
+    CopyType.MARKETING: ("headline", "body"),
+    CopyType.PRODUCT: ("title", "description"),
+    CopyType.AD: ("headline", "primary_text", "cta"),
+    CopyType.EMAIL: ("subject", "preview_text"),
+    CopyType.SOCIAL: ("post", "hashtags"),
+    CopyType.BLOG: ("hook", "intro"),
+}
+
+# Enough for the longest single variation (a blog intro) with room to spare
+REFINE_MAX_TOKENS = 500
+
+REFINE_PROMPT = """Revise this {copy_type} copy about "{topic}".
+Tone: {tone}
+Language: {language}
+Instruction: {instruction}
+
+Copy:
+{variation}
+
+Output format: JSON object with {fields} fields."""
+
+TOPUP_SUFFIX = """
+
+These variations already exist. Write new ones that don't repeat them:
+{existing}"""
+
+KIT_PROMPT = """Write a campaign kit with {count} sections for the topic below.
+
+Respond with one JSON object whose keys are exactly {keys}. Each key maps to
+the JSON array described in that section.
+
+{sections}"""
+
+KIT_SECTION = """### Section "{key}"
+{prompt}"""
+
+LOCALIZE_PROMPT = """Translate this JSON array of copy from {source} into {target}.
+Adapt idioms and calls to action so they read naturally to native speakers,
+keep the same keys, and don't translate brand names.
+
+Output format: JSON object with a "variations" array in the same order.
+
+{variations}"""
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _build_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+    )
+    if transport is None and settings.LLM_REPLAY_PATH:
+        transport = ReplayTransport(settings.LLM_REPLAY_PATH, settings.LLM_REPLAY_LATENCY_SCALE)
+    elif transport is None and settings.LLM_RECORD_PATH:
+        transport = RecordingTransport(settings.LLM_RECORD_PATH, httpx.AsyncHTTPTransport(limits=limits))
+    return httpx.AsyncClient(
+        base_url=settings.LLM_PROXY_URL,
+        timeout=httpx.Timeout(settings.LLM_TIMEOUT_SECONDS, connect=5.0),
+        limits=limits,
+        transport=transport,
+    )
+
+
+def get_llm_client() -> httpx.AsyncClient:
+    """Get the process-wide LLM proxy client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+def start_llm_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    global _client
+    _client = _build_client(transport)
+    return _client
+
+
+async def prewarm_llm_client(connections: int):
+    """Open pooled connections to the LLM proxy ahead of the first generation."""
+    client = get_llm_client()
+    
+    async def touch():
+        try:
+            await client.request("HEAD", "/")
+        except httpx.HTTPError:
+            pass
+    
+    await asyncio.gather(*(touch() for _ in range(connections)))
+
+
+async def close_llm_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _complete(
+    prompt: str,
+    max_tokens: int = 2000,
+    model: Optional[str] = None,
+    priority: Priority = Priority.PAID
+) -> str:
+    """Send one chat completion to the LLM proxy, once the scheduler admits it, and return its content."""
+    async with scheduler.slot(priority):
+        started = time.perf_counter()
+        degradation.started()
+        try:
+            response = await _post_completion(prompt, max_tokens, model or settings.LLM_MODEL)
+        except BaseException:
+            degradation.finished(None)
+            raise
+        degradation.finished(time.perf_counter() - started)
+    
+    if response.status_code != 200:
+        raise Exception(f"LLM API error: {response.status_code}")
+    
+    result = response.json()
+    return result["choices"][0]["message"]["content"]
+
+
+async def _post_completion(prompt: str, max_tokens: int, model: str) -> httpx.Response:
+    # Cancelling this coroutine closes the upstream request and frees its
+    # pooled connection.
+    return await get_llm_client().post(
+        "/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {settings.LLM_PROXY_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "model": model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a world-class copywriter. Generate creative, compelling copy. Always respond with valid JSON."
+                },
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.8,
+            "max_tokens": max_tokens,
+            "response_format": {"type": "json_object"}
+        }
+    )
+
+
+def parse_variations(content: str) -> List[Dict[str, Any]]:
+    """Parse the model's JSON into a list of variations."""
+    try:
+        parsed = json.loads(content)
+        # Handle both array and object with array field
+        if isinstance(parsed, list):
+            return parsed
+        elif isinstance(parsed, dict):
+            # Find the first array in the response
+            for key in parsed:
+                if isinstance(parsed[key], list):
+                    return parsed[key]
+            return [parsed]
+        return [parsed]
+    except json.JSONDecodeError:
+        # Fallback: return content as single variation
+        return [{"content": content}]
+
+
+def is_valid_variation(copy_type: CopyType, variation: Any) -> bool:
+    """Whether a parsed item has the main field the prompt asked for."""
+    if not isinstance(variation, dict):
+        return False
+    value = variation.get(CONTENT_FIELDS[copy_type])
+    return isinstance(value, str) and bool(value.strip())
+
+
+def accept_variations(
+    copy_type: CopyType,
+    candidates: List[Any],
+    accepted: List[Dict[str, Any]],
+    wanted: int,
+    duplicates: NearDuplicateFilter
+) -> List[Dict[str, Any]]:
+    """
+    Add valid candidates to accepted until it holds wanted items, skipping
+    near-duplicates of variations already accepted.
+    """
+    accepted = list(accepted)
+    for candidate in candidates:
+        if len(accepted) >= wanted:
+            break
+        if not is_valid_variation(copy_type, candidate):
+            continue
+        
+        if settings.DEDUP_ENABLED:
+            score = duplicates.add(format_variation_content(copy_type, candidate))
+            if accepted:
+                variation_similarity.labels(tool=TOOL_NAME).observe(score)
+            if score >= duplicates.threshold:
+                near_duplicates.labels(tool=TOOL_NAME, copy_type=copy_type.value).inc()
+                continue
+        accepted.append(candidate)
+    return accepted
+
+
 async def generate_copy(
     copy_type: CopyType,
     topic: str,
     tone: str,
     language: str,
-    variations: int
+    variations: int,
+    priority: Priority = Priority.PAID
 ) -> List[Dict[str, Any]]:
-    """Generate copy using LLM proxy."""
+    """
+    Generate copy using LLM proxy.
+
+    If the model returns fewer valid, distinct variations than asked for
+    (near-duplicates are dropped), smaller follow-up calls ask for just the
+    missing ones (LLM_TOPUP_ATTEMPTS), as long as they fit in the
+    LLM_TIMEOUT_SECONDS deadline. Under load, the degradation policy may
+    pick a smaller model, budget or variation count for the priority.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.LLM_TIMEOUT_SECONDS
+    plan = degradation.plan(priority, variations)
+    variations = plan.variations
     
     prompt = COPY_PROMPTS[copy_type].format(
         variations=variations,
@@ -101,52 +339,180 @@ async def generate_copy(
         tone=tone,
         language=language
     )
+    raw = parse_variations(await _complete(prompt, plan.max_tokens, plan.model, priority))
+    duplicates = NearDuplicateFilter(settings.DEDUP_SIMILARITY_THRESHOLD)
+    valid = accept_variations(copy_type, raw, [], variations, duplicates)
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            f"{settings.LLM_PROXY_URL}/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {settings.LLM_PROXY_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a world-class copywriter. Generate creative, compelling copy. Always respond with valid JSON."
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.8,
-                "max_tokens": 2000,
-                "response_format": {"type": "json_object"}
-            }
-        )
+    for _ in range(settings.LLM_TOPUP_ATTEMPTS):
+        missing = variations - len(valid)
+        remaining_time = deadline - loop.time()
+        if missing <= 0 or remaining_time < settings.LLM_TOPUP_MIN_SECONDS:
+            break
         
-        if response.status_code != 200:
-            raise Exception(f"LLM API error: {response.status_code}")
-        
-        result = response.json()
-        content = result["choices"][0]["message"]["content"]
-        
-        # Parse JSON response
-        import json
+        prompt = COPY_PROMPTS[copy_type].format(
+            variations=missing,
+            topic=topic,
+            tone=tone,
+            language=language
+        ) + TOPUP_SUFFIX.format(existing=json.dumps(valid, ensure_ascii=False))
         try:
-            parsed = json.loads(content)
-            # Handle both array and object with array field
-            if isinstance(parsed, list):
-                return parsed
-            elif isinstance(parsed, dict):
-                # Find the first array in the response
-                for key in parsed:
-                    if isinstance(parsed[key], list):
-                        return parsed[key]
-                return [parsed]
-            return [parsed]
-        except json.JSONDecodeError:
-            # Fallback: return content as single variation
-            return [{"content": content}]
+            async with asyncio.timeout(remaining_time):
+                extra = parse_variations(await _complete(prompt, plan.max_tokens, plan.model, priority))
+        except Exception:
+            variation_topups.labels(tool=TOOL_NAME, copy_type=copy_type.value, result="failed").inc()
+            break
+        
+        valid = accept_variations(copy_type, extra, valid, variations, duplicates)
+        result = "filled" if len(valid) >= variations else "partial"
+        variation_topups.labels(tool=TOOL_NAME, copy_type=copy_type.value, result=result).inc()
+    
+    # Nothing usable: hand back what the model said rather than nothing
+    return valid or raw
+
+
+async def refine_variation(
+    copy_type: CopyType,
+    topic: str,
+    tone: str,
+    language: str,
+    variation: str,
+    instruction: str,
+    priority: Priority = Priority.PAID
+) -> Dict[str, Any]:
+    """
+    Revise one variation following an instruction.
+
+    The prompt carries only that variation and the instruction, and the
+    reply is capped at REFINE_MAX_TOKENS, so this costs a fraction of a
+    full generation.
+    """
+    plan = degradation.plan(priority, 1, max_tokens=REFINE_MAX_TOKENS)
+    prompt = REFINE_PROMPT.format(
+        copy_type=copy_type.value,
+        topic=topic,
+        tone=tone,
+        language=language,
+        instruction=instruction,
+        variation=variation,
+        fields=", ".join(f'"{field}"' for field in OUTPUT_FIELDS[copy_type])
+    )
+    revised = [
+        v for v in parse_variations(await _complete(prompt, plan.max_tokens, plan.model, priority))
+        if is_valid_variation(copy_type, v)
+    ]
+    if not revised:
+        raise Exception("LLM returned no usable revision")
+    return revised[0]
+
+
+async def generate_kit(
+    copy_types: List[CopyType],
+    topic: str,
+    tone: str,
+    language: str,
+    variations: int,
+    priority: Priority = Priority.PAID
+) -> Dict[CopyType, List[Dict[str, Any]]]:
+    """
+    Generate several copy types for one topic in a single LLM call.
+    Returns: variations per copy type
+
+    Sections that come back missing, malformed or short are generated again
+    with parallel single-type calls.
+    """
+    plan = degradation.plan(priority, variations, max_tokens=1500 * len(copy_types))
+    variations = plan.variations
+    sections = "\n\n".join(
+        KIT_SECTION.format(
+            key=copy_type.value,
+            prompt=COPY_PROMPTS[copy_type].format(
+                variations=variations,
+                topic=topic,
+                tone=tone,
+                language=language
+            )
+        )
+        for copy_type in copy_types
+    )
+    prompt = KIT_PROMPT.format(
+        count=len(copy_types),
+        keys=", ".join(f'"{copy_type.value}"' for copy_type in copy_types),
+        sections=sections
+    )
+    
+    try:
+        parsed = json.loads(await _complete(prompt, plan.max_tokens, plan.model, priority))
+    except json.JSONDecodeError:
+        parsed = {}
+    if not isinstance(parsed, dict):
+        parsed = {}
+    
+    kit = {}
+    for copy_type in copy_types:
+        section = parsed.get(copy_type.value)
+        if isinstance(section, list):
+            duplicates = NearDuplicateFilter(settings.DEDUP_SIMILARITY_THRESHOLD)
+            accepted = accept_variations(copy_type, section, [], variations, duplicates)
+            if len(accepted) == variations:
+                kit[copy_type] = accepted
+    
+    failed = [copy_type for copy_type in copy_types if copy_type not in kit]
+    for copy_type in failed:
+        kit_fallbacks.labels(tool=TOOL_NAME, copy_type=copy_type.value).inc()
+    results = await asyncio.gather(*(
+        generate_copy(copy_type, topic, tone, language, variations, priority) for copy_type in failed
+    ))
+    kit.update(zip(failed, results))
+    
+    return {copy_type: kit[copy_type] for copy_type in copy_types}
+
+
+async def localize_variations(
+    copy_type: CopyType,
+    variations: List[Dict[str, Any]],
+    source_language: str,
+    target_language: str,
+    priority: Priority = Priority.PAID
+) -> Optional[List[Dict[str, Any]]]:
+    """Translate generated variations. Returns None if the reply doesn't line up."""
+    plan = degradation.plan(priority, len(variations), max_tokens=1200)
+    prompt = LOCALIZE_PROMPT.format(
+        source=source_language,
+        target=target_language,
+        variations=json.dumps(variations, ensure_ascii=False)
+    )
+    try:
+        translated = parse_variations(await _complete(prompt, plan.max_tokens, plan.model, priority))
+    except Exception:
+        localizations.labels(tool=TOOL_NAME, result="failed").inc()
+        return None
+    
+    if len(translated) != len(variations) or not all(
+        is_valid_variation(copy_type, v) for v in translated
+    ):
+        localizations.labels(tool=TOOL_NAME, result="invalid").inc()
+        return None
+    
+    localizations.labels(tool=TOOL_NAME, result="ok").inc()
+    return translated
+
+
+async def localize_all(
+    copy_type: CopyType,
+    variations: List[Dict[str, Any]],
+    source_language: str,
+    target_languages: List[str],
+    priority: Priority = Priority.PAID
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Translate variations into every target language in parallel, leaving out failures."""
+    targets = list(dict.fromkeys(
+        language for language in target_languages if language != source_language
+    ))
+    results = await asyncio.gather(*(
+        localize_variations(copy_type, variations, source_language, language, priority)
+        for language in targets
+    ))
+    return {language: result for language, result in zip(targets, results) if result is not None}
 
 
 def format_variation_content(copy_type: CopyType, variation: Dict[str, Any]) -> str:
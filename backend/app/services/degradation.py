@@ -0,0 +1,104 @@
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+from ..config import get_settings
+from ..metrics import degradation_level, degraded_generations, TOOL_NAME
+
+settings = get_settings()
+
+# Smoothing factor for the upstream latency average
+LATENCY_ALPHA = 0.2
+
+# Pressure at which each level starts; a level is left once pressure falls
+# HYSTERESIS below its threshold and it has been held DEGRADE_HOLD_SECONDS.
+LEVEL_THRESHOLDS = (0.7, 1.0)
+HYSTERESIS = 0.15
+
+
+class Priority(str, Enum):
+    PAID = "paid"
+    FREE = "free"
+    BATCH = "batch"
+
+
+@dataclass
+class GenerationPlan:
+    model: str
+    max_tokens: int
+    variations: int
+
+
+class DegradationPolicy:
+    """
+    Watches upstream load in this worker and shrinks low-priority work
+    when it backs up.
+
+    Pressure is the highest of in-flight calls / LLM_MAX_CONNECTIONS,
+    queued requests / DEGRADE_QUEUE_DEPTH and average upstream latency /
+    DEGRADE_LATENCY_SECONDS. From level 1, free-trial and batch requests
+    get DEGRADE_MODEL and at most DEGRADE_MAX_TOKENS; at level 2 they are
+    also cut to DEGRADE_MAX_VARIATIONS variations. Paid requests keep
+    their model and only lose variations above 3, at level 2.
+    """
+    
+    def __init__(self):
+        self.in_flight = 0
+        self.queued = 0
+        self.latency = 0.0
+        self.level = 0
+        self._changed_at = time.monotonic()
+    
+    def started(self):
+        self.in_flight += 1
+        self._update()
+    
+    def finished(self, seconds: Optional[float]):
+        """Record the end of an upstream call; seconds is None if it didn't complete."""
+        self.in_flight -= 1
+        if seconds is not None:
+            self.latency += LATENCY_ALPHA * (seconds - self.latency)
+        self._update()
+    
+    def pressure(self) -> float:
+        return max(
+            self.in_flight / max(settings.LLM_MAX_CONNECTIONS, 1),
+            self.queued / max(settings.DEGRADE_QUEUE_DEPTH, 1),
+            self.latency / settings.DEGRADE_LATENCY_SECONDS,
+        )
+    
+    def _update(self):
+        pressure = self.pressure()
+        target = sum(pressure >= threshold for threshold in LEVEL_THRESHOLDS)
+        now = time.monotonic()
+        if target > self.level:
+            self.level, self._changed_at = target, now
+        elif (
+            target < self.level
+            and pressure < LEVEL_THRESHOLDS[self.level - 1] - HYSTERESIS
+            and now - self._changed_at >= settings.DEGRADE_HOLD_SECONDS
+        ):
+            self.level, self._changed_at = self.level - 1, now
+        degradation_level.labels(tool=TOOL_NAME).set(self.level)
+    
+    def plan(self, priority: Priority, variations: int, max_tokens: int = 2000) -> GenerationPlan:
+        """Model, token budget and variation count for a request at the current level."""
+        self._update()
+        requested = GenerationPlan(settings.LLM_MODEL, max_tokens, variations)
+        if not settings.DEGRADE_ENABLED or self.level == 0:
+            return requested
+        
+        plan = GenerationPlan(requested.model, requested.max_tokens, requested.variations)
+        if priority is not Priority.PAID:
+            plan.model = settings.DEGRADE_MODEL or settings.LLM_MODEL
+            plan.max_tokens = min(max_tokens, settings.DEGRADE_MAX_TOKENS)
+        if self.level >= 2:
+            cap = 3 if priority is Priority.PAID else settings.DEGRADE_MAX_VARIATIONS
+            plan.variations = min(variations, cap)
+        
+        if plan != requested:
+            degraded_generations.labels(tool=TOOL_NAME, priority=priority.value).inc()
+        return plan
+
+
+degradation = DegradationPolicy()
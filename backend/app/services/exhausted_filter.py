@@ -0,0 +1,218 @@
+import hashlib
+import math
+import random
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+from ..config import get_settings
+from ..metrics import (
+    exhausted_filter_checks, exhausted_filter_false_positives,
+    exhausted_filter_entries, exhausted_filter_memory_bytes, exhausted_filter_fp_rate,
+    TOOL_NAME
+)
+from ..shared_store import get_shared_store
+
+settings = get_settings()
+
+
+class BloomFilter:
+    """
+    Bit-array Bloom filter. False positives are possible, false negatives
+    are not; there is no removal, only clear().
+    """
+    
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def _indexes(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+    
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+    
+    def add(self, key: str):
+        indexes = self._indexes(key)
+        bits = self.bits
+        if all(bits[i >> 3] & (1 << (i & 7)) for i in indexes):
+            return
+        for i in indexes:
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+    
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+    
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+    
+    @property
+    def estimated_fp_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class ExhaustedDeviceFilter:
+    """
+    Remembers devices that were refused for having no generations left, so
+    repeat requests are refused without touching the database.
+
+    A sample of hits (EXHAUSTED_FILTER_VERIFY_RATE) is passed through to the
+    database so real false positives can be counted. Devices that buy
+    generations (or get one refunded) are cleared here and listed in the
+    shared store; other workers pick the list up on a hit at most every
+    EXHAUSTED_FILTER_SYNC_SECONDS, so a hit costs no store read in between.
+    The filter is emptied every EXHAUSTED_FILTER_RESET_SECONDS or when full.
+
+    Cleared devices go into an exception set, since a Bloom filter can't
+    remove keys. The set is small (purchases and verified false positives
+    since the last reset); past MAX_CLEARED entries the filter is reset.
+
+    Trade-off: a paying device that collides with the filter (about
+    EXHAUSTED_FILTER_FP_RATE of devices once it is full) is refused until
+    a verified request clears it, about 1 / VERIFY_RATE requests on
+    average, or until the next reset. Raise the verify rate to shorten
+    that window at the cost of more database reads for exhausted devices.
+    """
+    
+    PURCHASES_KEY = "exhausted:purchases"
+    # Purchases kept in the shared store; a worker further behind resets
+    RECENT_PURCHASES = 1000
+    MAX_CLEARED = 10_000
+    # A refusal recorded this soon after a purchase may come from a balance
+    # read before it, and isn't added
+    PURCHASE_GRACE_SECONDS = 60
+    
+    def __init__(self, capacity: int, fp_rate: float, verify_rate: float, reset_seconds: int,
+                 sync_seconds: float = 1.0, store=None):
+        self.bloom = BloomFilter(capacity, fp_rate)
+        self.verify_rate = verify_rate
+        self.reset_seconds = reset_seconds
+        self.sync_seconds = sync_seconds
+        self.store = store if store is not None else get_shared_store()
+        self._cleared: Set[str] = set()
+        # device_id -> wall time of purchases seen in the shared store
+        self._purchases: Dict[str, float] = {}
+        # Read on first use, so a preloading master never opens the store
+        self._seen_seq: Optional[int] = None
+        self._synced_at = time.monotonic()
+        self._reset_at = time.monotonic() + reset_seconds
+        self._lock = threading.Lock()
+        self._publish()
+    
+    def _read_purchases(self) -> Tuple[int, list]:
+        value = self.store.get(self.PURCHASES_KEY) or {}
+        return value.get("seq", 0), value.get("devices", [])
+    
+    def _sync(self):
+        """Clear devices that bought generations through other workers."""
+        self._synced_at = time.monotonic()
+        seq, devices = self._read_purchases()
+        if self._seen_seq is None:
+            # Nothing in the filter predates this worker's first read
+            self._seen_seq = seq
+        if seq == self._seen_seq:
+            return
+        # A lower seq means the list expired and started over
+        new = seq - self._seen_seq if seq > self._seen_seq else seq
+        if new > len(devices):
+            # Missed purchases that have dropped off the list
+            self.clear()
+        with self._lock:
+            for device_id, purchased_at in devices[max(0, len(devices) - new):]:
+                self._purchases.pop(device_id, None)
+                self._purchases[device_id] = purchased_at
+                if device_id in self.bloom:
+                    self._cleared.add(device_id)
+            while len(self._purchases) > self.RECENT_PURCHASES:
+                del self._purchases[next(iter(self._purchases))]
+            self._seen_seq = seq
+        if len(self._cleared) > self.MAX_CLEARED:
+            self.clear()
+    
+    def is_exhausted(self, device_id: str) -> bool:
+        """Whether device_id is known to be exhausted (may be a false positive)."""
+        if time.monotonic() >= self._reset_at or self.bloom.count >= self.bloom.capacity:
+            self.clear()
+        
+        if device_id in self._cleared or device_id not in self.bloom:
+            exhausted_filter_checks.labels(tool=TOOL_NAME, result="miss").inc()
+            return False
+        
+        if time.monotonic() - self._synced_at >= self.sync_seconds:
+            self._sync()
+            if device_id in self._cleared:
+                exhausted_filter_checks.labels(tool=TOOL_NAME, result="miss").inc()
+                return False
+        
+        if self.verify_rate and random.random() < self.verify_rate:
+            exhausted_filter_checks.labels(tool=TOOL_NAME, result="verify").inc()
+            return False
+        
+        exhausted_filter_checks.labels(tool=TOOL_NAME, result="hit").inc()
+        return True
+    
+    def add(self, device_id: str):
+        """Record that device_id was refused."""
+        self._sync()
+        if time.time() - self._purchases.get(device_id, 0) < self.PURCHASE_GRACE_SECONDS:
+            return
+        with self._lock:
+            self._cleared.discard(device_id)
+            self.bloom.add(device_id)
+        self._publish()
+    
+    def allowed(self, device_id: str):
+        """Record that the database let device_id generate."""
+        if device_id not in self._cleared and device_id in self.bloom:
+            # Either a verified false positive or a stale entry; both mean
+            # the filter was wrong about this device.
+            exhausted_filter_false_positives.labels(tool=TOOL_NAME).inc()
+            self._clear_device(device_id)
+    
+    def discard(self, device_id: str):
+        """Forget device_id after a purchase or refund, in every worker."""
+        self._clear_device(device_id)
+        
+        def append(value):
+            value = value or {"seq": 0, "devices": []}
+            devices = value["devices"][-(self.RECENT_PURCHASES - 1):] + [[device_id, time.time()]]
+            return {"seq": value["seq"] + 1, "devices": devices}
+        
+        self.store.update(self.PURCHASES_KEY, append, ttl=self.reset_seconds * 2)
+    
+    def _clear_device(self, device_id: str):
+        if device_id in self.bloom:
+            with self._lock:
+                self._cleared.add(device_id)
+            if len(self._cleared) > self.MAX_CLEARED:
+                self.clear()
+    
+    def clear(self):
+        with self._lock:
+            self.bloom.clear()
+            self._cleared.clear()
+            self._reset_at = time.monotonic() + self.reset_seconds
+        self._publish()
+    
+    def _publish(self):
+        exhausted_filter_entries.labels(tool=TOOL_NAME).set(self.bloom.count)
+        exhausted_filter_memory_bytes.labels(tool=TOOL_NAME).set(self.bloom.memory_bytes)
+        exhausted_filter_fp_rate.labels(tool=TOOL_NAME).set(self.bloom.estimated_fp_rate)
+
+
+exhausted_devices = ExhaustedDeviceFilter(
+    capacity=settings.EXHAUSTED_FILTER_CAPACITY,
+    fp_rate=settings.EXHAUSTED_FILTER_FP_RATE,
+    verify_rate=settings.EXHAUSTED_FILTER_VERIFY_RATE,
+    reset_seconds=settings.EXHAUSTED_FILTER_RESET_SECONDS,
+    sync_seconds=settings.EXHAUSTED_FILTER_SYNC_SECONDS,
+)
@@ -0,0 +1,181 @@
+import asyncio
+import base64
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from ..config import get_settings
+from ..database import get_db_session
+from ..metrics import history_rows, TOOL_NAME
+from ..models import GenerationHistory
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+Cursor = Tuple[datetime, str]
+
+
+class HistoryBuffer:
+    """
+    Holds history rows in memory until a background task writes them in
+    one batch, so requests never wait on the insert.
+    """
+    
+    def __init__(self, max_rows: int):
+        self._rows: Deque[Dict] = deque()
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        # Set by the writer task; wakes it early once a batch is full
+        self.flush_requested: Optional[asyncio.Event] = None
+    
+    def __len__(self) -> int:
+        return len(self._rows)
+    
+    def add(self, rows: List[Dict]):
+        with self._lock:
+            self._rows.extend(rows)
+            dropped = max(0, len(self._rows) - self.max_rows)
+            for _ in range(dropped):
+                self._rows.popleft()
+        if dropped:
+            history_rows.labels(tool=TOOL_NAME, result="dropped").inc(dropped)
+        if self.flush_requested is not None and len(self._rows) >= settings.HISTORY_BATCH_SIZE:
+            self.flush_requested.set()
+    
+    def take(self) -> List[Dict]:
+        with self._lock:
+            rows = list(self._rows)
+            self._rows.clear()
+        return rows
+
+
+history_buffer = HistoryBuffer(settings.HISTORY_BUFFER_MAX)
+
+
+def record_generation(device_id: str, copy_type: str, topic: str, language: str, variations: List[str]):
+    """Queue the variations returned to a device for the history table."""
+    if not settings.HISTORY_ENABLED:
+        return
+    now = datetime.utcnow()
+    history_buffer.add([
+        {
+            "device_id": device_id,
+            "copy_type": copy_type,
+            "topic": topic,
+            "language": language,
+            "variation_id": i + 1,
+            "content": content,
+            "created_at": now,
+        }
+        for i, content in enumerate(variations)
+    ])
+
+
+def flush_history(db: Session) -> int:
+    """Write buffered rows. Returns rows written."""
+    rows = history_buffer.take()
+    if not rows:
+        return 0
+    try:
+        # ORM objects rather than a bulk insert() so sharded sessions route
+        # each row by device_id; SQLAlchemy still batches the INSERTs.
+        db.add_all([GenerationHistory(**row) for row in rows])
+        db.commit()
+    except Exception:
+        db.rollback()
+        history_rows.labels(tool=TOOL_NAME, result="dropped").inc(len(rows))
+        raise
+    history_rows.labels(tool=TOOL_NAME, result="written").inc(len(rows))
+    return len(rows)
+
+
+def _flush_once() -> int:
+    with get_db_session() as db:
+        return flush_history(db)
+
+
+async def history_writer_loop():
+    """Flush the buffer every HISTORY_FLUSH_SECONDS, or sooner once a batch is full."""
+    history_buffer.flush_requested = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(history_buffer.flush_requested.wait(), settings.HISTORY_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        history_buffer.flush_requested.clear()
+        try:
+            await asyncio.to_thread(_flush_once)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("history flush failed")
+
+
+async def stop_history_writer(task: Optional[asyncio.Task]):
+    """Cancel the writer and flush what is left."""
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if len(history_buffer):
+        try:
+            await asyncio.to_thread(_flush_once)
+        except Exception:
+            logger.exception("final history flush failed")
+
+
+def encode_cursor(row: GenerationHistory) -> str:
+    raw = f"{row.created_at.isoformat()}|{row.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """Raises ValueError for a malformed cursor."""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, row_id = raw.split("|", 1)
+    return datetime.fromisoformat(created_at), row_id
+
+
+def get_history_page(
+    db: Session,
+    device_id: str,
+    limit: int,
+    cursor: Optional[Cursor] = None
+) -> Tuple[List[GenerationHistory], Optional[str]]:
+    """
+    One page of a device's history, newest first.
+    Returns: (rows, next_cursor)
+
+    Keyset pagination on (created_at, id): each page is an index range scan
+    that starts where the previous one ended, however deep the page.
+    """
+    query = db.query(GenerationHistory).filter(GenerationHistory.device_id == device_id)
+    if cursor is not None:
+        created_at, row_id = cursor
+        query = query.filter(or_(
+            GenerationHistory.created_at < created_at,
+            and_(GenerationHistory.created_at == created_at, GenerationHistory.id < row_id)
+        ))
+    rows = query.order_by(
+        GenerationHistory.created_at.desc(), GenerationHistory.id.desc()
+    ).limit(limit + 1).all()
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def iter_history(db: Session, device_id: str, batch_size: int = 500) -> Iterator[GenerationHistory]:
+    """Every history row of a device, newest first, loaded one page at a time."""
+    cursor = None
+    while True:
+        rows, next_cursor = get_history_page(db, device_id, batch_size, cursor)
+        yield from rows
+        # Drop loaded rows so memory stays at one page
+        db.expunge_all()
+        if next_cursor is None:
+            return
+        cursor = decode_cursor(next_cursor)
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import func, or_, text
+from sqlalchemy.orm import Session
+from ..config import get_settings
+from ..database import get_db_session
+from ..metrics import maintenance_rows, maintenance_duration, TOOL_NAME
+from ..models import ArchivedGenerationToken, DeviceBalance, FreeTrialUsage, GenerationToken
+from ..shared_store import get_shared_store
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+ARCHIVED_COLUMNS = [
+    "id", "token", "product_sku", "total_generations", "remaining_generations",
+    "expires_at", "device_id", "created_at", "updated_at",
+]
+
+
+def archive_tokens(
+    db: Session,
+    now: datetime,
+    batch_size: int,
+    max_batches: int,
+) -> int:
+    """
+    Move expired tokens, and tokens exhausted for longer than
+    ARCHIVE_EXHAUSTED_AFTER_HOURS, to the archive table. Returns rows moved.
+
+    The grace period leaves a token that just gave its last credit in place
+    for refund_generation, should that generation still fail.
+    """
+    exhausted_cutoff = now - timedelta(hours=settings.ARCHIVE_EXHAUSTED_AFTER_HOURS)
+    moved = 0
+    for _ in range(max_batches):
+        tokens = db.query(GenerationToken).filter(
+            or_(
+                (GenerationToken.remaining_generations <= 0) & (GenerationToken.updated_at < exhausted_cutoff),
+                GenerationToken.expires_at <= now
+            )
+        ).limit(batch_size).all()
+        
+        if not tokens:
+            break
+        
+        db.add_all([
+            ArchivedGenerationToken(archived_at=now, **{c: getattr(t, c) for c in ARCHIVED_COLUMNS})
+            for t in tokens
+        ])
+        db.query(GenerationToken).filter(
+            GenerationToken.id.in_([t.id for t in tokens])
+        ).delete(synchronize_session=False)
+        db.commit()
+        
+        moved += len(tokens)
+        if len(tokens) < batch_size:
+            break
+    
+    return moved
+
+
+def prune_free_trials(
+    db: Session,
+    now: datetime,
+    batch_size: int,
+    max_batches: int,
+) -> int:
+    """
+    Delete free-trial rows that were never used, FREE_TRIAL_IDLE_DAYS after
+    creation (they come from status checks alone). Returns rows deleted.
+
+    Used rows are kept however old: they are the record that the device
+    had its trial, and deleting them would hand out a fresh one.
+    """
+    idle_cutoff = now - timedelta(days=settings.FREE_TRIAL_IDLE_DAYS)
+    
+    pruned = 0
+    for _ in range(max_batches):
+        rows = db.query(FreeTrialUsage.id, FreeTrialUsage.device_id).filter(
+            FreeTrialUsage.generations_used == 0,
+            FreeTrialUsage.created_at < idle_cutoff
+        ).limit(batch_size).all()
+        ids = [row.id for row in rows]
+        
+        if not ids:
+            break
+        
+        db.query(FreeTrialUsage).filter(
+            FreeTrialUsage.id.in_(ids)
+        ).delete(synchronize_session=False)
+        # Dropped balances are rebuilt from the remaining rows on next use
+        db.query(DeviceBalance).filter(
+            DeviceBalance.device_id.in_([row.device_id for row in rows])
+        ).delete(synchronize_session=False)
+        db.commit()
+        
+        pruned += len(ids)
+        if len(ids) < batch_size:
+            break
+    
+    return pruned
+
+
+def reconcile_balances(db: Session, now: datetime, batch_size: int) -> Dict[str, int]:
+    """
+    Rebuild device_balances from source rows and count rows that drifted.
+    Returns: {"checked", "drifted"}
+
+    Rows whose next_expiry has passed are refreshed but not counted as
+    drift, since a token expiring is expected to change the balance.
+    """
+    checked = drifted = 0
+    last_device_id = ""
+    while True:
+        # With sharding each shard returns its own first batch; the overall
+        # first batch_size rows are all among them.
+        balances = sorted(
+            db.query(DeviceBalance).filter(
+                DeviceBalance.device_id > last_device_id
+            ).order_by(DeviceBalance.device_id).limit(batch_size),
+            key=lambda b: b.device_id
+        )[:batch_size]
+        
+        if not balances:
+            break
+        
+        device_ids = [b.device_id for b in balances]
+        paid = {
+            row.device_id: (row.paid_remaining, row.next_expiry)
+            for row in db.query(
+                GenerationToken.device_id,
+                func.sum(GenerationToken.remaining_generations).label("paid_remaining"),
+                func.min(GenerationToken.expires_at).label("next_expiry")
+            ).filter(
+                GenerationToken.device_id.in_(device_ids),
+                GenerationToken.remaining_generations > 0,
+                GenerationToken.expires_at > now
+            ).group_by(GenerationToken.device_id)
+        }
+        free = dict(db.query(FreeTrialUsage.device_id, FreeTrialUsage.generations_used).filter(
+            FreeTrialUsage.device_id.in_(device_ids)
+        ))
+        
+        for balance in balances:
+            paid_remaining, next_expiry = paid.get(balance.device_id, (0, None))
+            free_used = free.get(balance.device_id) or 0
+            stored = (balance.paid_remaining, balance.free_used)
+            
+            if stored != (paid_remaining, free_used) and (
+                balance.next_expiry is None or balance.next_expiry > now
+            ):
+                drifted += 1
+                logger.warning(
+                    "balance drift for %s: stored paid=%s free_used=%s, actual paid=%s free_used=%s",
+                    balance.device_id, *stored, paid_remaining, free_used
+                )
+            
+            # Only overwrite if no request changed the row since we read it
+            db.query(DeviceBalance).filter(
+                DeviceBalance.device_id == balance.device_id,
+                DeviceBalance.paid_remaining == stored[0],
+                DeviceBalance.free_used == stored[1]
+            ).update(
+                {
+                    DeviceBalance.paid_remaining: paid_remaining,
+                    DeviceBalance.free_used: free_used,
+                    DeviceBalance.next_expiry: next_expiry
+                },
+                synchronize_session=False
+            )
+        
+        db.commit()
+        checked += len(balances)
+        last_device_id = device_ids[-1]
+    
+    return {"checked": checked, "drifted": drifted}
+
+
+def optimize_storage(db: Session):
+    """Refresh planner statistics and return freed pages to the filesystem."""
+    db.commit()
+    router = db.info.get("shard_router")
+    binds = router.engines.values() if router is not None else [db.get_bind()]
+    for bind in binds:
+        with bind.connect() as conn:
+            if bind.dialect.name == "sqlite":
+                conn.execute(text("ANALYZE"))
+                conn.execute(text("PRAGMA incremental_vacuum"))
+            elif bind.dialect.name == "postgresql":
+                for table in (GenerationToken, FreeTrialUsage, DeviceBalance, ArchivedGenerationToken):
+                    conn.execute(text(f"ANALYZE {table.__tablename__}"))
+            conn.commit()
+
+
+def run_maintenance(db: Session, now: Optional[datetime] = None) -> Dict[str, float]:
+    """
+    Run one maintenance pass.
+    Returns: {"archived_tokens", "pruned_free_trials", "balances_checked",
+              "balance_drift", "duration_seconds"}
+    """
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    
+    archived = archive_tokens(db, now, settings.MAINTENANCE_BATCH_SIZE, settings.MAINTENANCE_MAX_BATCHES)
+    pruned = prune_free_trials(db, now, settings.MAINTENANCE_BATCH_SIZE, settings.MAINTENANCE_MAX_BATCHES)
+    balances = reconcile_balances(db, now, settings.MAINTENANCE_BATCH_SIZE)
+    optimize_storage(db)
+    
+    duration = time.perf_counter() - started
+    maintenance_rows.labels(tool=TOOL_NAME, action="archived_tokens").inc(archived)
+    maintenance_rows.labels(tool=TOOL_NAME, action="pruned_free_trials").inc(pruned)
+    maintenance_rows.labels(tool=TOOL_NAME, action="balance_drift").inc(balances["drifted"])
+    maintenance_duration.labels(tool=TOOL_NAME).observe(duration)
+    
+    return {
+        "archived_tokens": archived,
+        "pruned_free_trials": pruned,
+        "balances_checked": balances["checked"],
+        "balance_drift": balances["drifted"],
+        "duration_seconds": round(duration, 3),
+    }
+
+
+def _run_once() -> Dict[str, float]:
+    with get_db_session() as db:
+        return run_maintenance(db)
+
+
+async def maintenance_loop():
+    """Run maintenance every MAINTENANCE_INTERVAL_SECONDS on one worker at a time."""
+    interval = settings.MAINTENANCE_INTERVAL_SECONDS
+    while True:
+        await asyncio.sleep(interval)
+        # The lease keeps other workers on this node from running the same pass.
+        if not get_shared_store().add("maintenance:lease", os.getpid(), ttl=interval * 0.9):
+            continue
+        try:
+            report = await asyncio.to_thread(_run_once)
+            logger.info("maintenance: %s", report)
+        except Exception:
+            logger.exception("maintenance run failed")
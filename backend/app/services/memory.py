@@ -0,0 +1,106 @@
+import os
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+from prometheus_client import REGISTRY
+from ..config import get_settings
+from ..metrics import metric_series, process_rss, TOOL_NAME
+
+settings = get_settings()
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process; peak RSS where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def series_counts() -> Dict[str, int]:
+    """Samples exposed per metric family in this process, a proxy for label set growth."""
+    counts = Counter()
+    for family in REGISTRY.collect():
+        counts[family.name] += len(family.samples)
+    return dict(counts)
+
+
+def update_memory_gauges():
+    process_rss.labels(tool=TOOL_NAME).set(rss_bytes())
+    for name, count in series_counts().items():
+        metric_series.labels(tool=TOOL_NAME, metric=name).set(count)
+
+
+class SnapshotStore:
+    """
+    tracemalloc snapshots for the admin memory endpoints. The first snapshot
+    starts tracing (which costs memory and CPU on every allocation) and
+    becomes the baseline later ones are diffed against; stop() ends tracing.
+    """
+    
+    def __init__(self):
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _take() -> tracemalloc.Snapshot:
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+    
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        """Start tracing if needed and keep a baseline snapshot."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(settings.TRACEMALLOC_FRAMES)
+                self.baseline = None
+            if self.baseline is None or reset:
+                self.baseline = self._take()
+            current, peak = tracemalloc.get_traced_memory()
+        return {"tracing": True, "traced_bytes": current, "peak_bytes": peak}
+    
+    def top(self, group_by: str = "lineno", limit: int = 20, diff: bool = True) -> List[Dict[str, Any]]:
+        """
+        Largest allocation sites now, or the largest growth since the baseline.
+
+        Returns:
+            Dicts with the site, its size and count, and with diff their
+            change since the baseline, largest first
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing() or self.baseline is None:
+                raise RuntimeError("no snapshot taken yet")
+            snapshot = self._take()
+            if diff:
+                stats = snapshot.compare_to(self.baseline, group_by)
+            else:
+                stats = snapshot.statistics(group_by)
+        
+        result = []
+        for stat in stats[:limit]:
+            frame = stat.traceback[0]
+            site = frame.filename if group_by == "filename" else f"{frame.filename}:{frame.lineno}"
+            item = {"site": site, "size_bytes": stat.size, "count": stat.count}
+            if diff:
+                item["size_diff_bytes"] = stat.size_diff
+                item["count_diff"] = stat.count_diff
+            result.append(item)
+        return result
+    
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self.baseline = None
+
+
+snapshots = SnapshotStore()
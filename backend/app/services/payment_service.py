@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import json
+from typing import Dict, Optional, Tuple
+import httpx
+from ..config import get_settings
+from ..shared_store import get_shared_store
+
+settings = get_settings()
+
+# Only retry when Creem can't have created the checkout: it refused the
+# request (429/503) or we never got a connection. A retry after a read
+# timeout or a 502/504 could create a second checkout.
+RETRY_STATUSES = {429, 503}
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+CheckoutKey = Tuple[str, str, str, str]
+
+
+class CreemError(Exception):
+    """Raised when Creem rejects or fails a request."""
+
+
+class CheckoutInProgress(CreemError):
+    """Raised when another worker is still creating the same checkout."""
+
+
+def parse_product_ids(raw: str) -> Dict[str, str]:
+    """Parse the CREEM_PRODUCT_IDS JSON map, dropping unconfigured SKUs."""
+    try:
+        product_ids = json.loads(raw)
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(product_ids, dict):
+        return {}
+    return {sku: pid for sku, pid in product_ids.items() if pid}
+
+
+class CreemClient:
+    """Pooled Creem API client with short-lived checkout session caching."""
+    
+    def __init__(
+        self,
+        api_base: str,
+        api_key: str,
+        product_ids: Dict[str, str],
+        timeout: float = 30.0,
+        max_retries: int = 2,
+        max_connections: int = 20,
+        cache_seconds: int = 30,
+        store=None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.api_key = api_key
+        self.product_ids = product_ids
+        self.max_retries = max_retries
+        self.cache_seconds = cache_seconds
+        self.timeout = timeout
+        self.store = store if store is not None else get_shared_store()
+        self._inflight: Dict[CheckoutKey, asyncio.Future] = {}
+        self._http = httpx.AsyncClient(
+            base_url=api_base,
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 5.0)),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            # Retries happen in _post_checkout only
+            transport=transport or httpx.AsyncHTTPTransport(),
+        )
+    
+    @classmethod
+    def from_settings(cls, **kwargs) -> "CreemClient":
+        return cls(
+            api_base=settings.CREEM_API_BASE,
+            api_key=settings.CREEM_API_KEY,
+            product_ids=parse_product_ids(settings.CREEM_PRODUCT_IDS),
+            timeout=settings.CREEM_TIMEOUT_SECONDS,
+            max_retries=settings.CREEM_MAX_RETRIES,
+            max_connections=settings.CREEM_MAX_CONNECTIONS,
+            cache_seconds=settings.CREEM_CHECKOUT_CACHE_SECONDS,
+            **kwargs,
+        )
+    
+    async def create_checkout(
+        self,
+        device_id: str,
+        product_sku: str,
+        success_url: str,
+        cancel_url: str,
+    ) -> Dict[str, str]:
+        """
+        Create (or reuse) a checkout session.
+        Returns: {"checkout_url": ..., "checkout_id": ...}
+
+        Identical requests within the cache window, including concurrent
+        double-clicks, share one upstream checkout. With a shared store this
+        holds across worker processes too.
+        """
+        key = (device_id, product_sku, success_url, cancel_url)
+        
+        cached = self.store.get(self._cache_key(key))
+        if cached:
+            return cached
+        
+        task = self._inflight.get(key)
+        if task is None:
+            # The upstream call runs as its own task so a caller that goes
+            # away doesn't cancel it for everyone else waiting on it.
+            task = asyncio.ensure_future(self._claim_or_create(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._settle(key, t))
+        return await asyncio.shield(task)
+    
+    @staticmethod
+    def _cache_key(key: CheckoutKey) -> str:
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return f"creem:checkout:{digest}"
+    
+    async def _claim_or_create(self, key: CheckoutKey) -> Dict[str, str]:
+        if self.cache_seconds <= 0:
+            return await self._post_checkout(*key)
+        
+        cache_key = self._cache_key(key)
+        lock_key = f"{cache_key}:lock"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while not self.store.add(lock_key, 1, ttl=self.timeout):
+            # Another worker is creating this checkout. Wait for its result,
+            # or for it to release the lock after failing and claim it then.
+            # Never post without the lock: that could create a second checkout.
+            if loop.time() >= deadline:
+                raise CheckoutInProgress("Checkout is already being created")
+            await asyncio.sleep(0.05)
+            cached = self.store.get(cache_key)
+            if cached:
+                return cached
+        try:
+            # The previous holder may have cached its result just before
+            # releasing the lock
+            cached = self.store.get(cache_key)
+            if cached:
+                return cached
+            result = await self._post_checkout(*key)
+            self.store.set(cache_key, result, ttl=self.cache_seconds)
+            return result
+        finally:
+            self.store.delete(lock_key)
+    
+    async def _post_checkout(
+        self,
+        device_id: str,
+        product_sku: str,
+        success_url: str,
+        cancel_url: str,
+    ) -> Dict[str, str]:
+        body = {
+            "product_id": self.product_ids[product_sku],
+            "success_url": success_url,
+            "cancel_url": cancel_url,
+            "metadata": {
+                "device_id": device_id,
+                "product_sku": product_sku
+            }
+        }
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._http.post(
+                    "/v1/checkouts",
+                    headers={
+                        "Authorization": f"Bearer {self.api_key}",
+                        "Content-Type": "application/json"
+                    },
+                    json=body
+                )
+            except RETRY_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise CreemError(f"Checkout request failed: {e!r}")
+            except httpx.TransportError as e:
+                raise CreemError(f"Checkout request failed: {e!r}")
+            else:
+                if response.status_code == 200:
+                    data = response.json()
+                    return {"checkout_url": data["checkout_url"], "checkout_id": data["id"]}
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise CreemError(response.text)
+            await asyncio.sleep(0.2 * 2 ** attempt)
+        
+        raise CreemError("Checkout creation failed")
+    
+    def _settle(self, key: CheckoutKey, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Mark retrieved so a failure nobody awaited isn't logged.
+            task.exception()
+    
+    async def aclose(self):
+        await self._http.aclose()
+
+
+_client: Optional[CreemClient] = None
+
+
+def get_creem_client() -> CreemClient:
+    """Get the process-wide Creem client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = CreemClient.from_settings()
+    return _client
+
+
+def start_creem_client() -> CreemClient:
+    """Build the Creem client at startup so product IDs are parsed once."""
+    global _client
+    _client = CreemClient.from_settings()
+    return _client
+
+
+async def close_creem_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Optional
+from ..config import get_settings
+from ..metrics import event_loop_lag, event_loop_blocked, TOOL_NAME
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# One profile at a time: two samplers would each slow the other's target
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(RuntimeError):
+    """A profile is already running in this process."""
+
+
+def _collapse(frame) -> str:
+    """A frame's stack, outermost first, as `file:function:line` joined by ';'."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def sample_stacks(seconds: float, interval: float, thread_ids: Optional[set] = None) -> str:
+    """
+    Sample the stacks of `thread_ids` (all other threads when None) every
+    `interval` seconds for `seconds`.
+
+    Returns:
+        Collapsed stacks, one "frame;frame;frame count" line per distinct
+        stack, as read by flamegraph.pl and speedscope
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("a profile is already running")
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or (thread_ids is not None and thread_id not in thread_ids):
+                    continue
+                stacks[_collapse(frame)] += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag: a task asks to wake every LOOP_MONITOR_INTERVAL_SECONDS
+    and records how late it actually woke. A watchdog thread watches the
+    task's heartbeat; when the loop has been stuck longer than
+    LOOP_BLOCKED_THRESHOLD_SECONDS it logs the loop thread's stack, which
+    names the blocking call while it is still running.
+    """
+    
+    def __init__(self):
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+    
+    async def _measure(self):
+        interval = settings.LOOP_MONITOR_INTERVAL_SECONDS
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            event_loop_lag.labels(tool=TOOL_NAME).observe(max(0.0, now - expected))
+    
+    def _watch(self):
+        threshold = settings.LOOP_BLOCKED_THRESHOLD_SECONDS
+        reported = None
+        while not self._stop.wait(threshold / 2):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - settings.LOOP_MONITOR_INTERVAL_SECONDS
+            if stalled < threshold or reported == heartbeat:
+                continue
+            # One report per stall
+            reported = heartbeat
+            event_loop_blocked.labels(tool=TOOL_NAME).inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+            logger.warning("event loop blocked for %.2fs in:\n%s", stalled, stack)
+    
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._watchdog:
+            self._stop.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+from ..config import get_settings
+from ..metrics import generation_queue_seconds, generation_queue_depth, TOOL_NAME
+from .degradation import Priority, degradation
+
+settings = get_settings()
+
+
+class GenerationScheduler:
+    """
+    Admits upstream LLM calls in priority order.
+
+    At most `capacity` calls run at once, and each class has its own cap so
+    free and batch work can't take every slot. When requests are waiting,
+    free slots go to classes in proportion to their weights (stride
+    scheduling): with weights 8/2/1, a backlog of paid requests gets eight
+    slots for every two free-trial and one batch slot.
+    """
+    
+    def __init__(self, capacity: int, weights: Dict[Priority, int], caps: Dict[Priority, int]):
+        self.capacity = capacity
+        self.caps = caps
+        self.strides = {priority: 1 / max(weight, 1) for priority, weight in weights.items()}
+        self.passes = {priority: 0.0 for priority in Priority}
+        self.queues: Dict[Priority, Deque[asyncio.Future]] = {priority: deque() for priority in Priority}
+        self.running = {priority: 0 for priority in Priority}
+        self._virtual_time = 0.0
+    
+    @classmethod
+    def from_settings(cls) -> "GenerationScheduler":
+        return cls(
+            capacity=settings.LLM_MAX_CONNECTIONS,
+            weights={
+                Priority.PAID: settings.SCHEDULER_PAID_WEIGHT,
+                Priority.FREE: settings.SCHEDULER_FREE_WEIGHT,
+                Priority.BATCH: settings.SCHEDULER_BATCH_WEIGHT,
+            },
+            caps={
+                Priority.PAID: settings.LLM_MAX_CONNECTIONS,
+                Priority.FREE: settings.SCHEDULER_FREE_MAX_CONCURRENCY,
+                Priority.BATCH: settings.SCHEDULER_BATCH_MAX_CONCURRENCY,
+            },
+        )
+    
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+    
+    def _has_room(self, priority: Priority) -> bool:
+        return sum(self.running.values()) < self.capacity and self.running[priority] < self.caps[priority]
+    
+    def _grant(self, priority: Priority):
+        # A class coming back from idle starts at the current virtual time
+        # instead of using up the credit it didn't spend while idle.
+        start = max(self.passes[priority], self._virtual_time)
+        self._virtual_time = start
+        self.passes[priority] = start + self.strides[priority]
+        self.running[priority] += 1
+    
+    def _dispatch(self):
+        while True:
+            waiting = [
+                priority for priority in Priority
+                if self.queues[priority] and self._has_room(priority)
+            ]
+            if not waiting:
+                break
+            priority = min(waiting, key=lambda p: max(self.passes[p], self._virtual_time))
+            waiter = self.queues[priority].popleft()
+            if waiter.done():
+                continue
+            self._grant(priority)
+            waiter.set_result(None)
+        self._publish()
+    
+    def _publish(self):
+        for priority, queue in self.queues.items():
+            generation_queue_depth.labels(tool=TOOL_NAME, priority=priority.value).set(len(queue))
+        degradation.queued = self.queued
+    
+    async def acquire(self, priority: Priority):
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues[priority].append(waiter)
+        # Grants right away when there's room and nothing is ahead of us
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we were cancelled; hand the slot on.
+                self.release(priority)
+            else:
+                try:
+                    self.queues[priority].remove(waiter)
+                except ValueError:
+                    pass
+                self._publish()
+            raise
+        generation_queue_seconds.labels(tool=TOOL_NAME, priority=priority.value).observe(
+            time.perf_counter() - started
+        )
+    
+    def release(self, priority: Priority):
+        self.running[priority] -= 1
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, priority: Priority):
+        """Hold one upstream slot for the duration of the block."""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+
+scheduler = GenerationScheduler.from_settings()
@@ -1,11 +1,17 @@
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
+from sqlalchemy import case, func, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from ..models import GenerationToken, FreeTrialUsage
+from ..models import GenerationToken, FreeTrialUsage, DeviceBalance
 from ..config import get_settings
+from .exhausted_filter import exhausted_devices
 
 settings = get_settings()
 
+# A concurrent request can drain the token we picked; retry with the next one.
+CONSUME_ATTEMPTS = 5
+
 
 def get_free_trial_usage(db: Session, device_id: str) -> FreeTrialUsage:
     """Get or create free trial usage record."""
@@ -16,37 +22,140 @@ def get_free_trial_usage(db: Session, device_id: str) -> FreeTrialUsage:
     if not usage:
         usage = FreeTrialUsage(device_id=device_id, generations_used=0)
         db.add(usage)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another request created it first
+            db.rollback()
+            return db.query(FreeTrialUsage).filter(
+                FreeTrialUsage.device_id == device_id
+            ).one()
         db.refresh(usage)
     
     return usage
 
 
-def check_can_generate(db: Session, device_id: str) -> Tuple[bool, Optional[int], bool]:
+def compute_balance(db: Session, device_id: str, now: datetime) -> Tuple[int, Optional[datetime], int]:
     """
-    Check if device can generate.
-    Returns: (can_generate, remaining_count, is_free_trial)
+    Derive a device's balance from the source rows.
+    Returns: (paid_remaining, next_expiry, free_used)
     """
-    # First check for paid tokens
-    now = datetime.utcnow()
-    tokens = db.query(GenerationToken).filter(
+    paid_remaining, next_expiry = db.query(
+        func.coalesce(func.sum(GenerationToken.remaining_generations), 0),
+        func.min(GenerationToken.expires_at)
+    ).filter(
         GenerationToken.device_id == device_id,
         GenerationToken.remaining_generations > 0,
         GenerationToken.expires_at > now
-    ).all()
+    ).one()
+    
+    free_used = db.query(FreeTrialUsage.generations_used).filter(
+        FreeTrialUsage.device_id == device_id
+    ).scalar()
+    
+    return paid_remaining, next_expiry, free_used or 0
+
+
+def get_device_balance(db: Session, device_id: str, persist: bool = False) -> DeviceBalance:
+    """
+    Get a device's balance with a primary-key lookup.
+
+    The row is (re)built from source rows when it is missing or one of the
+    device's tokens has expired since it was written. Devices with nothing
+    to record get an unsaved zero balance unless persist is set.
+    """
+    now = datetime.utcnow()
+    balance = db.get(DeviceBalance, device_id)
     
-    total_remaining = sum(t.remaining_generations for t in tokens)
+    if balance is not None and (balance.next_expiry is None or balance.next_expiry > now):
+        return balance
     
-    if total_remaining > 0:
-        return True, total_remaining, False
+    if balance is not None:
+        return rebuild_balance(db, balance, now)
+    
+    paid_remaining, next_expiry, free_used = compute_balance(db, device_id, now)
+    
+    balance = DeviceBalance(
+        device_id=device_id,
+        paid_remaining=paid_remaining,
+        next_expiry=next_expiry,
+        free_used=free_used
+    )
+    if not (persist or paid_remaining or free_used):
+        return balance
+    
+    db.add(balance)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another request created it first
+        db.rollback()
+        return db.get(DeviceBalance, device_id)
+    return balance
+
+
+def rebuild_balance(db: Session, balance: DeviceBalance, now: datetime) -> DeviceBalance:
+    """Overwrite a balance row with values derived from the source rows."""
+    balance.paid_remaining, balance.next_expiry, balance.free_used = compute_balance(
+        db, balance.device_id, now
+    )
+    db.commit()
+    return balance
+
+
+def _adjust_balance(
+    db: Session,
+    device_id: str,
+    paid: int = 0,
+    free_used: int = 0,
+    expires_at: Optional[datetime] = None
+):
+    """
+    Apply a delta to the balance row in the caller's transaction.
+    expires_at is the expiry of a token that (again) has generations left.
+    """
+    values = {
+        DeviceBalance.paid_remaining: DeviceBalance.paid_remaining + paid,
+        DeviceBalance.free_used: DeviceBalance.free_used + free_used
+    }
+    if expires_at is not None:
+        values[DeviceBalance.next_expiry] = case(
+            (
+                or_(DeviceBalance.next_expiry.is_(None), DeviceBalance.next_expiry > expires_at),
+                expires_at
+            ),
+            else_=DeviceBalance.next_expiry
+        )
+    db.query(DeviceBalance).filter(DeviceBalance.device_id == device_id).update(
+        values,
+        synchronize_session=False
+    )
+
+
+def check_can_generate(db: Session, device_id: str) -> Tuple[bool, Optional[int], bool]:
+    """
+    Check if device can generate.
+    Returns: (can_generate, remaining_count, is_free_trial)
+    """
+    if settings.EXHAUSTED_FILTER_ENABLED and exhausted_devices.is_exhausted(device_id):
+        return False, 0, False
+    
+    balance = get_device_balance(db, device_id)
+    
+    # First check for paid tokens
+    if balance.paid_remaining > 0:
+        exhausted_devices.allowed(device_id)
+        return True, balance.paid_remaining, False
     
     # Check free trial
-    usage = get_free_trial_usage(db, device_id)
-    free_remaining = settings.FREE_GENERATIONS_PER_DEVICE - usage.generations_used
+    free_remaining = settings.FREE_GENERATIONS_PER_DEVICE - balance.free_used
     
     if free_remaining > 0:
+        exhausted_devices.allowed(device_id)
         return True, free_remaining, True
     
+    if settings.EXHAUSTED_FILTER_ENABLED:
+        exhausted_devices.add(device_id)
     return False, 0, False
 
 
@@ -54,42 +163,121 @@ def consume_generation(db: Session, device_id: str) -> Tuple[bool, Optional[int]
     """
     Consume one generation.
     Returns: (success, remaining_after, was_free_trial)
+
+    Decrements are conditional UPDATEs (remaining > 0 / used < limit), so
+    concurrent requests on any backend can't overdraw or lose a decrement.
+    The balance row is updated in the same transaction.
     """
-    # Try to consume from paid tokens first
     now = datetime.utcnow()
-    token = db.query(GenerationToken).filter(
-        GenerationToken.device_id == device_id,
-        GenerationToken.remaining_generations > 0,
-        GenerationToken.expires_at > now
-    ).order_by(GenerationToken.expires_at.asc()).first()
+    balance = get_device_balance(db, device_id, persist=True)
     
-    if token:
-        token.remaining_generations -= 1
-        db.commit()
-        
-        # Calculate total remaining
-        total = db.query(GenerationToken).filter(
-            GenerationToken.device_id == device_id,
-            GenerationToken.remaining_generations > 0,
-            GenerationToken.expires_at > now
-        ).all()
-        total_remaining = sum(t.remaining_generations for t in total)
+    # Try to consume from paid tokens first
+    if balance.paid_remaining > 0:
+        for _ in range(CONSUME_ATTEMPTS):
+            token_id = db.query(GenerationToken.id).filter(
+                GenerationToken.device_id == device_id,
+                GenerationToken.remaining_generations > 0,
+                GenerationToken.expires_at > now
+            ).order_by(GenerationToken.expires_at.asc()).limit(1).scalar()
+            
+            if token_id is None:
+                break
+            
+            updated = db.query(GenerationToken).filter(
+                GenerationToken.id == token_id,
+                GenerationToken.device_id == device_id,
+                GenerationToken.remaining_generations > 0
+            ).update(
+                {GenerationToken.remaining_generations: GenerationToken.remaining_generations - 1},
+                synchronize_session=False
+            )
+            
+            if updated:
+                _adjust_balance(db, device_id, paid=-1)
+                db.commit()
+                db.refresh(balance)
+                return True, max(balance.paid_remaining, 0), False
+            
+            db.rollback()
         
-        return True, total_remaining, False
+        # The balance promised paid generations the tokens don't have
+        rebuild_balance(db, balance, now)
     
     # Try free trial
     usage = get_free_trial_usage(db, device_id)
-    free_remaining = settings.FREE_GENERATIONS_PER_DEVICE - usage.generations_used
+    updated = db.query(FreeTrialUsage).filter(
+        FreeTrialUsage.device_id == device_id,
+        FreeTrialUsage.generations_used < settings.FREE_GENERATIONS_PER_DEVICE
+    ).update(
+        {
+            FreeTrialUsage.generations_used: FreeTrialUsage.generations_used + 1,
+            FreeTrialUsage.last_used_at: now
+        },
+        synchronize_session=False
+    )
     
-    if free_remaining > 0:
-        usage.generations_used += 1
-        usage.last_used_at = now
+    if updated:
+        _adjust_balance(db, device_id, free_used=1)
         db.commit()
-        return True, free_remaining - 1, True
+        db.refresh(usage)
+        return True, settings.FREE_GENERATIONS_PER_DEVICE - usage.generations_used, True
     
+    db.commit()
     return False, 0, False
 
 
+def refund_generation(db: Session, device_id: str, was_free_trial: bool) -> bool:
+    """
+    Give back a generation taken by consume_generation.
+    Returns: whether anything was refunded
+
+    Paid generations go back to the soonest-expiring valid token that has
+    been drawn from, the one consume_generation most likely took it from.
+    """
+    now = datetime.utcnow()
+    # Make sure the balance row exists so the adjustment below lands.
+    get_device_balance(db, device_id, persist=True)
+    
+    if was_free_trial:
+        updated = db.query(FreeTrialUsage).filter(
+            FreeTrialUsage.device_id == device_id,
+            FreeTrialUsage.generations_used > 0
+        ).update(
+            {FreeTrialUsage.generations_used: FreeTrialUsage.generations_used - 1},
+            synchronize_session=False
+        )
+        if updated:
+            _adjust_balance(db, device_id, free_used=-1)
+    else:
+        updated = 0
+        for _ in range(CONSUME_ATTEMPTS):
+            token = db.query(GenerationToken.id, GenerationToken.expires_at).filter(
+                GenerationToken.device_id == device_id,
+                GenerationToken.remaining_generations < GenerationToken.total_generations,
+                GenerationToken.expires_at > now
+            ).order_by(GenerationToken.expires_at.asc()).first()
+            
+            if token is None:
+                break
+            
+            updated = db.query(GenerationToken).filter(
+                GenerationToken.id == token.id,
+                GenerationToken.device_id == device_id,
+                GenerationToken.remaining_generations < GenerationToken.total_generations
+            ).update(
+                {GenerationToken.remaining_generations: GenerationToken.remaining_generations + 1},
+                synchronize_session=False
+            )
+            if updated:
+                _adjust_balance(db, device_id, paid=1, expires_at=token.expires_at)
+                break
+    
+    db.commit()
+    if updated:
+        exhausted_devices.discard(device_id)
+    return bool(updated)
+
+
 def get_tokens_by_device(db: Session, device_id: str) -> list:
     """Get all valid tokens for a device."""
     now = datetime.utcnow()
@@ -99,22 +287,50 @@ def get_tokens_by_device(db: Session, device_id: str) -> list:
     ).all()
 
 
-def create_token(
+def add_paid_token(
     db: Session,
     device_id: str,
     product_sku: str,
     total_generations: int,
-    expires_days: int = 365
+    expires_at: datetime
 ) -> GenerationToken:
-    """Create a new generation token."""
+    """
+    Add a token and credit the balance in the caller's transaction.
+    The caller commits, then calls exhausted_devices.discard(device_id).
+    """
+    # Materialize the balance before the token exists so it isn't counted twice.
+    get_device_balance(db, device_id, persist=True)
+    
     token = GenerationToken(
         device_id=device_id,
         product_sku=product_sku,
         total_generations=total_generations,
         remaining_generations=total_generations,
-        expires_at=datetime.utcnow() + timedelta(days=expires_days)
+        expires_at=expires_at
     )
     db.add(token)
+    db.flush()
+    
+    _adjust_balance(db, device_id, paid=total_generations, expires_at=expires_at)
+    return token
+
+
+def create_token(
+    db: Session,
+    device_id: str,
+    product_sku: str,
+    total_generations: int,
+    expires_days: int = 365
+) -> GenerationToken:
+    """Create a new generation token."""
+    token = add_paid_token(
+        db,
+        device_id,
+        product_sku,
+        total_generations,
+        datetime.utcnow() + timedelta(days=expires_days)
+    )
     db.commit()
+    exhausted_devices.discard(device_id)
     db.refresh(token)
     return token
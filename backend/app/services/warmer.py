@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from ..config import get_settings
+from ..metrics import warmer_requests, warmer_generations, TOOL_NAME
+from ..schemas import CopyType
+from ..shared_store import get_shared_store
+from .degradation import Priority, degradation
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# (copy_type, normalized topic, tone, language)
+WarmKey = Tuple[str, str, str, str]
+
+# Warm results are generated with the most variations a request can ask
+# for, so one result serves any variation count.
+WARM_VARIATIONS = 5
+
+# Budget charge per warm generation: its max_tokens, an upper bound
+TOKENS_PER_GENERATION = 2000
+
+SKETCH_STORE_KEY = "warmer:sketch"
+BUDGET_STORE_KEY = "warmer:spent"
+LEASE_STORE_KEY = "warmer:lease"
+
+_SPACES = re.compile(r"\s+")
+
+
+def warm_key(copy_type: str, topic: str, tone: Optional[str], language: str) -> WarmKey:
+    return (copy_type, _SPACES.sub(" ", topic).strip().casefold(), tone or "professional", language)
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy-hitters sketch: tracks at most `capacity` keys, and
+    any key seen more than total / capacity times is guaranteed to be among
+    them. A new key replaces the current minimum and inherits its count as
+    the error bound.
+
+    The minimum is found through a heap holding one (count, key) entry per
+    tracked key. Increments don't touch it: counts only grow, so an entry
+    whose count is stale is pushed back with the current count when it
+    reaches the top. Replacing a key costs O(log capacity) amortized.
+    """
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[Any, List[int]] = {}  # key -> [count, error]
+        self._heap: List[Tuple[int, Any]] = []
+    
+    def offer(self, key, weight: int = 1):
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += weight
+            return
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            floor = self._pop_min()
+        self.counts[key] = [floor + weight, floor]
+        heapq.heappush(self._heap, (floor + weight, key))
+    
+    def _pop_min(self) -> int:
+        """Drop the key with the lowest count and return that count."""
+        while True:
+            count, key = heapq.heappop(self._heap)
+            current = self.counts[key][0]
+            if current == count:
+                del self.counts[key]
+                return count
+            heapq.heappush(self._heap, (current, key))
+    
+    def clear(self):
+        self.counts.clear()
+        self._heap.clear()
+    
+    def top(self, n: int) -> List[Tuple[Any, int]]:
+        """The n most frequent keys with their guaranteed (count - error) counts."""
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(key, count - error) for key, (count, error) in ranked]
+
+
+class CacheWarmer:
+    """
+    Pre-generates copy for the most requested (copy type, topic, tone,
+    language) combinations while upstream is quiet, so those requests are
+    answered without waiting on the LLM.
+
+    Each stored result is handed out once: a user asking for a popular
+    topic still gets copy nobody else received. The sketch is saved to the
+    shared store so a restarted worker knows what is popular right away.
+
+    WARMER_TOKEN_BUDGET_PER_HOUR is spent from the shared store, so it
+    holds for all workers on the node together, and only one worker warms
+    per interval (see warmer_loop). Warm results stay in the worker that
+    made them.
+    """
+    
+    def __init__(self, sketch_size: int):
+        self.sketch = SpaceSaving(sketch_size)
+        self.topics: Dict[WarmKey, str] = {}
+        self.results: Dict[WarmKey, Deque[Tuple[float, List[Dict[str, Any]]]]] = {}
+        self._lock = threading.Lock()
+    
+    def clear(self):
+        with self._lock:
+            self.sketch.clear()
+            self.topics.clear()
+            self.results.clear()
+    
+    def observe(self, copy_type: str, topic: str, tone: Optional[str], language: str):
+        key = warm_key(copy_type, topic, tone, language)
+        with self._lock:
+            self.sketch.offer(key)
+            if key in self.sketch.counts:
+                self.topics[key] = topic
+            # Forget topics the sketch no longer tracks
+            if len(self.topics) > self.sketch.capacity:
+                for stale in [k for k in self.topics if k not in self.sketch.counts]:
+                    del self.topics[stale]
+    
+    def take(self, copy_type: str, topic: str, tone: Optional[str], language: str) -> Optional[List[Dict[str, Any]]]:
+        """Pop a warm result for this request, if there is a fresh one."""
+        key = warm_key(copy_type, topic, tone, language)
+        now = time.monotonic()
+        with self._lock:
+            stock = self.results.get(key)
+            while stock:
+                created, variations = stock.popleft()
+                if now - created < settings.WARMER_RESULT_TTL_SECONDS:
+                    warmer_requests.labels(tool=TOOL_NAME, result="hit").inc()
+                    return variations
+        warmer_requests.labels(tool=TOOL_NAME, result="miss").inc()
+        return None
+    
+    @staticmethod
+    def _reserve(tokens: int) -> bool:
+        """Spend tokens from the shared hourly budget. Returns False when it is used up."""
+        reserved = False
+        
+        def spend(spent):
+            nonlocal reserved
+            now = time.time()
+            spent = [entry for entry in spent or [] if now - entry[0] < 3600]
+            reserved = sum(t for _, t in spent) + tokens <= settings.WARMER_TOKEN_BUDGET_PER_HOUR
+            if reserved:
+                spent.append([now, tokens])
+            return spent
+        
+        get_shared_store().update(BUDGET_STORE_KEY, spend, ttl=3600)
+        return reserved
+    
+    def candidates(self) -> List[WarmKey]:
+        """Popular keys, once per missing warm result, most popular first."""
+        now = time.monotonic()
+        with self._lock:
+            wanted = []
+            for key, count in self.sketch.top(settings.WARMER_TOP_K):
+                if count < settings.WARMER_MIN_COUNT or key not in self.topics:
+                    continue
+                stock = self.results.setdefault(key, deque())
+                while stock and now - stock[0][0] >= settings.WARMER_RESULT_TTL_SECONDS:
+                    stock.popleft()
+                wanted.extend([key] * (settings.WARMER_RESULTS_PER_KEY - len(stock)))
+            # Drop stock for keys that are no longer popular
+            top = {key for key, _ in self.sketch.top(settings.WARMER_TOP_K)}
+            for key in [k for k in self.results if k not in top]:
+                del self.results[key]
+            return wanted
+    
+    async def warm_once(self) -> int:
+        """Fill missing results while upstream is quiet and budget remains. Returns generations made."""
+        from .copy_service import generate_copy
+        
+        made = 0
+        for key in self.candidates():
+            if degradation.pressure() > settings.WARMER_MAX_PRESSURE:
+                break
+            if not self._reserve(TOKENS_PER_GENERATION):
+                break
+            
+            copy_type, _, tone, language = key
+            try:
+                variations = await generate_copy(
+                    CopyType(copy_type), self.topics[key], tone, language, WARM_VARIATIONS, Priority.BATCH
+                )
+            except Exception:
+                logger.exception("warming %s failed", key)
+                continue
+            with self._lock:
+                self.results.setdefault(key, deque()).append((time.monotonic(), variations))
+            warmer_generations.labels(tool=TOOL_NAME).inc()
+            made += 1
+        return made
+    
+    def save_sketch(self):
+        """Merge this worker's popular keys into the shared store."""
+        with self._lock:
+            entries = [
+                [list(key), count, self.topics[key]]
+                for key, count in self.sketch.top(settings.WARMER_TOP_K * 4) if key in self.topics
+            ]
+        
+        def merge(saved):
+            merged = {tuple(key): [count, topic] for key, count, topic in (saved or [])}
+            for key, count, topic in entries:
+                key = tuple(key)
+                if key not in merged or merged[key][0] < count:
+                    merged[key] = [count, topic]
+            ranked = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)
+            return [[list(key), count, topic] for key, (count, topic) in ranked[:self.sketch.capacity]]
+        
+        get_shared_store().update(SKETCH_STORE_KEY, merge, ttl=7 * 86400)
+    
+    def load_sketch(self):
+        """Seed the sketch from the shared store, e.g. right after a deploy."""
+        for key, count, topic in get_shared_store().get(SKETCH_STORE_KEY) or []:
+            key = tuple(key)
+            with self._lock:
+                self.sketch.offer(key, count)
+                self.topics[key] = topic
+
+
+warmer = CacheWarmer(settings.WARMER_SKETCH_SIZE)
+
+
+async def warmer_loop():
+    """Warm popular requests every WARMER_INTERVAL_SECONDS, on one worker at a time."""
+    try:
+        warmer.load_sketch()
+    except Exception:
+        logger.exception("loading warmer sketch failed")
+    while True:
+        try:
+            # The lease keeps workers from warming the same keys in the same
+            # interval; the shared budget caps them all together
+            if get_shared_store().add(LEASE_STORE_KEY, os.getpid(), ttl=settings.WARMER_INTERVAL_SECONDS * 0.9):
+                made = await warmer.warm_once()
+                if made:
+                    logger.info("warmed %d popular requests", made)
+            warmer.save_sketch()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("warmer run failed")
+        await asyncio.sleep(settings.WARMER_INTERVAL_SECONDS)
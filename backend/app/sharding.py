@@ -0,0 +1,109 @@
+import zlib
+from typing import Dict, Iterable, List, Optional, Set
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BindParameter, BooleanClauseList, BinaryExpression
+from .models import DeviceBalance
+
+
+def shard_index(device_id: str, shard_count: int) -> int:
+    """Stable shard number for a device."""
+    return zlib.crc32(device_id.encode()) % shard_count
+
+
+def _device_ids(statement, params: Optional[dict] = None) -> Optional[Set[str]]:
+    """
+    device_id values a statement is restricted to, if its WHERE clause pins
+    device_id with == or IN at the top level. None means any device.
+    """
+    where = getattr(statement, "whereclause", None)
+    if where is None:
+        return None
+    
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        clauses = where.clauses
+    else:
+        clauses = [where]
+    
+    for clause in clauses:
+        if not isinstance(clause, BinaryExpression) or getattr(clause.left, "key", None) != "device_id":
+            continue
+        if not isinstance(clause.right, BindParameter):
+            continue
+        value = clause.right.effective_value
+        if value is None and params:
+            # e.g. Session.get() passes the primary key as a parameter
+            value = params.get(clause.right.key)
+        if value is None:
+            continue
+        if clause.operator is operators.eq:
+            return {value}
+        if clause.operator is operators.in_op:
+            return set(value)
+    return None
+
+
+class ShardRouter:
+    """
+    Hash-partitions every device-keyed table across several databases by
+    device_id. Sessions from session_factory() route each statement to the
+    shards that can hold its rows: one shard when the query pins device_id,
+    all shards otherwise.
+    """
+    
+    def __init__(self, engines: Dict[str, Engine]):
+        self.engines = engines
+        self.shard_ids = list(engines)
+    
+    @classmethod
+    def from_template(cls, url_template: str, shard_count: int) -> "ShardRouter":
+        from .database import create_db_engine
+        return cls({
+            f"shard{i}": create_db_engine(url_template.format(shard=i))
+            for i in range(shard_count)
+        })
+    
+    def shard_for(self, device_id: Optional[str]) -> str:
+        if not device_id:
+            return self.shard_ids[0]
+        return self.shard_ids[shard_index(device_id, len(self.shard_ids))]
+    
+    def _shard_chooser(self, mapper, instance, clause=None) -> str:
+        return self.shard_for(getattr(instance, "device_id", None))
+    
+    def _identity_chooser(self, mapper, primary_key, **kwargs) -> List[str]:
+        # DeviceBalance is keyed by device_id itself; other tables use UUIDs.
+        if mapper is not None and mapper.class_ is DeviceBalance:
+            return [self.shard_for(primary_key[0])]
+        return self.shard_ids
+    
+    def _execute_chooser(self, orm_context) -> Iterable[str]:
+        params = orm_context.parameters if isinstance(orm_context.parameters, dict) else None
+        device_ids = _device_ids(orm_context.statement, params)
+        if device_ids is None:
+            return self.shard_ids
+        return sorted({self.shard_for(device_id) for device_id in device_ids})
+    
+    def session_factory(self) -> sessionmaker:
+        return sessionmaker(
+            class_=ShardedSession,
+            autocommit=False,
+            autoflush=False,
+            shards=self.engines,
+            shard_chooser=self._shard_chooser,
+            identity_chooser=self._identity_chooser,
+            execute_chooser=self._execute_chooser,
+            info={"shard_router": self},
+        )
+    
+    def create_all(self):
+        from .database import create_tables
+        
+        for shard_engine in self.engines.values():
+            create_tables(shard_engine)
+    
+    def dispose(self):
+        for shard_engine in self.engines.values():
+            shard_engine.dispose()
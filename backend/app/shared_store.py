@@ -0,0 +1,175 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple
+from .config import get_settings
+
+settings = get_settings()
+
+
+class MemoryStore:
+    """In-process key/value store with TTLs and LRU eviction."""
+    
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _live(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.time():
+            del self._data[key]
+            return None
+        return item
+    
+    def _put(self, key: str, value: Any, ttl: Optional[float]):
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            item = self._live(key)
+            return default if item is None else item[0]
+    
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._put(key, value, ttl)
+    
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Set key only if it is absent. Returns whether it was set."""
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._put(key, value, ttl)
+            return True
+    
+    def update(self, key: str, fn: Callable[[Any], Any], ttl: Optional[float] = None) -> Any:
+        """Atomically replace key with fn(current value or None)."""
+        with self._lock:
+            item = self._live(key)
+            value = fn(None if item is None else item[0])
+            self._put(key, value, ttl)
+            return value
+    
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteStore:
+    """
+    Key/value store in a local SQLite file, shared by every worker process
+    on the node. Values are stored as JSON.
+    """
+    
+    # Expired rows are swept every this many writes.
+    PURGE_EVERY = 1000
+    
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._writes = 0
+    
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; created lazily so forked workers never
+        # inherit the parent's handle.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout_ms / 1000,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._local.conn = conn
+        return conn
+    
+    def _read(self, conn: sqlite3.Connection, key: str) -> Optional[Any]:
+        row = conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+    
+    def _write(self, conn: sqlite3.Connection, key: str, value: Any, ttl: Optional[float]):
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None),
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._read(self._conn(), key)
+        return default if value is None else value
+    
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._write(self._conn(), key, value, ttl)
+    
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Set key only if it is absent. Returns whether it was set."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            added = self._read(conn, key) is None
+            if added:
+                self._write(conn, key, value, ttl)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return added
+    
+    def update(self, key: str, fn: Callable[[Any], Any], ttl: Optional[float] = None) -> Any:
+        """Atomically replace key with fn(current value or None)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = fn(self._read(conn, key))
+            self._write(conn, key, value, ttl)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return value
+    
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+    
+    def clear(self):
+        self._conn().execute("DELETE FROM kv")
+
+
+_store = None
+
+
+def get_shared_store():
+    """
+    Get the store for state that must agree across workers (caches, rate
+    limits). Uses SHARED_STORE_PATH when set, otherwise process memory.
+    """
+    global _store
+    if _store is None:
+        if settings.SHARED_STORE_PATH:
+            _store = SQLiteStore(settings.SHARED_STORE_PATH, settings.SQLITE_BUSY_TIMEOUT_MS)
+        else:
+            _store = MemoryStore()
+    return _store
@@ -0,0 +1,18 @@
+from uvicorn.workers import UvicornWorker
+from .config import get_settings
+
+settings = get_settings()
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    """
+    Uvicorn worker that gives in-flight requests DRAIN_TIMEOUT_SECONDS to
+    finish on shutdown, then cancels them. Cancelled generations are refunded.
+    Plain UvicornWorker waits until gunicorn's graceful_timeout and is then
+    killed, with no refunds and no final history flush.
+    """
+    
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "timeout_graceful_shutdown": int(settings.DRAIN_TIMEOUT_SECONDS),
+    }
@@ -0,0 +1,49 @@
+"""
+Gunicorn config for running several uvicorn workers per node.
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+WEB_CONCURRENCY sets the worker count (default: one per CPU core).
+"""
+import multiprocessing
+import os
+import shutil
+import uuid
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+# Cancels (and refunds) requests still running DRAIN_TIMEOUT_SECONDS after
+# shutdown starts; graceful_timeout leaves time after that for cleanup.
+worker_class = "app.worker.DrainingUvicornWorker"
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = 120
+keepalive = 5
+
+# Each worker writes its metric samples here and /metrics aggregates them.
+# Must be set before any worker imports prometheus_client.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+# Cross-worker caches and rate limits live in a shared SQLite file unless
+# configured otherwise.
+os.environ.setdefault("SHARED_STORE_PATH", "/tmp/ai-copywriter-shared.db")
+
+
+def on_starting(server):
+    # Workers inherit it; drain mode set under it (app/drain.py) covers all
+    # of them and ends with this master
+    os.environ["APP_BOOT_ID"] = uuid.uuid4().hex
+    
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    
+    # Create tables once in the master so workers don't race on DDL.
+    from app.database import dispose_db, init_db
+    init_db()
+    # Workers are forked from this process; don't hand them open connections.
+    dispose_db()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,60 @@
+"""
+Measure generation latency and throughput against recorded upstream traffic.
+
+    python -m scripts.bench_generation cassettes/prod.jsonl.gz --concurrency 20 --requests 200
+
+Record a cassette first by running the app with LLM_RECORD_PATH set. Each
+request here takes the next recording in the cassette (prompts don't need to
+match), replayed with its original latency times --latency-scale, so runs
+are repeatable and never call upstream.
+"""
+import argparse
+import asyncio
+import time
+
+
+async def run(path: str, concurrency: int, requests: int, latency_scale: float) -> tuple:
+    """Return the latency of each generate_copy call and the total wall time, in seconds."""
+    from app.schemas import CopyType
+    from app.services import copy_service
+    from app.services.cassette import ReplayTransport
+    
+    copy_service.start_llm_client(ReplayTransport(path, latency_scale, match_body=False))
+    pending = list(range(requests))
+    latencies = []
+    
+    async def worker():
+        while pending:
+            i = pending.pop()
+            started = time.perf_counter()
+            await copy_service.generate_copy(CopyType.MARKETING, f"Benchmark topic {i}", "professional", "en", 3)
+            latencies.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await copy_service.close_llm_client()
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cassette")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    args = parser.parse_args()
+    
+    latencies, elapsed = asyncio.run(run(args.cassette, args.concurrency, args.requests, args.latency_scale))
+    latencies.sort()
+    
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+    
+    print(f"{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.1f}/s)")
+    print(f"p50 {pct(50):.0f}ms  p90 {pct(90):.0f}ms  p99 {pct(99):.0f}ms  max {latencies[-1] * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure credit-write throughput against 1..N SQLite shards.
+
+    python -m scripts.bench_shards --shards 1 2 4 8 --workers 8 --seconds 5
+
+Each worker process (like a gunicorn worker) consumes generations for random
+devices in a loop; the result is total successful writes per second for
+each shard count. Files are created in a temporary directory.
+"""
+import argparse
+import multiprocessing
+import random
+import tempfile
+import time
+
+
+def _worker(url_template: str, shard_count: int, devices: list, seconds: float, results):
+    from app.sharding import ShardRouter
+    from app.services.token_service import consume_generation
+    
+    router = ShardRouter.from_template(url_template, shard_count)
+    db = router.session_factory()()
+    writes = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        success, _, _ = consume_generation(db, random.choice(devices))
+        writes += success
+    db.close()
+    router.dispose()
+    results.put(writes)
+
+
+def run(shard_count: int, workers: int, seconds: float, device_count: int) -> float:
+    """Return successful consume_generation calls per second."""
+    from app.sharding import ShardRouter
+    from app.services.token_service import create_token
+    
+    directory = tempfile.mkdtemp(prefix="bench_shards_")
+    url_template = f"sqlite:///{directory}/shard{{shard}}.db"
+    router = ShardRouter.from_template(url_template, shard_count)
+    router.create_all()
+    
+    devices = [f"bench-device-{i:06d}" for i in range(device_count)]
+    db = router.session_factory()()
+    for device_id in devices:
+        create_token(db, device_id, "pack_200", 1_000_000, 365)
+    db.close()
+    router.dispose()
+    
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=_worker, args=(url_template, shard_count, devices, seconds, results))
+        for _ in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    total = sum(results.get() for _ in procs)
+    for p in procs:
+        p.join()
+    return total / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--devices", type=int, default=200)
+    args = parser.parse_args()
+    
+    baseline = None
+    print(f"{'shards':>6}  {'writes/s':>10}  {'speedup':>7}")
+    for shard_count in args.shards:
+        rate = run(shard_count, args.workers, args.seconds, args.devices)
+        baseline = baseline or rate
+        print(f"{shard_count:>6}  {rate:>10.0f}  {rate / baseline:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
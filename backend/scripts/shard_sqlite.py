@@ -0,0 +1,88 @@
+"""
+Split a single SQLite database into device_id shards, or rebalance an
+existing set of shards onto a different shard count.
+
+    # app.db -> 4 shards
+    python -m scripts.shard_sqlite \
+        --source sqlite:///./data/app.db \
+        --target 'sqlite:///./data/app_shard{shard}.db' --shards 4
+
+    # 4 shards -> 8 shards
+    python -m scripts.shard_sqlite \
+        --source 'sqlite:///./data/app_shard{shard}.db' --source-shards 4 \
+        --target 'sqlite:///./data/new_shard{shard}.db' --shards 8
+
+Then set DATABASE_SHARDS and DATABASE_SHARD_URL_TEMPLATE to the target.
+Rows already present on their target shard are skipped, so the copy can be
+re-run; stop the app before the final run.
+"""
+import argparse
+import time
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from app.database import create_db_engine
+from app.models import Base
+from app.sharding import ShardRouter
+
+
+def reshard(source_urls, target_router: ShardRouter, batch_size: int = 1000) -> dict:
+    """Copy rows from every source database onto their target shard. Returns rows copied per table."""
+    target_router.create_all()
+    copied = defaultdict(int)
+    
+    for source_url in source_urls:
+        source = create_db_engine(source_url)
+        for table in Base.metadata.sorted_tables:
+            pk = list(table.primary_key.columns)
+            with source.connect() as src:
+                result = src.execution_options(stream_results=True).execute(select(table).order_by(*pk))
+                for rows in result.mappings().partitions(batch_size):
+                    by_shard = defaultdict(list)
+                    for row in rows:
+                        by_shard[target_router.shard_for(row["device_id"])].append(dict(row))
+                    
+                    for shard_id, shard_rows in by_shard.items():
+                        with target_router.engines[shard_id].begin() as dst:
+                            keys = [tuple(r[c.name] for c in pk) for r in shard_rows]
+                            existing = {
+                                tuple(r) for r in dst.execute(
+                                    select(*pk).where(pk[0].in_([k[0] for k in keys]))
+                                )
+                            }
+                            fresh = [r for r, k in zip(shard_rows, keys) if k not in existing]
+                            if fresh:
+                                dst.execute(table.insert(), fresh)
+                                copied[table.name] += len(fresh)
+        source.dispose()
+    
+    return dict(copied)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", required=True, help="Source URL, or URL template with {shard}")
+    parser.add_argument("--source-shards", type=int, default=0, help="Shard count when --source is a template")
+    parser.add_argument("--target", required=True, help="Target URL template with {shard}")
+    parser.add_argument("--shards", type=int, required=True, help="Target shard count")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    
+    if args.source_shards:
+        sources = [args.source.format(shard=i) for i in range(args.source_shards)]
+    else:
+        sources = [args.source]
+    
+    router = ShardRouter.from_template(args.target, args.shards)
+    started = time.perf_counter()
+    copied = reshard(sources, router, args.batch_size)
+    router.dispose()
+    
+    for table in Base.metadata.sorted_tables:
+        print(f"{table.name}: {copied.get(table.name, 0)} rows copied")
+    print(f"done in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
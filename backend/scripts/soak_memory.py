@@ -0,0 +1,102 @@
+"""
+Drive traffic at a running backend and flag memory that only ever grows.
+
+    ADMIN_TOKEN=... python -m scripts.soak_memory http://localhost:8000 --minutes 30
+
+Run the server with LLM_REPLAY_PATH set (see app/services/cassette.py), so
+the soak doesn't spend upstream tokens, and RATE_LIMIT_ENABLED=false. Every --sample-seconds the script
+reads /api/v1/admin/memory and, at the end, reports RSS and every metric
+family whose series count rose in most samples after the warm-up. With
+--tracemalloc it also prints the allocation sites that grew the most.
+Exits 1 when it found growth.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import httpx
+
+COPY_TYPES = ["marketing", "product", "ad", "email", "social", "blog"]
+
+
+def _traffic(base_url: str, stop: threading.Event, counts: dict):
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        while not stop.is_set():
+            device_id = f"soak-device-{random.randrange(1_000_000)}"
+            response = client.post("/api/v1/copy/generate", json={
+                "copy_type": random.choice(COPY_TYPES),
+                "topic": f"Soak topic {random.randrange(1000)}",
+                "device_id": device_id,
+                "variations": 2
+            })
+            client.get(f"/api/v1/tokens/status/{device_id}")
+            client.get(f"/api/v1/copy/history/{device_id}")
+            counts[response.status_code] = counts.get(response.status_code, 0) + 1
+
+
+def growing(values: list, min_share: float) -> bool:
+    """Whether the values rose between most consecutive samples and ended higher."""
+    if len(values) < 3:
+        return False
+    rises = sum(b > a for a, b in zip(values, values[1:]))
+    return values[-1] > values[0] and rises >= min_share * (len(values) - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base_url")
+    parser.add_argument("--minutes", type=float, default=10)
+    parser.add_argument("--sample-seconds", type=float, default=30)
+    parser.add_argument("--warmup-samples", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--min-share", type=float, default=0.8, help="share of rising samples that counts as growth")
+    parser.add_argument("--tracemalloc", action="store_true")
+    args = parser.parse_args()
+    
+    admin = httpx.Client(base_url=args.base_url, headers={"X-Admin-Token": os.environ["ADMIN_TOKEN"]}, timeout=60)
+    if args.tracemalloc:
+        admin.post("/api/v1/admin/memory/snapshot").raise_for_status()
+    
+    stop = threading.Event()
+    counts = {}
+    threads = [threading.Thread(target=_traffic, args=(args.base_url, stop, counts)) for _ in range(args.clients)]
+    for t in threads:
+        t.start()
+    
+    samples = []
+    deadline = time.monotonic() + args.minutes * 60
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(args.sample_seconds)
+            sample = admin.get("/api/v1/admin/memory").json()
+            samples.append(sample)
+            print(f"rss {sample['rss_bytes'] / 2**20:.1f} MiB  series {sum(sample['series'].values())}  responses {counts}")
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    
+    samples = samples[args.warmup_samples:]
+    findings = []
+    rss = [s["rss_bytes"] for s in samples]
+    if growing(rss, args.min_share):
+        findings.append(f"RSS grew {(rss[-1] - rss[0]) / 2**20:.1f} MiB over {len(rss)} samples")
+    for name in samples[-1]["series"] if samples else []:
+        series = [s["series"].get(name, 0) for s in samples]
+        if growing(series, args.min_share):
+            findings.append(f"{name}: {series[0]} -> {series[-1]} series")
+    
+    if args.tracemalloc:
+        print("\nlargest growth since start:")
+        for stat in admin.get("/api/v1/admin/memory/top", params={"limit": 15}).json():
+            print(f"  {stat['size_diff_bytes'] / 1024:+10.1f} KiB  {stat['count_diff']:+8d}  {stat['site']}")
+        admin.delete("/api/v1/admin/memory/snapshot")
+    
+    print("\n" + ("\n".join(findings) if findings else "no monotonic growth found"))
+    sys.exit(1 if findings else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Hammer the credit path with concurrent generate requests and check the books.
+
+    python -m scripts.stress_credits --workers 4 --devices 20 --credits 50 --requests-per-device 100
+
+Each worker process (like a gunicorn worker) serves POST /api/v1/copy/generate
+in-process against a stub LLM that fails --failure-rate of calls, so failed
+generations are refunded while others compete for the same credits. Demand
+per device exceeds its credits. Everything shares one SQLite file in a
+temporary directory.
+
+Afterwards every device must satisfy:
+- no overdraft: successful generations <= credits + free trial
+- no lost decrement or double refund: paid and free generations charged
+  == generations served
+- the cached balance row agrees with the tokens and free-trial usage
+
+Prints throughput, the time consume/refund calls take, and separately the
+time spent waiting: for a pooled connection, and for the SQLite write lock
+(the first write of each transaction, where busy_timeout waits). Exits 1 on
+any violation, so it doubles as a benchmark for changes to the credit path.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import traceback
+from collections import Counter
+
+
+def _worker(database_url: str, device_ids: list, requests_per_device: int, concurrency: int,
+            failure_rate: float, seed: int, results):
+    try:
+        results.put(_serve(database_url, device_ids, requests_per_device, concurrency, failure_rate, seed))
+    except BaseException:
+        results.put(traceback.format_exc())
+        raise
+
+
+def _serve(database_url: str, device_ids: list, requests_per_device: int, concurrency: int,
+           failure_rate: float, seed: int) -> tuple:
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ["HISTORY_ENABLED"] = "false"
+    os.environ["EXHAUSTED_FILTER_ENABLED"] = "false"
+    import httpx
+    from sqlalchemy import event
+    from app import database
+    from app.api import copy as copy_api
+    from app.main import app
+    from app.services import copy_service
+    
+    rng = random.Random(seed)
+    credit_seconds, checkout_seconds, lock_seconds = [], [], []
+    
+    def timed(fn):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                credit_seconds.append(time.perf_counter() - started)
+        return wrapper
+    
+    copy_api.consume_generation = timed(copy_api.consume_generation)
+    copy_api.refund_generation = timed(copy_api.refund_generation)
+    
+    pool = database.engine.pool
+    checkout = pool.connect
+    
+    def timed_checkout():
+        started = time.perf_counter()
+        try:
+            return checkout()
+        finally:
+            checkout_seconds.append(time.perf_counter() - started)
+    
+    pool.connect = timed_checkout
+    
+    @event.listens_for(database.engine, "before_cursor_execute")
+    def write_started(conn, cursor, statement, parameters, context, executemany):
+        if not conn.info.get("writing") and statement.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+            conn.info["writing"] = time.perf_counter()
+    
+    @event.listens_for(database.engine, "after_cursor_execute")
+    def write_locked(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("writing")
+        if started and started is not True:
+            lock_seconds.append(time.perf_counter() - started)
+            conn.info["writing"] = True
+    
+    @event.listens_for(pool, "checkin")
+    def transaction_ended(dbapi_connection, connection_record):
+        connection_record.info.pop("writing", None)
+    
+    for name in ("commit", "rollback"):
+        event.listen(database.engine, name, lambda conn: conn.info.pop("writing", None))
+    
+    async def stub_llm(request):
+        await asyncio.sleep(rng.uniform(0.001, 0.01))
+        if rng.random() < failure_rate:
+            return httpx.Response(500, json={"error": "stub failure"})
+        content = '{"variations": [{"headline": "Stub", "body": "Stub copy."}]}'
+        return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+    
+    async def run():
+        copy_service.start_llm_client(httpx.MockTransport(stub_llm))
+        statuses = Counter()
+        successes = Counter()
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://stress") as client:
+            async def generate(device_id):
+                async with semaphore:
+                    response = await client.post("/api/v1/copy/generate", json={
+                        "copy_type": "marketing", "topic": "Stress", "device_id": device_id, "variations": 1
+                    })
+                statuses[response.status_code] += 1
+                if response.status_code == 200:
+                    successes[device_id] += 1
+            
+            work = [device_id for device_id in device_ids for _ in range(requests_per_device)]
+            rng.shuffle(work)
+            started = time.perf_counter()
+            await asyncio.gather(*(generate(device_id) for device_id in work))
+            elapsed = time.perf_counter() - started
+        await copy_service.close_llm_client()
+        return statuses, successes, elapsed
+    
+    statuses, successes, elapsed = asyncio.run(run())
+    return dict(statuses), dict(successes), elapsed, credit_seconds, checkout_seconds, lock_seconds
+
+
+def run(workers: int = 4, devices: int = 20, credits: int = 50, requests_per_device: int = 100,
+        concurrency: int = 50, failure_rate: float = 0.2, free_devices: int = 5) -> dict:
+    """
+    Run the stress load and audit the database.
+
+    Returns:
+        Dict with "violations" (empty when the books balance), "statuses",
+        "requests_per_second", and p50/p99/max milliseconds of consume/refund
+        calls ("credit_ms"), pool checkouts ("checkout_wait_ms") and write
+        lock waits ("lock_wait_ms")
+    """
+    from sqlalchemy.orm import sessionmaker
+    from app.database import create_db_engine, create_tables
+    from app.models import DeviceBalance
+    from app.services.token_service import create_token, get_device_balance, get_free_trial_usage
+    
+    directory = tempfile.mkdtemp(prefix="stress_credits_")
+    database_url = f"sqlite:///{directory}/stress.db"
+    engine = create_db_engine(database_url)
+    create_tables(engine)
+    db = sessionmaker(bind=engine)()
+    
+    paid = [f"stress-paid-{i:04d}" for i in range(devices)]
+    free = [f"stress-free-{i:04d}" for i in range(free_devices)]
+    for device_id in paid:
+        create_token(db, device_id, "pack_200", credits, 365)
+    
+    # Each worker sends its share of every device's requests
+    per_worker = max(1, requests_per_device // workers)
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker, args=(
+            database_url, paid + free, per_worker, concurrency, failure_rate, seed, results
+        ))
+        for seed in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    outputs = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    for output in outputs:
+        if isinstance(output, str):
+            raise RuntimeError(f"stress worker failed:\n{output}")
+    
+    statuses, successes = Counter(), Counter()
+    credit_seconds, checkout_seconds, lock_seconds = [], [], []
+    for worker_statuses, worker_successes, _, worker_credit, worker_checkout, worker_lock in outputs:
+        statuses.update(worker_statuses)
+        successes.update(worker_successes)
+        credit_seconds.extend(worker_credit)
+        checkout_seconds.extend(worker_checkout)
+        lock_seconds.extend(worker_lock)
+    elapsed = max(output[2] for output in outputs)
+    
+    from app.config import get_settings
+    free_limit = get_settings().FREE_GENERATIONS_PER_DEVICE
+    violations = []
+    db.expire_all()
+    for device_id in paid + free:
+        # Devices fall back to their free trial once paid credits run out
+        owned = credits if device_id in paid else 0
+        remaining = get_device_balance(db, device_id).paid_remaining
+        free_used = get_free_trial_usage(db, device_id).generations_used
+        served = successes[device_id]
+        if served > owned + free_limit or remaining < 0 or free_used > free_limit:
+            violations.append(f"{device_id}: overdraft, {served} generations on {owned} credits + free trial")
+        if (owned - remaining) + free_used != served:
+            violations.append(
+                f"{device_id}: {owned - remaining} paid and {free_used} free generations charged for {served} served"
+            )
+        cached = db.get(DeviceBalance, device_id)
+        if cached is not None and (cached.paid_remaining, cached.free_used) != (remaining, free_used):
+            violations.append(
+                f"{device_id}: balance row says {cached.paid_remaining} paid / {cached.free_used} free, "
+                f"tokens say {remaining} / {free_used}"
+            )
+    db.close()
+    engine.dispose()
+    
+    def timings(seconds):
+        seconds = sorted(seconds) or [0.0]
+        
+        def pct(p):
+            return seconds[min(len(seconds) - 1, int(p / 100 * len(seconds)))] * 1000
+        
+        return {"p50": pct(50), "p99": pct(99), "max": seconds[-1] * 1000}
+    
+    return {
+        "violations": violations,
+        "statuses": dict(statuses),
+        "requests_per_second": sum(statuses.values()) / elapsed,
+        "credit_ms": timings(credit_seconds),
+        "checkout_wait_ms": timings(checkout_seconds),
+        "lock_wait_ms": timings(lock_seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--free-devices", type=int, default=5)
+    parser.add_argument("--credits", type=int, default=50)
+    parser.add_argument("--requests-per-device", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50, help="in-flight requests per worker")
+    parser.add_argument("--failure-rate", type=float, default=0.2)
+    args = parser.parse_args()
+    
+    result = run(args.workers, args.devices, args.credits, args.requests_per_device,
+                 args.concurrency, args.failure_rate, args.free_devices)
+    print(f"{result['requests_per_second']:.0f} requests/s  statuses {result['statuses']}")
+    for label, key in (("consume/refund", "credit_ms"), ("pool checkout", "checkout_wait_ms"), ("write lock", "lock_wait_ms")):
+        timings = result[key]
+        print(f"{label:<15} p50 {timings['p50']:.1f}ms  p99 {timings['p99']:.1f}ms  max {timings['max']:.1f}ms")
+    for violation in result["violations"]:
+        print("VIOLATION", violation)
+    print("books balance" if not result["violations"] else f"{len(result['violations'])} violations")
+    raise SystemExit(1 if result["violations"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,35 @@
+import asyncio
+import os
+from contextlib import contextmanager
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
-from app.main import app
-from app.database import get_db
+from app.main import app, settings as main_settings
+from app.database import get_db, create_db_engine
 from app.models import Base
+from app.ratelimit import get_bucket_store
+from app.services import copy_service, history_service
+from app.services.exhausted_filter import exhausted_devices
+from app.services.warmer import warmer
+from app.drain import drain
+from app.shared_store import get_shared_store
 
-# Test database
-SQLALCHEMY_DATABASE_URL = "sqlite://"
+# Test database; set TEST_DATABASE_URL (e.g. a local Postgres container) to
+# run the suite against another backend.
+SQLALCHEMY_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "sqlite://")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
+if SQLALCHEMY_DATABASE_URL == "sqlite://":
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+else:
+    engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
@@ -34,9 +48,34 @@ def setup_db():
     Base.metadata.drop_all(bind=engine)
 
 
+@pytest.fixture(autouse=True)
+def reset_in_memory_state():
+    get_bucket_store().clear()
+    get_shared_store().clear()
+    exhausted_devices.clear()
+    history_service.history_buffer.take()
+    warmer.clear()
+    drain.clear()
+    yield
+
+
+@contextmanager
+def testing_db_session():
+    db = TestingSessionLocal()
+    try:
+        yield db
+        db.commit()
+    finally:
+        db.close()
+
+
 @pytest.fixture
-def client():
+def client(monkeypatch):
     app.dependency_overrides[get_db] = override_get_db
+    # Background writers use the test database too
+    monkeypatch.setattr(history_service, "get_db_session", testing_db_session)
+    # No background connections to the real LLM proxy
+    monkeypatch.setattr(main_settings, "LLM_PREWARM_CONNECTIONS", 0)
     with TestClient(app) as c:
         yield c
     app.dependency_overrides.clear()
@@ -49,3 +88,12 @@ def db():
         yield db
     finally:
         db.close()
+
+
+@pytest.fixture
+def mock_llm():
+    """Send LLM proxy calls to a handler(request) for the rest of the test."""
+    def install(handler):
+        copy_service.start_llm_client(httpx.MockTransport(handler))
+    yield install
+    asyncio.run(copy_service.close_llm_client())
@@ -128,3 +128,440 @@ def test_error_detail_format_402(client: TestClient, db):
             f"Object detail must have 'error' or 'message': {detail}"
     else:
         assert isinstance(detail, str), f"Detail must be string or dict: {detail}"
+
+
+def test_rate_limit_per_device(client: TestClient, monkeypatch):
+    """Bursts from one device should get 429 with Retry-After"""
+    from app.ratelimit import settings as ratelimit_settings
+    monkeypatch.setattr(ratelimit_settings, "RATE_LIMIT_DEVICE_BURST", 2)
+    
+    payload = {"copy_type": "marketing", "topic": "Test", "device_id": "limited-device-1"}
+    # Invalid requests still spend rate-limit tokens, and never reach the LLM
+    statuses = [
+        client.post("/api/v1/copy/generate", json={**payload, "variations": 0}).status_code
+        for _ in range(3)
+    ]
+    assert statuses[:2] == [422, 422]
+    assert statuses[2] == 429
+    
+    response = client.post("/api/v1/copy/generate", json=payload)
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    assert "detail" in response.json()
+    
+    # Other devices are unaffected
+    response = client.post("/api/v1/copy/generate", json={**payload, "device_id": "limited-device-2", "variations": 0})
+    assert response.status_code == 422
+
+
+def test_token_bucket_refill():
+    from app.ratelimit import take_token
+    
+    allowed, state, _ = take_token(None, 0.0, rate=1.0, capacity=1)
+    assert allowed
+    allowed, state, retry_after = take_token(state, 0.5, rate=1.0, capacity=1)
+    assert not allowed
+    assert retry_after == pytest.approx(0.5)
+    allowed, state, _ = take_token(state, 1.0, rate=1.0, capacity=1)
+    assert allowed
+
+
+def test_copy_kit_bills_per_type_and_falls_back(client: TestClient, mock_llm):
+    """A kit is one upstream call; a bad section is regenerated on its own"""
+    import json
+    import httpx
+    
+    prompts = []
+    
+    def upstream(request):
+        prompt = json.loads(request.content)["messages"][1]["content"]
+        prompts.append(prompt)
+        if 'Section "' in prompt:
+            content = {
+                "marketing": [{"headline": "Wake up", "body": "Fresh roasted coffee, delivered."}],
+                "email": "not a list"
+            }
+        else:
+            content = {"items": [{"subject": "Your beans are roasting", "preview_text": "Ships Monday"}]}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}]})
+    
+    mock_llm(upstream)
+    payload = {
+        "copy_types": ["marketing", "email"],
+        "topic": "Coffee subscription",
+        "device_id": "kit-device-12345",
+        "variations": 1
+    }
+    response = client.post("/api/v1/copy/kit", json=payload)
+    assert response.status_code == 200
+    data = response.json()
+    assert [s["copy_type"] for s in data["sections"]] == ["marketing", "email"]
+    assert "Fresh roasted coffee" in data["sections"][0]["variations"][0]["content"]
+    assert "Your beans are roasting" in data["sections"][1]["variations"][0]["content"]
+    assert data["remaining_generations"] == 1
+    assert len(prompts) == 2
+    
+    # Not enough generations left for two types: nothing is charged
+    response = client.post("/api/v1/copy/kit", json=payload)
+    assert response.status_code == 402
+    response = client.get("/api/v1/tokens/status/kit-device-12345")
+    assert response.json()["remaining_generations"] == 1
+    
+    response = client.post("/api/v1/copy/kit", json={**payload, "copy_types": ["email", "email"]})
+    assert response.status_code == 422
+
+
+def test_generate_with_target_languages(client: TestClient, mock_llm):
+    """Variations are generated once and translated per target language"""
+    import json
+    import httpx
+    
+    prompts = []
+    
+    def upstream(request):
+        prompt = json.loads(request.content)["messages"][1]["content"]
+        prompts.append(prompt)
+        if "into de" in prompt:
+            content = {"variations": [{"headline": "Aufwachen", "body": "Frisch gerösteter Kaffee."}]}
+        elif "into fr" in prompt:
+            content = {"variations": []}
+        else:
+            content = {"variations": [{"headline": "Wake up", "body": "Fresh roasted coffee."}]}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}]})
+    
+    mock_llm(upstream)
+    response = client.post("/api/v1/copy/generate", json={
+        "copy_type": "marketing",
+        "topic": "Coffee subscription",
+        "device_id": "polyglot-device-1",
+        "variations": 1,
+        "target_languages": ["de", "fr", "en"]
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert "Fresh roasted coffee" in data["variations"][0]["content"]
+    # fr came back empty and is left out; en is the source language
+    assert list(data["translations"]) == ["de"]
+    assert "Frisch gerösteter Kaffee" in data["translations"]["de"][0]["content"]
+    assert len(prompts) == 3
+    assert data["remaining_generations"] == 2
+    
+    # Free trial generations can't fan out to more languages than the cap
+    response = client.post("/api/v1/copy/generate", json={
+        "copy_type": "marketing",
+        "topic": "Coffee subscription",
+        "device_id": "polyglot-device-1",
+        "variations": 1,
+        "target_languages": ["de", "fr", "es"]
+    })
+    assert response.status_code == 402
+    assert len(prompts) == 3
+    response = client.get("/api/v1/tokens/status/polyglot-device-1")
+    assert response.json()["remaining_generations"] == 2
+
+
+def test_disconnect_through_full_app_refunds(client: TestClient, monkeypatch):
+    """A disconnect seen by the ASGI server cancels generation and refunds"""
+    import asyncio
+    import json
+    import httpx
+    from app.main import app
+    from app.api import copy as copy_api
+    from app.services import copy_service
+    
+    monkeypatch.setattr(copy_api.settings, "LLM_DISCONNECT_POLL_SECONDS", 0.01)
+    upstream_cancelled = []
+    
+    async def slow_upstream(request):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            upstream_cancelled.append(True)
+            raise
+    
+    body = json.dumps({"copy_type": "marketing", "topic": "Test", "device_id": "asgi-disconnect-1"}).encode()
+    
+    async def run():
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        disconnected = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.2, disconnected.set)
+        
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # Like uvicorn: waits until the client goes away, then reports it
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+        
+        sent = []
+        
+        async def send(message):
+            sent.append(message)
+        
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "POST", "scheme": "http", "path": "/api/v1/copy/generate", "raw_path": b"/api/v1/copy/generate",
+            "query_string": b"", "root_path": "",
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 5000), "server": ("testserver", 80),
+        }
+        copy_service.start_llm_client(httpx.MockTransport(slow_upstream))
+        try:
+            await asyncio.wait_for(app(scope, receive, send), 5)
+        finally:
+            await copy_service.close_llm_client()
+        return sent
+    
+    sent = asyncio.run(run())
+    assert sent[0]["status"] == 499
+    assert upstream_cancelled == [True]
+    response = client.get("/api/v1/tokens/status/asgi-disconnect-1")
+    assert response.json()["remaining_generations"] == 3
+
+
+def test_history_pagination_and_export(client: TestClient, db):
+    """History pages follow a cursor; exports stream every row"""
+    import csv
+    import io
+    import json
+    from app.services.history_service import record_generation, flush_history
+    
+    for i in range(5):
+        record_generation("history-device-1", "marketing", f"Topic {i}", "en", [f"Variation {i}a", f"Variation {i}b"])
+    record_generation("history-device-2", "ad", "Other", "en", ["Not mine"])
+    assert flush_history(db) == 11
+    
+    contents = []
+    cursor = None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/api/v1/copy/history/history-device-1", params=params).json()
+        contents += [item["content"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(contents) == 10
+    assert len(set(contents)) == 10
+    assert "Not mine" not in contents
+    
+    assert client.get("/api/v1/copy/history/history-device-1", params={"cursor": "%%%"}).status_code == 400
+    
+    response = client.get("/api/v1/copy/history/history-device-1/export")
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["content"] for line in lines) == sorted(contents)
+    
+    response = client.get("/api/v1/copy/history/history-device-1/export", params={"format": "csv"})
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == 10
+    assert rows[0]["topic"].startswith("Topic")
+
+
+def test_refine_sends_only_the_variation(client: TestClient, mock_llm):
+    """A refine is one small call with just the variation and the instruction"""
+    import json
+    import httpx
+    
+    requests = []
+    
+    def upstream(request):
+        requests.append(json.loads(request.content))
+        content = {"subject": "Beans, but faster", "preview_text": "Ships today"}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}]})
+    
+    mock_llm(upstream)
+    response = client.post("/api/v1/copy/refine", json={
+        "copy_type": "email",
+        "topic": "Coffee subscription",
+        "device_id": "refine-device-123",
+        "variation": "📧 Subject: Your beans are roasting\n📄 Preview: Ships Monday",
+        "instruction": "Shorter and more urgent"
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert "Beans, but faster" in data["variation"]["content"]
+    assert data["remaining_generations"] == 2
+    
+    assert len(requests) == 1
+    prompt = requests[0]["messages"][1]["content"]
+    assert "Shorter and more urgent" in prompt
+    assert "Your beans are roasting" in prompt
+    assert requests[0]["max_tokens"] <= 500
+
+
+def test_popular_request_is_served_from_warmed_result(client: TestClient, mock_llm):
+    """Repeated topics are pre-generated and the next request skips upstream"""
+    import asyncio
+    import json
+    import httpx
+    from app.services.warmer import warmer
+    
+    calls = []
+    
+    def upstream(request):
+        calls.append(request)
+        content = {"variations": [{"headline": f"Wake up {i}", "body": f"Roast {i}."} for i in range(5)]}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}]})
+    
+    mock_llm(upstream)
+    for i in range(3):
+        response = client.post("/api/v1/copy/generate", json={
+            "copy_type": "marketing",
+            "topic": "Coffee  Subscription" if i else "coffee subscription",
+            "device_id": f"warm-device-{i}",
+            "variations": 2
+        })
+        assert response.status_code == 200
+    assert len(calls) == 3
+    
+    assert asyncio.run(warmer.warm_once()) == 2
+    assert len(calls) == 5
+    
+    response = client.post("/api/v1/copy/generate", json={
+        "copy_type": "marketing",
+        "topic": "Coffee subscription",
+        "device_id": "warm-device-3",
+        "variations": 2
+    })
+    assert response.status_code == 200
+    assert len(response.json()["variations"]) == 2
+    assert response.json()["remaining_generations"] == 2
+    assert len(calls) == 5
+    
+    # Warm results are single-use; another tone is a different request
+    assert warmer.take("marketing", "coffee subscription", "professional", "en") is not None
+    assert warmer.take("marketing", "coffee subscription", "professional", "en") is None
+    assert warmer.take("marketing", "coffee subscription", "playful", "en") is None
+
+
+def test_admin_profile_returns_collapsed_stacks(client: TestClient, monkeypatch):
+    """The profiler is hidden without ADMIN_TOKEN and needs it in X-Admin-Token"""
+    from app.api import admin
+    
+    response = client.get("/api/v1/admin/profile?seconds=0.05")
+    assert response.status_code == 404
+    
+    monkeypatch.setattr(admin.settings, "ADMIN_TOKEN", "s3cret")
+    response = client.get("/api/v1/admin/profile?seconds=0.05", headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == 401
+    
+    response = client.get("/api/v1/admin/profile?seconds=0.1&all_threads=true", headers={"X-Admin-Token": "s3cret"})
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) >= 1 and ";" in stack
+    
+    response = client.get("/api/v1/admin/profile?seconds=3600", headers={"X-Admin-Token": "s3cret"})
+    assert response.status_code == 400
+
+
+def test_admin_memory_snapshot_diff(client: TestClient, monkeypatch):
+    """tracemalloc snapshots are diffed against the first one"""
+    from app.api import admin
+    
+    monkeypatch.setattr(admin.settings, "ADMIN_TOKEN", "s3cret")
+    headers = {"X-Admin-Token": "s3cret"}
+    
+    assert client.get("/api/v1/admin/memory/top", headers=headers).status_code == 409
+    response = client.post("/api/v1/admin/memory/snapshot", headers=headers)
+    assert response.json()["tracing"] is True
+    try:
+        leak = [bytearray(1024) for _ in range(200)]
+        response = client.get("/api/v1/admin/memory/top?limit=5", headers=headers)
+        assert response.status_code == 200
+        top = response.json()
+        assert any("test_api.py" in stat["site"] and stat["size_diff_bytes"] >= 200 * 1024 for stat in top)
+        
+        data = client.get("/api/v1/admin/memory", headers=headers).json()
+        assert data["rss_bytes"] > 0
+        assert data["series"]["http_requests"] >= 1
+    finally:
+        client.delete("/api/v1/admin/memory/snapshot", headers=headers)
+        del leak
+
+
+def test_request_metrics_use_route_templates(client: TestClient):
+    """Paths with device ids share one series per route"""
+    for i in range(3):
+        client.get(f"/api/v1/tokens/status/label-device-{i}")
+    client.get("/no/such/path")
+    
+    text = client.get("/metrics").text
+    assert 'endpoint="/api/v1/tokens/status/{device_id}"' in text
+    assert "label-device" not in text
+    assert 'endpoint="unmatched"' in text
+    assert "worker_resident_memory_bytes" in text
+
+
+def test_drain_mode_refuses_new_generations(client: TestClient, monkeypatch):
+    """Draining turns /health 503 and refuses generations, other endpoints still answer"""
+    from app.api import admin
+    
+    monkeypatch.setattr(admin.settings, "ADMIN_TOKEN", "s3cret")
+    assert client.get("/health").status_code == 200
+    
+    response = client.post("/api/v1/admin/drain", headers={"X-Admin-Token": "s3cret"})
+    assert response.json() == {"draining": True, "in_flight": 0}
+    
+    response = client.get("/health")
+    assert response.status_code == 503
+    assert response.json()["status"] == "draining"
+    
+    response = client.post("/api/v1/copy/generate", json={
+        "copy_type": "marketing",
+        "topic": "Coffee",
+        "device_id": "drain-device"
+    })
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    
+    response = client.get("/api/v1/tokens/status/drain-device")
+    assert response.json()["remaining_generations"] == 3
+
+
+def test_responses_are_compressed_when_large(client: TestClient, mock_llm, db):
+    """Large bodies are gzipped, small ones aren't, and compact mode drops repeated fields"""
+    import gzip
+    import json
+    import httpx
+    from app.services.history_service import flush_history
+    
+    long_body = "Freshly roasted beans delivered to your door every week. " * 40
+    
+    def upstream(request):
+        content = {"variations": [{"headline": f"Wake up {i}", "body": long_body} for i in range(3)]}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}]})
+    
+    mock_llm(upstream)
+    payload = {"copy_type": "marketing", "topic": "Coffee", "device_id": "gzip-device-1"}
+    response = client.post("/api/v1/copy/generate", json=payload, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert int(response.headers["content-length"]) < len(response.content) / 5
+    full = response.json()
+    
+    response = client.post("/api/v1/copy/generate?compact=true", json=payload, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    compact = response.json()
+    assert compact["variations"] == [v["content"] for v in full["variations"]]
+    assert compact["remaining_generations"] == 1
+    assert "success" not in compact
+    
+    response = client.get("/health", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    
+    # Streamed exports are compressed chunk by chunk
+    assert flush_history(db) == 6
+    response = client.get("/api/v1/copy/history/gzip-device-1", params={"compact": True})
+    data = response.json()
+    assert data["fields"][-1] == "content" and len(data["items"]) == 6
+    with client.stream(
+        "GET", "/api/v1/copy/history/gzip-device-1/export", headers={"Accept-Encoding": "gzip"}
+    ) as response:
+        assert response.headers["content-encoding"] == "gzip"
+        assert "content-length" not in response.headers
+        raw = b"".join(response.iter_raw())
+    lines = gzip.decompress(raw).decode().splitlines()
+    assert len(lines) == 6 and long_body.strip() in json.loads(lines[0])["content"]
@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 from app.services.token_service import (
     check_can_generate,
     consume_generation,
+    refund_generation,
     get_free_trial_usage,
     create_token,
 )
@@ -118,6 +119,31 @@ def test_multiple_tokens(db):
     assert is_free == False
 
 
+def test_consume_with_stale_session_does_not_overdraw(db):
+    """A session holding stale token state must not push remaining below zero"""
+    from tests.conftest import TestingSessionLocal
+    
+    device_id = "stale-session-device"
+    create_token(db, device_id, "pack_10", 1, 365)
+    
+    other = TestingSessionLocal()
+    try:
+        # Both sessions see one remaining generation
+        assert check_can_generate(other, device_id) == (True, 1, False)
+        assert consume_generation(db, device_id) == (True, 0, False)
+        
+        # The paid token is gone, so the other session falls back to free trial
+        success, remaining, was_free = consume_generation(other, device_id)
+        assert success == True
+        assert was_free == True
+    finally:
+        other.close()
+    
+    token = db.query(GenerationToken).filter(GenerationToken.device_id == device_id).one()
+    db.refresh(token)
+    assert token.remaining_generations == 0
+
+
 def test_get_free_trial_usage_creates(db):
     """get_free_trial_usage should create record if not exists"""
     device_id = "new-free-trial-device"
@@ -127,3 +153,900 @@ def test_get_free_trial_usage_creates(db):
     assert usage is not None
     assert usage.device_id == device_id
     assert usage.generations_used == 0
+
+
+def test_creem_checkout_deduplicates_double_clicks():
+    """Identical concurrent checkouts should share one upstream session"""
+    import asyncio
+    import httpx
+    from app.services.payment_service import CreemClient, parse_product_ids
+    from app.shared_store import MemoryStore
+    
+    calls = []
+    
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"id": f"chk_{len(calls)}", "checkout_url": "https://pay/x"})
+    
+    async def run():
+        client = CreemClient(
+            api_base="https://creem.test",
+            api_key="key",
+            product_ids=parse_product_ids('{"pack_10": "prod_1", "pack_50": ""}'),
+            store=MemoryStore(),
+            transport=httpx.MockTransport(handler),
+        )
+        args = ("double-click-device", "pack_10", "http://s", "http://c")
+        first, second = await asyncio.gather(
+            client.create_checkout(*args), client.create_checkout(*args)
+        )
+        third = await client.create_checkout(*args)
+        other = await client.create_checkout("other-device-123", "pack_10", "http://s", "http://c")
+        await client.aclose()
+        return first, second, third, other, client.product_ids
+    
+    first, second, third, other, product_ids = asyncio.run(run())
+    
+    assert product_ids == {"pack_10": "prod_1"}
+    assert first == second == third
+    assert other["checkout_id"] != first["checkout_id"]
+    assert len(calls) == 2
+
+
+def test_creem_checkout_retries_only_when_nothing_was_created():
+    """Refusals and connect failures are retried; read timeouts are not"""
+    import asyncio
+    import httpx
+    from app.services.payment_service import CreemClient, CreemError
+    from app.shared_store import MemoryStore
+    
+    def run(outcomes):
+        calls = []
+        
+        def handler(request):
+            outcome = outcomes[len(calls)]
+            calls.append(request)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return httpx.Response(outcome, json={"id": "chk_1", "checkout_url": "https://pay/x"})
+        
+        async def checkout():
+            client = CreemClient(
+                api_base="https://creem.test",
+                api_key="key",
+                product_ids={"pack_10": "prod_1"},
+                cache_seconds=0,
+                store=MemoryStore(),
+                transport=httpx.MockTransport(handler),
+            )
+            try:
+                return await client.create_checkout("retry-device-123", "pack_10", "http://s", "http://c")
+            finally:
+                await client.aclose()
+        
+        try:
+            result = asyncio.run(checkout())
+        except CreemError:
+            result = None
+        return result, len(calls)
+    
+    assert run([503, httpx.ConnectError("refused"), 200]) == ({"checkout_url": "https://pay/x", "checkout_id": "chk_1"}, 3)
+    assert run([httpx.ReadTimeout("slow"), 200]) == (None, 1)
+    assert run([502, 200]) == (None, 1)
+
+
+def test_creem_checkout_waiters_take_over_a_failed_lock():
+    """A worker waiting on another's checkout claims it once that one fails"""
+    import asyncio
+    import time
+    import httpx
+    from app.services.payment_service import CheckoutInProgress, CreemClient, CreemError
+    from app.shared_store import MemoryStore
+    
+    calls = []
+    
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            return httpx.Response(400, json={"error": "bad request"})
+        return httpx.Response(200, json={"id": "chk_2", "checkout_url": "https://pay/x"})
+    
+    store = MemoryStore()
+    
+    def worker(timeout=5.0):
+        return CreemClient(
+            api_base="https://creem.test",
+            api_key="key",
+            product_ids={"pack_10": "prod_1"},
+            timeout=timeout,
+            store=store,
+            transport=httpx.MockTransport(handler),
+        )
+    
+    args = ("lock-device-123", "pack_10", "http://s", "http://c")
+    
+    async def run():
+        first, second = worker(), worker()
+        started = time.monotonic()
+        results = await asyncio.gather(
+            first.create_checkout(*args), second.create_checkout(*args), return_exceptions=True
+        )
+        return results, time.monotonic() - started
+    
+    results, elapsed = asyncio.run(run())
+    assert isinstance(results[0], CreemError)
+    assert results[1] == {"checkout_url": "https://pay/x", "checkout_id": "chk_2"}
+    assert elapsed < 1
+    
+    # A lock that is never released times out without posting
+    store.clear()
+    calls.clear()
+    store.add(CreemClient._cache_key(args) + ":lock", 1)
+    with pytest.raises(CheckoutInProgress):
+        asyncio.run(worker(timeout=0.2).create_checkout(*args))
+    assert calls == []
+
+
+def test_sqlite_shared_store(tmp_path):
+    """Shared store should support TTLs, add-if-absent and atomic updates"""
+    from app.shared_store import SQLiteStore
+    
+    store = SQLiteStore(str(tmp_path / "shared.db"))
+    
+    assert store.add("lock", 1, ttl=60) is True
+    assert store.add("lock", 1, ttl=60) is False
+    
+    # A failed add rolls back instead of committing
+    with pytest.raises(TypeError):
+        store.add("unserializable", object())
+    assert store.get("unserializable") is None
+    assert store.add("unserializable", 1) is True
+    
+    store.set("expired", {"a": 1}, ttl=-1)
+    assert store.get("expired") is None
+    
+    for _ in range(5):
+        store.update("counter", lambda v: (v or 0) + 1)
+    assert store.get("counter") == 5
+    
+    # A second handle (as another worker would have) sees the same data
+    assert SQLiteStore(str(tmp_path / "shared.db")).get("counter") == 5
+
+
+def test_maintenance_archives_and_prunes(db):
+    """Spent tokens move to the archive; unused free-trial rows are pruned"""
+    from app.models import ArchivedGenerationToken
+    from app.services.maintenance_service import run_maintenance
+    
+    now = datetime.utcnow()
+    live = create_token(db, "maint-live-device", "pack_10", 10, 365)
+    exhausted = create_token(db, "maint-spent-device", "pack_10", 10, 365)
+    exhausted.remaining_generations = 0
+    exhausted.updated_at = now - timedelta(days=2)
+    db.add(GenerationToken(
+        device_id="maint-expired-device",
+        product_sku="pack_10",
+        total_generations=10,
+        remaining_generations=4,
+        expires_at=now - timedelta(days=1)
+    ))
+    db.add_all([
+        FreeTrialUsage(device_id="maint-idle-device", generations_used=0,
+                       created_at=now - timedelta(days=30), last_used_at=now - timedelta(days=30)),
+        FreeTrialUsage(device_id="maint-gone-device", generations_used=3,
+                       created_at=now - timedelta(days=400), last_used_at=now - timedelta(days=400)),
+        FreeTrialUsage(device_id="maint-recent-device", generations_used=1),
+    ])
+    db.commit()
+    
+    report = run_maintenance(db, now)
+    
+    assert report["archived_tokens"] == 2
+    assert report["pruned_free_trials"] == 1
+    assert "duration_seconds" in report
+    assert [t.id for t in db.query(GenerationToken).all()] == [live.id]
+    assert db.query(ArchivedGenerationToken).count() == 2
+    # A used trial is kept however old, or the device would get a new one
+    assert sorted(u.device_id for u in db.query(FreeTrialUsage).all()) == ["maint-gone-device", "maint-recent-device"]
+
+
+def test_maintenance_keeps_just_exhausted_tokens_refundable(db):
+    """A token that gave its last credit isn't archived before a refund can land"""
+    from app.services.maintenance_service import archive_tokens
+    
+    token = create_token(db, "maint-last-credit", "pack_10", 1, 365)
+    assert consume_generation(db, "maint-last-credit")[0] is True
+    
+    assert archive_tokens(db, datetime.utcnow(), 100, 1) == 0
+    assert refund_generation(db, "maint-last-credit", was_free_trial=False) is True
+    db.refresh(token)
+    assert token.remaining_generations == 1
+    
+    # Exhausted past the grace period, it is archived
+    consume_generation(db, "maint-last-credit")
+    assert archive_tokens(db, datetime.utcnow() + timedelta(hours=25), 100, 1) == 1
+
+
+def test_device_balance_tracks_purchases_and_consumption(db):
+    """The balance row should follow token creation and consumption"""
+    from app.models import DeviceBalance
+    from app.services.maintenance_service import reconcile_balances
+    
+    device_id = "ledger-device"
+    create_token(db, device_id, "pack_10", 10, 365)
+    create_token(db, device_id, "pack_50", 50, 30)
+    
+    balance = db.get(DeviceBalance, device_id)
+    assert balance.paid_remaining == 60
+    assert balance.next_expiry < datetime.utcnow() + timedelta(days=31)
+    
+    consume_generation(db, device_id)
+    db.refresh(balance)
+    assert balance.paid_remaining == 59
+    assert check_can_generate(db, device_id) == (True, 59, False)
+    
+    # Nothing drifted, then simulate a lost update
+    assert reconcile_balances(db, datetime.utcnow(), 100) == {"checked": 1, "drifted": 0}
+    balance.paid_remaining = 5
+    db.commit()
+    assert reconcile_balances(db, datetime.utcnow(), 100) == {"checked": 1, "drifted": 1}
+    db.refresh(balance)
+    assert balance.paid_remaining == 59
+
+
+def test_device_balance_rebuilds_after_expiry(db):
+    """A balance past its next expiry is rebuilt from the tokens"""
+    device_id = "ledger-expiry-device"
+    token = create_token(db, device_id, "pack_10", 10, 365)
+    create_token(db, device_id, "pack_50", 50, 365)
+    assert check_can_generate(db, device_id) == (True, 60, False)
+    
+    token.expires_at = datetime.utcnow() - timedelta(seconds=1)
+    from app.models import DeviceBalance
+    db.get(DeviceBalance, device_id).next_expiry = token.expires_at
+    db.commit()
+    
+    assert check_can_generate(db, device_id) == (True, 50, False)
+
+
+def test_exhausted_filter_skips_database(db, monkeypatch):
+    """Refused devices are refused again without a query until they buy"""
+    from app.services import token_service
+    from app.services.exhausted_filter import exhausted_devices
+    
+    monkeypatch.setattr(exhausted_devices, "verify_rate", 0)
+    device_id = "filter-exhausted-device"
+    db.add(FreeTrialUsage(device_id=device_id, generations_used=3))
+    db.commit()
+    
+    assert check_can_generate(db, device_id) == (False, 0, False)
+    
+    def no_db(*args, **kwargs):
+        raise AssertionError("database should not be consulted")
+    
+    monkeypatch.setattr(token_service, "get_device_balance", no_db)
+    assert check_can_generate(db, device_id) == (False, 0, False)
+    monkeypatch.undo()
+    
+    # A purchase clears the device
+    create_token(db, device_id, "pack_10", 10, 365)
+    assert check_can_generate(db, device_id) == (True, 10, False)
+
+
+def test_exhausted_filter_false_positive_keeps_real_entries():
+    """Clearing a device that was never added must not weaken other entries"""
+    from app.services.exhausted_filter import ExhaustedDeviceFilter
+    from app.shared_store import MemoryStore
+    
+    devices = ExhaustedDeviceFilter(capacity=4, fp_rate=0.3, verify_rate=0, reset_seconds=3600, store=MemoryStore())
+    devices.add("real-exhausted-device")
+    ghost = next(f"ghost-{i}" for i in range(10000) if f"ghost-{i}" in devices.bloom and f"ghost-{i}" != "real-exhausted-device")
+    bits = bytes(devices.bloom.bits)
+    
+    assert devices.is_exhausted(ghost)
+    devices.allowed(ghost)
+    assert not devices.is_exhausted(ghost)
+    assert bytes(devices.bloom.bits) == bits
+    assert devices.is_exhausted("real-exhausted-device")
+
+
+def test_exhausted_filter_purchases_reach_other_workers():
+    """A purchase through one worker clears the device in the others without a store read per hit"""
+    from app.services.exhausted_filter import ExhaustedDeviceFilter
+    from app.shared_store import MemoryStore
+    
+    class CountingStore(MemoryStore):
+        reads = 0
+        
+        def get(self, key, default=None):
+            self.reads += 1
+            return super().get(key, default)
+    
+    store = CountingStore()
+    first, second = (
+        ExhaustedDeviceFilter(capacity=1000, fp_rate=1e-4, verify_rate=0, reset_seconds=3600,
+                              sync_seconds=3600, store=store)
+        for _ in range(2)
+    )
+    first.add("buyer-device")
+    first.add("still-exhausted-device")
+    reads = store.reads
+    for _ in range(100):
+        assert first.is_exhausted("still-exhausted-device")
+    assert store.reads == reads
+    
+    second.discard("buyer-device")
+    assert first.is_exhausted("buyer-device")  # not synced yet
+    first.sync_seconds = 0
+    assert not first.is_exhausted("buyer-device")
+    assert first.is_exhausted("still-exhausted-device")
+    
+    # A refusal right after a purchase may come from a stale balance read
+    first.add("buyer-device")
+    assert not first.is_exhausted("buyer-device")
+
+
+def test_bloom_filter():
+    from app.services.exhausted_filter import BloomFilter
+    
+    bloom = BloomFilter(capacity=1000, fp_rate=1e-4)
+    for i in range(1000):
+        bloom.add(f"device-{i}")
+    
+    assert all(f"device-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives <= 10
+    assert bloom.estimated_fp_rate < 1e-3
+    # One bit per slot
+    assert bloom.memory_bytes == (bloom.size + 7) // 8
+    
+    bloom.clear()
+    assert "device-1" not in bloom
+
+
+def test_sharded_storage_routes_by_device(tmp_path):
+    """With sharding, each device's rows live in one shard file"""
+    from sqlalchemy import inspect as sa_inspect
+    from app.models import DeviceBalance, PaymentTransaction
+    from app.sharding import ShardRouter
+    from app.services.maintenance_service import run_maintenance
+    
+    router = ShardRouter.from_template(f"sqlite:///{tmp_path}/shard{{shard}}.db", 3)
+    router.create_all()
+    db = router.session_factory()()
+    devices = [f"sharded-device-{i}" for i in range(12)]
+    
+    try:
+        for device_id in devices:
+            token = create_token(db, device_id, "pack_10", 10, 365)
+            db.add(PaymentTransaction(
+                token_id=token.id, product_sku="pack_10", provider_transaction_id=f"tx-{device_id}",
+                amount_cents=499, status="completed", device_id=device_id
+            ))
+            db.commit()
+            assert consume_generation(db, device_id) == (True, 9, False)
+        
+        # Every device's rows are in the shard the router picks for it
+        for shard_id, shard_engine in router.engines.items():
+            with shard_engine.connect() as conn:
+                rows = conn.exec_driver_sql("SELECT device_id FROM generation_tokens").fetchall()
+            assert {r[0] for r in rows} == {d for d in devices if router.shard_for(d) == shard_id}
+        
+        # Queries without a device_id fan out to every shard
+        assert db.query(PaymentTransaction).filter(
+            PaymentTransaction.provider_transaction_id == "tx-sharded-device-7"
+        ).one().device_id == "sharded-device-7"
+        assert db.get(DeviceBalance, "sharded-device-5").paid_remaining == 9
+        assert check_can_generate(db, "sharded-device-5") == (True, 9, False)
+        
+        report = run_maintenance(db)
+        assert report["balances_checked"] == len(devices)
+        assert report["balance_drift"] == 0
+    finally:
+        db.close()
+        router.dispose()
+
+
+def test_disconnect_cancels_generation_and_refunds(db, monkeypatch):
+    """A client that goes away cancels the upstream call and gets its credit back"""
+    import asyncio
+    import httpx
+    from app.api import copy as copy_api
+    from app.schemas import CopyGenerateRequest
+    from app.services import copy_service
+    from app.services.token_service import get_device_balance
+    
+    monkeypatch.setattr(copy_api.settings, "LLM_DISCONNECT_POLL_SECONDS", 0.01)
+    upstream_cancelled = []
+    
+    async def slow_upstream(request):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            upstream_cancelled.append(request.url.path)
+            raise
+    
+    class DisconnectedRequest:
+        async def is_disconnected(self):
+            return True
+    
+    async def generate(device_id):
+        copy_service.start_llm_client(httpx.MockTransport(slow_upstream))
+        try:
+            return await copy_api.generate_copy_endpoint(
+                CopyGenerateRequest(copy_type="marketing", topic="Test", device_id=device_id),
+                DisconnectedRequest(),
+                db
+            )
+        finally:
+            await copy_service.close_llm_client()
+    
+    create_token(db, "paid-disconnect-device", "pack_10", 10, 365)
+    response = asyncio.run(generate("paid-disconnect-device"))
+    assert response.status_code == 499
+    assert upstream_cancelled == ["/v1/chat/completions"]
+    assert get_device_balance(db, "paid-disconnect-device").paid_remaining == 10
+    assert db.query(GenerationToken).filter(
+        GenerationToken.device_id == "paid-disconnect-device"
+    ).one().remaining_generations == 10
+    
+    response = asyncio.run(generate("free-disconnect-device"))
+    assert response.status_code == 499
+    assert get_free_trial_usage(db, "free-disconnect-device").generations_used == 0
+    assert get_device_balance(db, "free-disconnect-device").free_used == 0
+
+
+def test_generate_copy_tops_up_missing_variations():
+    """A short reply is completed with a follow-up call for the missing count"""
+    import asyncio
+    import json
+    import httpx
+    from app.schemas import CopyType
+    from app.services import copy_service
+    
+    replies = [
+        {"variations": [{"headline": "A", "body": "First"}, {"headline": "B"}, {"headline": "C", "body": "Second"}]},
+        {"variations": [{"headline": "D", "body": "Third"}, {"headline": "E", "body": "Fourth"}, {"headline": "F", "body": "Extra"}]},
+    ]
+    prompts = []
+    
+    def upstream(request):
+        prompts.append(json.loads(request.content)["messages"][1]["content"])
+        content = json.dumps(replies[len(prompts) - 1])
+        return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+    
+    async def generate():
+        copy_service.start_llm_client(httpx.MockTransport(upstream))
+        try:
+            return await copy_service.generate_copy(CopyType.MARKETING, "Coffee", "fun", "en", 4)
+        finally:
+            await copy_service.close_llm_client()
+    
+    variations = asyncio.run(generate())
+    assert [v["body"] for v in variations] == ["First", "Second", "Third", "Fourth"]
+    assert len(prompts) == 2
+    assert prompts[1].startswith("Generate 2 ")
+    assert '"body": "Second"' in prompts[1]
+
+
+def test_near_duplicate_variations_are_dropped():
+    from app.schemas import CopyType
+    from app.services.copy_service import accept_variations
+    from app.services.similarity import NearDuplicateFilter, jaccard, shingles
+    
+    assert jaccard(shingles("Wake up to Better Coffee!"), shingles("wake up to better coffee")) == 1.0
+    assert jaccard(shingles("Wake up to better coffee"), shingles("Fresh beans, delivered weekly")) < 0.2
+    
+    candidates = [
+        {"headline": "Brew", "body": "Start every morning with freshly roasted beans delivered to your door."},
+        {"headline": "Brew", "body": "Start every morning with freshly roasted beans delivered to your doorstep."},
+        {"headline": "Save", "body": "Cafe-quality espresso at home for a fraction of the price."},
+    ]
+    duplicates = NearDuplicateFilter(threshold=0.8)
+    accepted = accept_variations(CopyType.MARKETING, candidates, [], 3, duplicates)
+    assert accepted == [candidates[0], candidates[2]]
+
+
+def test_degradation_policy_levels(monkeypatch):
+    """Free traffic is degraded under load; paid traffic keeps its model"""
+    from app.services.degradation import DegradationPolicy, Priority, settings as degradation_settings
+    
+    monkeypatch.setattr(degradation_settings, "LLM_MAX_CONNECTIONS", 10)
+    monkeypatch.setattr(degradation_settings, "DEGRADE_MODEL", "fast-model")
+    monkeypatch.setattr(degradation_settings, "DEGRADE_HOLD_SECONDS", 0)
+    policy = DegradationPolicy()
+    
+    for _ in range(7):
+        policy.started()
+    assert policy.level == 1
+    plan = policy.plan(Priority.FREE, 5)
+    assert (plan.model, plan.max_tokens, plan.variations) == ("fast-model", 1000, 5)
+    assert policy.plan(Priority.PAID, 5).model == degradation_settings.LLM_MODEL
+    
+    for _ in range(3):
+        policy.started()
+    assert policy.level == 2
+    assert policy.plan(Priority.FREE, 5).variations == 2
+    assert policy.plan(Priority.PAID, 5).variations == 3
+    assert policy.plan(Priority.PAID, 2).variations == 2
+    
+    # Just below the threshold isn't enough to step down (hysteresis)
+    policy.finished(None)
+    assert policy.level == 2
+    for _ in range(2):
+        policy.finished(None)
+    assert policy.level == 1
+    for _ in range(7):
+        policy.finished(None)
+    assert policy.level == 0
+    assert policy.plan(Priority.FREE, 5).model == degradation_settings.LLM_MODEL
+
+
+def test_degraded_free_generation_uses_faster_model(monkeypatch):
+    """Under heavy load, free-trial requests go upstream with DEGRADE_MODEL"""
+    import asyncio
+    import json
+    import time
+    import httpx
+    from app.config import get_settings
+    from app.schemas import CopyType
+    from app.services import copy_service
+    from app.services.degradation import Priority, degradation
+    
+    models = []
+    
+    def upstream(request):
+        body = json.loads(request.content)
+        models.append(body["model"])
+        content = json.dumps({"variations": [{"headline": f"Headline {i}", "body": f"Body text number {i}"} for i in range(3)]})
+        return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+    
+    settings = get_settings()
+    assert settings.DEGRADE_MODEL and settings.DEGRADE_MODEL != settings.LLM_MODEL
+    monkeypatch.setattr(degradation, "level", 2)
+    monkeypatch.setattr(degradation, "_changed_at", time.monotonic())
+    
+    async def generate(priority):
+        copy_service.start_llm_client(httpx.MockTransport(upstream))
+        try:
+            return await copy_service.generate_copy(CopyType.MARKETING, "Test", "professional", "en", 3, priority=priority)
+        finally:
+            await copy_service.close_llm_client()
+    
+    assert len(asyncio.run(generate(Priority.FREE))) == 2
+    assert len(asyncio.run(generate(Priority.PAID))) == 3
+    assert models == [settings.DEGRADE_MODEL, settings.LLM_MODEL]
+
+
+def test_scheduler_prefers_paid_and_caps_free():
+    """Queued paid calls get most slots; free calls can't use every slot"""
+    import asyncio
+    from app.services.degradation import Priority
+    from app.services.scheduler import GenerationScheduler
+    
+    async def run():
+        scheduler = GenerationScheduler(
+            capacity=2,
+            weights={Priority.PAID: 8, Priority.FREE: 2, Priority.BATCH: 1},
+            caps={Priority.PAID: 2, Priority.FREE: 1, Priority.BATCH: 1},
+        )
+        # Free is capped at one slot, so a paid call still gets in at once
+        await scheduler.acquire(Priority.FREE)
+        waiting_free = asyncio.ensure_future(scheduler.acquire(Priority.FREE))
+        await asyncio.sleep(0)
+        assert not waiting_free.done()
+        await asyncio.wait_for(scheduler.acquire(Priority.PAID), 1)
+        
+        order = []
+        
+        async def request(priority):
+            async with scheduler.slot(priority):
+                order.append(priority)
+                await asyncio.sleep(0)
+        
+        tasks = [asyncio.ensure_future(request(p)) for p in [Priority.FREE] * 10 + [Priority.PAID] * 10]
+        await asyncio.sleep(0)
+        scheduler.release(Priority.PAID)
+        scheduler.release(Priority.FREE)
+        # The queued free call got the free slot; give it back
+        await waiting_free
+        scheduler.release(Priority.FREE)
+        await asyncio.gather(*tasks)
+        assert scheduler.running == {p: 0 for p in Priority}
+        assert scheduler.queued == 0
+        return order
+    
+    order = asyncio.run(run())
+    assert order[:10].count(Priority.PAID) >= 8
+
+
+def test_space_saving_keeps_heavy_hitters():
+    from app.services.warmer import SpaceSaving
+    
+    sketch = SpaceSaving(capacity=3)
+    for i in range(200):
+        sketch.offer("popular")
+        sketch.offer(f"rare-{i}")
+        if i % 2 == 0:
+            sketch.offer("common")
+    
+    top = dict(sketch.top(2))
+    assert len(sketch.counts) == 3
+    assert list(top) == ["popular", "common"]
+    # Reported counts never exceed the true ones
+    assert top["popular"] <= 200
+    
+    # Seeded counts (as load_sketch offers them) rank the same way
+    sketch.clear()
+    sketch.offer("seeded", 50)
+    for i in range(100):
+        sketch.offer(f"rare-{i}")
+    assert sketch.top(1) == [("seeded", 50)]
+
+
+def test_warm_budget_is_shared_by_workers(monkeypatch):
+    """Workers draw warm generations from one hourly budget in the shared store"""
+    from app.services import warmer as warmer_module
+    from app.services.warmer import CacheWarmer, TOKENS_PER_GENERATION
+    
+    monkeypatch.setattr(warmer_module.settings, "WARMER_TOKEN_BUDGET_PER_HOUR", TOKENS_PER_GENERATION * 3)
+    workers = [CacheWarmer(100) for _ in range(3)]
+    granted = [worker._reserve(TOKENS_PER_GENERATION) for worker in workers * 2]
+    assert granted.count(True) == 3
+
+
+def test_cassette_records_and_replays_llm_traffic(tmp_path):
+    import asyncio
+    import json
+    import time
+    import httpx
+    from app.schemas import CopyType
+    from app.services import copy_service
+    from app.services.cassette import CassetteMiss, RecordingTransport, ReplayTransport
+    
+    path = str(tmp_path / "llm.jsonl.gz")
+    
+    async def upstream(request):
+        await asyncio.sleep(0.05)
+        content = {"variations": [{"headline": "Wake up", "body": "Fresh roasted coffee."}]}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}]})
+    
+    async def generate(transport, topic="Coffee"):
+        copy_service.start_llm_client(transport)
+        try:
+            return await copy_service.generate_copy(CopyType.MARKETING, topic, "fun", "en", 1)
+        finally:
+            await copy_service.close_llm_client()
+    
+    recorded = asyncio.run(generate(RecordingTransport(path, httpx.MockTransport(upstream))))
+    
+    started = time.perf_counter()
+    assert asyncio.run(generate(ReplayTransport(path))) == recorded
+    assert time.perf_counter() - started >= 0.05
+    
+    started = time.perf_counter()
+    assert asyncio.run(generate(ReplayTransport(path, latency_scale=0))) == recorded
+    assert time.perf_counter() - started < 0.05
+    
+    with pytest.raises(CassetteMiss):
+        asyncio.run(generate(ReplayTransport(path), topic="Tea"))
+    assert asyncio.run(generate(ReplayTransport(path, latency_scale=0, match_body=False), topic="Tea")) == recorded
+
+
+def test_loop_monitor_reports_blocking_call(monkeypatch, caplog):
+    import asyncio
+    import time
+    from app.services import profiler
+    
+    monkeypatch.setattr(profiler.settings, "LOOP_MONITOR_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(profiler.settings, "LOOP_BLOCKED_THRESHOLD_SECONDS", 0.1)
+    
+    def blocking_call():
+        time.sleep(0.3)
+    
+    async def run():
+        monitor = profiler.LoopMonitor()
+        monitor.start()
+        await asyncio.sleep(0.05)
+        blocking_call()
+        await asyncio.sleep(0.05)
+        monitor.stop()
+    
+    with caplog.at_level("WARNING", logger="app.services.profiler"):
+        asyncio.run(run())
+    assert "event loop blocked" in caplog.text
+    assert "blocking_call" in caplog.text
+
+
+def test_create_tables_skips_existing_schema(monkeypatch):
+    from sqlalchemy import create_engine
+    from app.database import create_tables
+    from app.models import Base
+    
+    engine = create_engine("sqlite://")
+    create_tables(engine)
+    
+    def fail(*args, **kwargs):
+        raise AssertionError("create_all ran on a complete schema")
+    
+    monkeypatch.setattr(Base.metadata, "create_all", fail)
+    create_tables(engine)
+
+
+def test_prewarm_opens_llm_connections():
+    import asyncio
+    import httpx
+    from app.services import copy_service
+    
+    requests = []
+    
+    def upstream(request):
+        requests.append(request.method)
+        return httpx.Response(404)
+    
+    async def prewarm():
+        copy_service.start_llm_client(httpx.MockTransport(upstream))
+        try:
+            await copy_service.prewarm_llm_client(3)
+        finally:
+            await copy_service.close_llm_client()
+    
+    asyncio.run(prewarm())
+    assert requests == ["HEAD"] * 3
+
+
+def test_import_time_budget():
+    """Cold start regression guard: importing the app stays within budget"""
+    import os
+    import subprocess
+    import sys
+    
+    budget = float(os.getenv("IMPORT_TIME_BUDGET_SECONDS", "3.0"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(__file__)), check=True
+    )
+    # "import time: self [us] | cumulative | package"
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+    total = dict((name, cumulative) for cumulative, name in rows)["app.main"] / 1e6
+    slowest = ", ".join(f"{name} {cumulative / 1e6:.2f}s" for cumulative, name in sorted(rows, reverse=True)[:8])
+    assert total < budget, f"importing took {total:.2f}s (budget {budget}s); slowest: {slowest}"
+
+
+def test_shutdown_cancellation_refunds_generation(db, monkeypatch):
+    """A generation cut off by shutdown gets its credit back"""
+    import asyncio
+    import httpx
+    from app.api import copy as copy_api
+    from app.schemas import CopyGenerateRequest
+    from app.services import copy_service
+    from app.services.token_service import get_device_balance
+    
+    async def slow_upstream(request):
+        await asyncio.sleep(30)
+    
+    class ConnectedRequest:
+        async def is_disconnected(self):
+            return False
+    
+    async def generate_then_cancel():
+        copy_service.start_llm_client(httpx.MockTransport(slow_upstream))
+        try:
+            task = asyncio.create_task(copy_api.generate_copy_endpoint(
+                CopyGenerateRequest(copy_type="marketing", topic="Test", device_id="shutdown-device"),
+                ConnectedRequest(),
+                db
+            ))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        finally:
+            await copy_service.close_llm_client()
+    
+    create_token(db, "shutdown-device", "pack_10", 10, 365)
+    asyncio.run(generate_then_cancel())
+    assert get_device_balance(db, "shutdown-device").paid_remaining == 10
+
+
+def test_choose_encoding_honours_q_values(monkeypatch):
+    from app import compression
+    
+    monkeypatch.setattr(compression, "brotli", object())
+    assert compression.choose_encoding("gzip, deflate, br") == "br"
+    assert compression.choose_encoding("br;q=0, gzip;q=0.5") == "gzip"
+    assert compression.choose_encoding("*") == "br"
+    assert compression.choose_encoding("identity") is None
+    monkeypatch.setattr(compression, "brotli", None)
+    assert compression.choose_encoding("br") is None
+    assert compression.choose_encoding("br, gzip") == "gzip"
+
+
+def test_credit_books_balance_under_concurrent_load():
+    from scripts.stress_credits import run
+    
+    # More requests in flight per worker than the connection pool holds
+    result = run(workers=2, devices=3, credits=5, requests_per_device=20, concurrency=50, free_devices=1)
+    assert result["violations"] == []
+    assert result["statuses"].get(200)
+
+
+def test_client_ip_trusts_only_configured_proxies(monkeypatch):
+    from app import ratelimit
+    
+    def scope(peer):
+        return {"client": (peer, 1234), "headers": [(b"x-real-ip", b"203.0.113.7")]}
+    
+    # Private peers aren't trusted by default: Docker NAT makes direct clients look private
+    monkeypatch.setattr(ratelimit.settings, "RATE_LIMIT_TRUSTED_PROXIES", "")
+    assert ratelimit.client_ip(scope("172.18.0.1")) == "172.18.0.1"
+    
+    monkeypatch.setattr(ratelimit.settings, "RATE_LIMIT_TRUSTED_PROXIES", "10.0.0.5, 172.20.0.0/16")
+    assert ratelimit.client_ip(scope("172.20.3.4")) == "203.0.113.7"
+    assert ratelimit.client_ip(scope("10.0.0.5")) == "203.0.113.7"
+    assert ratelimit.client_ip(scope("172.18.0.1")) == "172.18.0.1"
+    assert ratelimit.client_ip(scope("testclient")) == "testclient"
+
+
+def test_kit_mixing_paid_and_free_trial_is_reported_as_free(db, monkeypatch):
+    """A kit that runs out of paid credits mid-way is a free-trial kit"""
+    import asyncio
+    from app.api import copy as copy_api
+    from app.schemas import CopyKitRequest
+    from app.services.scheduler import Priority
+    
+    priorities = []
+    
+    async def fake_kit(copy_types, priority, **kwargs):
+        priorities.append(priority)
+        return {copy_type: [{"headline": "Kit", "body": "Kit copy."}] for copy_type in copy_types}
+    
+    class ConnectedRequest:
+        async def is_disconnected(self):
+            return False
+    
+    monkeypatch.setattr(copy_api, "generate_kit", fake_kit)
+    create_token(db, "mixed-kit-device", "pack_10", 1, 365)
+    request = CopyKitRequest(copy_types=["marketing", "social"], topic="Test", device_id="mixed-kit-device", variations=1)
+    
+    response = asyncio.run(copy_api.generate_kit_endpoint(request, ConnectedRequest(), db))
+    assert response.is_free_trial is True
+    assert [section.is_free_trial for section in response.sections] == [False, True]
+    assert priorities == [Priority.FREE]
+
+
+def test_every_metric_has_tool_label():
+    """Dashboards select on tool=, so every metric must carry it"""
+    from prometheus_client.metrics import MetricWrapperBase
+    from app import metrics
+    
+    unlabelled = [
+        name for name, metric in vars(metrics).items()
+        if isinstance(metric, MetricWrapperBase) and "tool" not in metric._labelnames
+    ]
+    assert unlabelled == []
+
+
+def test_drain_reaches_every_worker(tmp_path, monkeypatch):
+    """Draining through one worker drains its siblings, not the next server on the store"""
+    from app.drain import DrainState
+    from app.shared_store import SQLiteStore
+    
+    # Two workers of one gunicorn master: same boot id, own store handles
+    monkeypatch.setenv("APP_BOOT_ID", "boot-1")
+    first = DrainState(SQLiteStore(str(tmp_path / "shared.db")), check_seconds=0)
+    second = DrainState(SQLiteStore(str(tmp_path / "shared.db")), check_seconds=0)
+    assert not second.draining
+    
+    first.start()
+    assert first.draining and second.draining
+    
+    # After a restart the flag left in the store no longer applies
+    monkeypatch.setenv("APP_BOOT_ID", "boot-2")
+    assert not DrainState(SQLiteStore(str(tmp_path / "shared.db")), check_seconds=0).draining